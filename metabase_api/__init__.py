@@ -1,2 +1,6 @@
 from .metabase_api import Metabase_API
 from .metabase_api_async import Metabase_API_Async
+from ._retry import RetryPolicy, CircuitBreaker, CircuitBreakerOpen
+from ._rate_limit import RateLimiter
+from ._metadata_store import MetadataStore
+from ._result_cache import ResultCache
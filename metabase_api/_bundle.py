@@ -0,0 +1,271 @@
+import gzip
+import json
+import os
+
+BUNDLE_VERSION = 1
+# the keys of a card definition that are kept when it is created from a bundle
+CARD_KEYS = ['name', 'description', 'display', 'visualization_settings', 'dataset_query', 'parameters', 'type', 'dataset',
+             'cache_ttl', 'collection_position']
+REFERENCE_KINDS = ['database', 'table', 'field', 'segment', 'card']
+
+
+class BundleWriter():
+    """
+    Write a bundle (see export_collection_bundle): a gzip-compressed JSON lines file with one object per line,
+    {"kind": ..., "data": ...}, written as the objects are received. The file is written under a temporary name
+    and renamed when complete, so an interrupted export does not leave a partial bundle behind.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.counts = {}
+        self._tmp_path = path + '.part'
+        self._file = gzip.open(self._tmp_path, 'wt', encoding='utf-8')
+        self.write('header', {'version': BUNDLE_VERSION})
+
+
+    def write(self, kind, data):
+        self._file.write(json.dumps({'kind': kind, 'data': data}, ensure_ascii=False) + '\n')
+        if kind != 'header':
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+
+    def close(self):
+        """Finish the bundle and return a report: {'path', 'bytes', 'counts': {kind: number of objects}}"""
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        return {'path': self.path, 'bytes': os.path.getsize(self.path), 'counts': self.counts}
+
+
+    def abort(self):
+        """Close and remove the incomplete bundle"""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+
+def read_bundle(path):
+    """Return {kind: [objects]} for the objects of the given bundle, in the order they were written"""
+    bundle = { kind: [] for kind in ['collection', 'card', 'dashboard', 'pulse', 'segment'] + REFERENCE_KINDS }
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            record = json.loads(line)
+            if i == 0:
+                if record['kind'] != 'header' or record['data']['version'] > BUNDLE_VERSION:
+                    raise ValueError('{} is not a bundle or was made by a newer version of this package'.format(path))
+                continue
+            bundle.setdefault(record['kind'], []).append(record['data'])
+    return bundle
+
+
+
+def remap_references(obj, remap):
+    """
+    Return a copy of a query or definition (e.g. a dataset_query, the parameters of a card, the definition of a segment)
+    where every referenced database, table, field, segment and card id is replaced by remap(kind, id).
+    """
+    if isinstance(obj, list):
+        if len(obj) >= 2 and obj[0] in ['field', 'field-id'] and _is_id(obj[1]):
+            return [obj[0], remap('field', obj[1])] + [ remap_references(i, remap) for i in obj[2:] ]
+        if len(obj) == 2 and obj[0] == 'segment' and _is_id(obj[1]):
+            return ['segment', remap('segment', obj[1])]
+        return [ remap_references(i, remap) for i in obj ]
+
+    if isinstance(obj, dict):
+        result = {}
+        for key, value in obj.items():
+            if key == 'source-table' and isinstance(value, str) and value.startswith('card__'):
+                result[key] = 'card__{}'.format(remap('card', int(value[len('card__'):])))
+            elif key in _REFERENCE_KEYS and _is_id(value):
+                result[key] = remap(_REFERENCE_KEYS[key], value)
+            else:
+                result[key] = remap_references(value, remap)
+        return result
+
+    return obj
+
+
+def remap_visualization_settings(settings, remap, dropped=None):
+    """
+    Return a copy of the visualization_settings of a card or dashcard with its references remapped (see remap_references),
+    including the field references in the keys of column_settings (e.g. '["ref",["field",12,null]]') and the cards and
+    dashboards targeted by click behaviors. remap can raise a ValueError for a reference it cannot remap: the setting using
+    it (e.g. a column setting or a click behavior) is then dropped, and {'setting': path of the setting, 'error': message}
+    is appended to the `dropped` list (if given).
+    """
+    return _remap_settings(settings, remap, dropped, [])
+
+
+
+def _remap_settings(settings, remap, dropped, path):
+    result = {}
+    for key, value in (settings or {}).items():
+        try:
+            if key == 'column_settings' and isinstance(value, dict):
+                value = _remap_column_settings(value, remap, dropped, path + [key])
+            elif key == 'click_behavior' and isinstance(value, dict):
+                value = _remap_click_behavior(value, remap)
+            else:
+                value = remap_references(value, remap)
+        except ValueError as e:
+            if dropped is not None:
+                dropped.append({ 'setting': path + [key], 'error': str(e) })
+            continue
+        result[key] = value
+    return result
+
+
+
+def _remap_column_settings(column_settings, remap, dropped, path):
+    result = {}
+    for column, settings in column_settings.items():
+        try:
+            new_column = _remap_json_strings(column, remap)
+        except ValueError as e:  # e.g. a field that is not in the bundle
+            if dropped is not None:
+                dropped.append({ 'setting': path + [column], 'error': str(e) })
+            continue
+        result[new_column] = _remap_settings(settings, remap, dropped, path + [column])
+    return result
+
+
+
+def _remap_click_behavior(click_behavior, remap):
+    click_behavior = remap_references(click_behavior, remap)
+    target_kind = _LINK_TYPES.get(click_behavior.get('linkType'))
+    if target_kind and _is_id(click_behavior.get('targetId')):
+        click_behavior['targetId'] = remap(target_kind, click_behavior['targetId'])
+    if 'parameterMapping' in click_behavior:
+        click_behavior['parameterMapping'] = _remap_json_strings(click_behavior['parameterMapping'], remap)
+    return click_behavior
+
+
+# the link types of click behaviors that target another item, and the kind of the item
+_LINK_TYPES = {'question': 'card', 'dashboard': 'dashboard'}
+
+
+
+def strip_item_links(settings):
+    """
+    Return a copy of visualization settings without the click behaviors that link to cards or dashboards
+    (they are set once all the items of a bundle are created, see import_collection_bundle)
+    """
+    result = {}
+    for key, value in (settings or {}).items():
+        if key == 'column_settings' and isinstance(value, dict):
+            value = { column: strip_item_links(column_value) for column, column_value in value.items() }
+        elif key == 'click_behavior' and isinstance(value, dict) and value.get('linkType') in _LINK_TYPES:
+            continue
+        result[key] = value
+    return result
+
+
+
+def _remap_json_strings(obj, remap):
+    """Remap the references in the strings (and keys) holding JSON arrays, e.g. '["dimension",["field",12,null]]'"""
+    if isinstance(obj, str) and obj.startswith('['):
+        try:
+            value = json.loads(obj)
+        except ValueError:
+            return obj
+        return json.dumps(remap_references(value, remap), separators=(',', ':'))
+    if isinstance(obj, list):
+        return [ _remap_json_strings(i, remap) for i in obj ]
+    if isinstance(obj, dict):
+        return { _remap_json_strings(key, remap): _remap_json_strings(value, remap) for key, value in obj.items() }
+    return obj
+
+
+# the keys whose (integer) values are references, and the kind of the referenced object
+_REFERENCE_KEYS = {'source-table': 'table', 'table_id': 'table', 'database': 'database', 'database_id': 'database',
+                   'source-field': 'field', 'field_id': 'field', 'card-id': 'card', 'card_id': 'card'}
+
+
+
+def _is_id(value):
+    # negative ids are not references (e.g. -1337, the virtual database of the queries based on saved questions)
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+
+def find_references(obj, references=None):
+    """Add the ids referenced by a query or definition (see remap_references) to references ({kind: set of ids}) and return it"""
+    if references is None:
+        references = { kind: set() for kind in REFERENCE_KINDS }
+    def add(kind, id):
+        references[kind].add(id)
+        return id
+    remap_references(obj, add)
+    return references
+
+
+
+def find_visualization_references(settings, references):
+    """
+    Add the databases, tables, fields and segments referenced by visualization settings (see remap_visualization_settings) 
+    to references. The cards and dashboards targeted by click behaviors are not added: when they are not in the bundle,
+    their click behaviors are dropped (and reported, see import_collection_bundle).
+    """
+    def add(kind, id):
+        if kind in references and kind != 'card':
+            references[kind].add(id)
+        return id
+    remap_visualization_settings(settings, add)
+    return references
+
+
+
+def get_visualization_settings(item):
+    """The visualization settings of a card, or of the dashcards of a dashboard"""
+    if 'dashcards' in item:
+        return [ dashcard.get('visualization_settings') for dashcard in item.get('dashcards') or [] ]
+    return [ item.get('visualization_settings') ]
+
+
+
+def get_card_references(card):
+    """The parts of a card that reference other objects"""
+    return { key: card.get(key) for key in ['dataset_query', 'parameters', 'table_id', 'database_id'] }
+
+
+
+def get_dashboard_references(dashboard):
+    """The parts of a dashboard that reference other objects (the cards of its dashcards and the targets of its filters)"""
+    return [ dashboard.get('parameters'),
+             [ {'card_id': dashcard.get('card_id'), 'series': [ {'card_id': card['id']} for card in dashcard.get('series') or [] ],
+                'parameter_mappings': dashcard.get('parameter_mappings')} for dashcard in dashboard.get('dashcards') or [] ] ]
+
+
+
+def get_pulse_references(pulse):
+    return [ {'card_id': card['id']} for card in pulse.get('cards') or [] ]
+
+
+
+def make_card_json(card, collection_id, remap):
+    """Return the json for creating the card of a bundle in the given collection, with its references remapped"""
+    card_json = { key: card[key] for key in CARD_KEYS if key in card }
+    card_json['collection_id'] = collection_id
+    for key in ['dataset_query', 'parameters']:
+        if key in card_json:
+            card_json[key] = remap_references(card_json[key], remap)
+    if 'visualization_settings' in card_json:
+        card_json['visualization_settings'] = remap_visualization_settings(card_json['visualization_settings'], remap)
+    if card_json.get('description') == '':  # see the issue #10
+        card_json['description'] = None
+    return card_json
+
+
+
+def make_pulse_json(pulse, collection_id, card_id_mapping):
+    """
+    Return the json for creating the pulse of a bundle in the given collection, using the new card ids.
+    The recipients that are users of the source Metabase are dropped (only the email addresses are kept).
+    """
+    pulse_json = { key: pulse[key] for key in ['name', 'skip_if_empty', 'parameters'] if key in pulse }
+    pulse_json['collection_id'] = collection_id
+    pulse_json['cards'] = [ dict(card, id=card_id_mapping[card['id']]) for card in pulse.get('cards') or [] ]
+    pulse_json['channels'] = [ dict({ key: value for key, value in channel.items() if key not in ['id', 'pulse_id'] },
+                                    recipients=[ i for i in channel.get('recipients') or [] if 'id' not in i ])
+                               for channel in pulse.get('channels') or [] ]
+    return pulse_json
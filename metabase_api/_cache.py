@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+class TTLCache():
+    """
+    Minimal thread-safe key -> value cache where entries expire after 'ttl' seconds.
+    If ttl is None nothing is stored, so every lookup is a miss.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = {}  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        """Return the cached value for the given key, or None if it is not cached or has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._entries[key]
+                return None
+            return value
+
+
+    def set(self, key, value):
+        """Cache the value (if ttl is set) and return it"""
+        if self.ttl is not None:
+            with self._lock:
+                self._entries[key] = (time.monotonic(), value)
+        return value
+
+
+    def invalidate(self, key=None):
+        """Drop the given key (or all the keys if key is None)"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,71 @@
+class CollectionTree():
+    """
+    In-memory tree of the collections, built from a single listing (GET /api/collection/) using the 'location'
+    of each collection (e.g. '/1/5/' for a child of the collection 5, itself a child of the collection 1).
+    A path is made of the names of the collections from the top level down, separated by '/' (e.g. 'Finance/Reports/Monthly').
+
+    Parameters
+    ----------
+    records : the collection records of the item index (see ItemIndex.make_record)
+    """
+    def __init__(self, records):
+        self._collections = {}
+        self._children = {None: []}
+        for record in records:
+            if not isinstance(record['id'], int):  # the 'root' pseudo-collection
+                continue
+            location = (record.get('location') or '/').strip('/')
+            parent_id = int(location.split('/')[-1]) if location else None
+            self._collections[record['id']] = {'id': record['id'], 'name': record['name'], 'parent_id': parent_id}
+            self._children.setdefault(record['id'], [])
+
+        for collection in self._collections.values():
+            if collection['parent_id'] not in self._collections:
+                collection['parent_id'] = None  # the parent is not visible (e.g. the personal collection of another user)
+            self._children[collection['parent_id']].append(collection['id'])
+
+        self._paths = {}
+        self._path_index = {}
+        stack = [ (i, '') for i in self._children[None] ]
+        while stack:
+            collection_id, parent_path = stack.pop()
+            path = parent_path + self._collections[collection_id]['name']
+            self._paths[collection_id] = path
+            self._path_index.setdefault(path, []).append(collection_id)
+            stack.extend( (i, path + '/') for i in self._children[collection_id] )
+
+
+    def __contains__(self, collection_id):
+        return collection_id in self._collections
+
+
+    def get_ids(self, path):
+        """Return the ids of the collections with the given path (more than one if siblings have the same name)"""
+        return list(self._path_index.get(path.strip('/'), []))
+
+
+    def get_path(self, collection_id):
+        return self._paths[collection_id]
+
+
+    def get_name(self, collection_id):
+        return self._collections[collection_id]['name']
+
+
+    def get_parent_id(self, collection_id):
+        """Return the id of the parent collection (None for the top-level collections)"""
+        return self._collections[collection_id]['parent_id']
+
+
+    def get_children(self, collection_id=None):
+        """Return the ids of the direct children of the given collection (or of the top-level collections if None)"""
+        return list(self._children[collection_id])
+
+
+    def iter_subtree(self, collection_id=None):
+        """Yield the ids of the given collection and all its descendants, parents before children"""
+        stack = [collection_id] if collection_id is not None else list(reversed(self._children[None]))
+        while stack:
+            collection_id = stack.pop()
+            yield collection_id
+            stack.extend(reversed(self._children[collection_id]))
@@ -0,0 +1,205 @@
+from array import array
+
+INTEGER_TYPES = ['type/Integer', 'type/BigInteger']
+FLOAT_TYPES = ['type/Float', 'type/Decimal']
+BOOLEAN_TYPES = ['type/Boolean']
+
+
+def _get_kind(col):
+    base_type = col.get('effective_type') or col.get('base_type')
+    if base_type in INTEGER_TYPES:
+        return 'integer'
+    if base_type in FLOAT_TYPES:
+        return 'float'
+    if base_type in BOOLEAN_TYPES:
+        return 'boolean'
+    return None
+
+
+
+def to_columnar(cols, rows, backend='array'):
+    """
+    Convert the 'cols' and 'rows' of a query result (the 'data' of POST /api/card/:id/query) into one compact
+    array per column. The type of each column is taken from its 'base_type' (as in the result_metadata of the card).
+
+    Parameters
+    ----------
+    cols : the column descriptions (data.cols)
+    rows : the rows (data.rows), as lists of cells
+    backend : the type of the returned arrays:
+        - 'array': integer columns become array('q'), float columns array('d') (nulls are NaN), boolean columns
+                   array('b') and the other columns lists. Integer columns with nulls become array('d') (nulls are NaN).
+        - 'numpy': same as 'array' but with numpy arrays (int64, float64, bool and object)
+        - 'pyarrow': a pyarrow Table (nulls are kept as nulls)
+    Date/time columns are kept as strings.
+
+    Returns {'columns': [column names], 'base_types': [base types], 'data': [one array per column]}
+    (a pyarrow Table for the 'pyarrow' backend).
+    """
+    builder = ColumnarBuilder(cols)
+    builder.add_rows(rows)
+    return builder.finish(backend)
+
+
+
+class ColumnarBuilder():
+    """
+    Build the columnar format (see to_columnar) from rows received in batches (e.g. streamed from an export). 
+    The cells of each batch are appended to one buffer per column, a typed array for the integer, float and 
+    boolean columns, so neither the rows nor a Python object per numeric cell are kept in memory.
+    """
+    def __init__(self, cols):
+        self.cols = cols
+        self._columns = [ _Column(_get_kind(col)) for col in cols ]
+
+
+    @classmethod
+    def from_columns(cls, cols, columns):
+        """Make a builder holding the given columns (lists of cells, as returned by get_columns)"""
+        builder = cls(cols)
+        for column, cells in zip(builder._columns, columns):
+            column.extend(cells)
+        return builder
+
+
+    def add_rows(self, rows):
+        """Append rows (lists of cells, in the order of the columns)"""
+        for i, column in enumerate(self._columns):
+            column.extend([ row[i] for row in rows ])
+
+
+    def get_columns(self):
+        """The cells of each column, as lists (nulls are None), e.g. for serializing them as JSON"""
+        return [ column.get_cells() for column in self._columns ]
+
+
+    def finish(self, backend='array'):
+        """Return the columnar format of the rows added so far, with the arrays of the given backend (see to_columnar)"""
+        assert backend in ['array', 'numpy', 'pyarrow']
+        names = [ col['name'] for col in self.cols ]
+
+        if backend == 'pyarrow':
+            try:
+                import pyarrow as pa
+            except ImportError:
+                raise ImportError('The "pyarrow" backend needs pyarrow (pip install pyarrow)')
+            return pa.Table.from_arrays([ column.to_pyarrow(pa) for column in self._columns ], names=names)
+
+        if backend == 'numpy':
+            try:
+                import numpy as np
+            except ImportError:
+                raise ImportError('The "numpy" backend needs numpy (pip install numpy)')
+            data = [ column.to_numpy(np) for column in self._columns ]
+        else:
+            data = [ column.to_array() for column in self._columns ]
+
+        return {'columns': names, 'base_types': [ col.get('base_type') for col in self.cols ], 'data': data}
+
+
+
+# the typecode of the buffer of each kind of column, and the value stored for the null cells
+_TYPECODES = {'integer': 'q', 'float': 'd', 'boolean': 'b'}
+_NULL_VALUES = {'integer': 0, 'float': float('nan'), 'boolean': 0}
+
+
+class _Column():
+    """
+    The buffer of a column: a typed array for the integer, float and boolean columns, with a bytearray marking
+    the null cells (made when the first null is added), or a list for the other columns and for the typed columns
+    holding a cell that does not fit the array (e.g. numbers returned as strings, or integers that do not fit in 64 bits)
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.values = array(_TYPECODES[kind]) if kind in _TYPECODES else []
+        self.nulls = None
+
+
+    def extend(self, cells):
+        if type(self.values) == list:
+            self.values.extend(cells)
+            return
+        size = len(self.values)
+        values = cells
+        if None in cells:
+            null_value = _NULL_VALUES[self.kind]
+            values = [ null_value if cell is None else cell for cell in cells ]
+        try:
+            self.values.extend(values)
+        except (TypeError, OverflowError):
+            del self.values[size:]  # the cells before the invalid one were added
+            self.values = self.get_cells()
+            self.nulls = None
+            self.values.extend(cells)
+            return
+        if self.nulls is not None or values is not cells:
+            if self.nulls is None:
+                self.nulls = bytearray(size)
+            self.nulls.extend([ cell is None for cell in cells ])
+
+
+    def get_cells(self):
+        if type(self.values) == list:
+            return list(self.values)
+        if self.nulls is None:
+            return self.values.tolist()
+        return [ None if null else value for value, null in zip(self.values.tolist(), self.nulls) ]
+
+
+    def to_array(self):
+        if type(self.values) == list or self.nulls is None or self.kind == 'float':
+            return self.values
+        if self.kind == 'integer':
+            return array('d', [ float('nan') if null else value for value, null in zip(self.values, self.nulls) ])
+        return self.get_cells()  # a boolean column with nulls
+
+
+    def to_numpy(self, np):
+        if type(self.values) == list or (self.kind == 'boolean' and self.nulls is not None):
+            result = np.empty(len(self.values), dtype=object)
+            result[:] = self.get_cells()
+            return result
+        if self.kind == 'boolean':
+            return np.frombuffer(self.values, dtype=np.int8).astype(np.bool_)
+        if self.kind == 'float':
+            return np.frombuffer(self.values, dtype=np.float64)
+        if self.nulls is None:
+            return np.frombuffer(self.values, dtype=np.int64)
+        result = np.frombuffer(self.values, dtype=np.int64).astype(np.float64)
+        result[np.frombuffer(self.nulls, dtype=np.bool_)] = np.nan
+        return result
+
+
+    def to_pyarrow(self, pa):
+        if type(self.values) == list:
+            return _to_pyarrow(pa, self.values, self.kind)
+        types = {'integer': pa.int64(), 'float': pa.float64(), 'boolean': pa.int8()}
+        result = pa.Array.from_buffers(types[self.kind], len(self.values), [None, pa.py_buffer(self.values)])
+        if self.nulls is not None:
+            import pyarrow.compute as pc
+            nulls = pa.Array.from_buffers(pa.uint8(), len(self.nulls), [None, pa.py_buffer(self.nulls)]).cast(pa.bool_())
+            result = pc.if_else(nulls, pa.scalar(None, type=result.type), result)
+        return result.cast(pa.bool_()) if self.kind == 'boolean' else result
+
+
+
+def get_export_cols(result_metadata, keys):
+    """
+    The column descriptions (for to_columnar) of the rows of a json export (e.g. POST /api/card/:id/query/json), whose
+    rows are objects without the types of the columns. keys are the keys of the first row, in order (so the columns with
+    the same display name are kept apart). The columns are matched by position with the result_metadata of the card if
+    it has as many columns, otherwise they are untyped and named after the keys (e.g. if the card was never run).
+    """
+    result_metadata = result_metadata or []
+    if keys is None or len(result_metadata) == len(keys):
+        return result_metadata
+    return [ {'name': key} for key in keys ]
+
+
+
+def _to_pyarrow(pa, values, kind):
+    types = {'integer': pa.int64(), 'float': pa.float64(), 'boolean': pa.bool_()}
+    try:
+        return pa.array(values, type=types.get(kind))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return pa.array([ None if i is None else str(i) for i in values ], type=pa.string())
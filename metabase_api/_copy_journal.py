@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+
+
+class CopyJournal():
+    """
+    Append-only JSON lines file recording the items created by a copy (see copy_collection), one line per item:
+    {"model", "source_id", "destination_id", "name"}. Each line is flushed to disk as soon as the item is created,
+    so when a copy is interrupted, running it again with the same journal skips the items that were already
+    copied (reusing the collections that were already created) and continues with the rest.
+    A journal belongs to a single copy (a source collection and a destination).
+
+    Parameters
+    ----------
+    path : path of the journal file (created if it does not exist)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}  # (model, source_id) -> entry
+        self._lock = threading.Lock()
+        content = ''
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                content = f.read()
+        for line in content.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:  # a line cut short by an interruption
+                continue
+            self._entries[(entry['model'], entry['source_id'])] = entry
+        self._file = open(path, 'a', encoding='utf-8')
+        if content and not content.endswith('\n'):
+            self._file.write('\n')
+
+
+    def get(self, model, source_id):
+        """Return the entry of the item if it was already copied, otherwise None"""
+        return self._entries.get((model, source_id))
+
+
+    def record(self, entry):
+        """Add the entry of a copied item to the journal (and make sure it is on disk)"""
+        with self._lock:
+            self._entries[(entry['model'], entry['source_id'])] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+    def entries(self):
+        """Return the entries of all the items in the journal"""
+        return list(self._entries.values())
+
+
+    def close(self):
+        self._file.close()
+
+
+
+class SyncMapping(CopyJournal):
+    """
+    The source -> destination mapping of a sync (see sync_collection): a CopyJournal whose entries also have the hash
+    of what was last written to the destination item, {"model", "source_id", "destination_id", "name", "hash"}.
+    The entries of dashboards also have the ids of the copies of their tabs and dashcards, {"tabs": {source id: id},
+    "dashcards": {source id: id}}, so they are updated in place by the next syncs.
+    A later line for the same item replaces the earlier one and a line with a null destination_id removes the item,
+    so the mapping is kept on disk as the sync goes. The file is compacted (one line per item) when it is opened.
+
+    Parameters
+    ----------
+    path : path of the mapping file (created if it does not exist)
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self._file.close()
+        self._entries = { key: entry for key, entry in self._entries.items() if entry['destination_id'] is not None }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, path)
+        self._file = open(path, 'a', encoding='utf-8')
+
+
+    def remove(self, model, source_id):
+        """Remove the item from the mapping (and make sure it is on disk)"""
+        with self._lock:
+            self._entries.pop((model, source_id), None)
+            self._file.write(json.dumps({ 'model': model, 'source_id': source_id, 'destination_id': None }) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
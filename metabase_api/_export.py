@@ -0,0 +1,130 @@
+import json
+import os
+
+from ._streaming import JSONArrayDecoder, CSVDecoder
+
+# the export format requested from Metabase for each file format
+EXPORT_FORMATS = {'csv': 'csv', 'json': 'json', 'xlsx': 'xlsx', 'jsonl': 'json', 'parquet': 'json'}
+
+
+class CardExporter():
+    """
+    Write the body of POST /api/card/:id/query/:export-format to a file as it is received, chunk by chunk.
+    csv, json and xlsx bodies are written as they are. For jsonl and parquet the rows of the json body are
+    decoded incrementally and transcoded on the fly. The file is written under a temporary name
+    and renamed when complete, so an interrupted export does not leave a partial file behind.
+
+    Parameters
+    ----------
+    path : path of the file to write
+    file_format : one of csv, json, xlsx, jsonl or parquet
+    batch_size : number of rows per row group (parquet only). The types of the columns are inferred from the first batch.
+    """
+    def __init__(self, path, file_format, batch_size=10000):
+        assert file_format in EXPORT_FORMATS
+        self.path = path
+        self.file_format = file_format
+        self.rows = 0
+        self._tmp_path = path + '.part'
+        self._decoder = { 'csv': CSVDecoder, 'json': JSONArrayDecoder, 'jsonl': JSONArrayDecoder,
+                          'parquet': JSONArrayDecoder }.get(file_format, lambda: None)()
+        if file_format == 'parquet':
+            self._file = _ParquetWriter(self._tmp_path, batch_size)
+        else:
+            self._file = open(self._tmp_path, 'wb')
+
+
+    def feed(self, chunk):
+        rows = self._decoder.feed(chunk) if self._decoder else []
+        self._write(chunk, rows)
+
+
+    def close(self):
+        """Finish the file and return a report: {'path', 'format', 'bytes', 'rows'} (rows is None for xlsx)"""
+        if self._decoder:
+            self._write(b'', self._decoder.close())
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        if self.file_format == 'csv':
+            self.rows -= 1  # the header
+        return { 'path': self.path, 'format': self.file_format, 'bytes': os.path.getsize(self.path),
+                 'rows': self.rows if self._decoder else None }
+
+
+    def abort(self):
+        """Close and remove the incomplete file"""
+        getattr(self._file, 'abort', self._file.close)()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+    def _write(self, chunk, rows):
+        self.rows += len(rows)
+        if self.file_format == 'jsonl':
+            self._file.write(''.join( json.dumps(row, ensure_ascii=False) + '\n' for row in rows ).encode('utf-8'))
+        elif self.file_format == 'parquet':
+            self._file.write(rows)
+        else:
+            self._file.write(chunk)
+
+
+
+class _ParquetWriter():
+    """Write rows (dictionaries) to a parquet file in row groups of batch_size rows (needs pyarrow)"""
+    def __init__(self, path, batch_size):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Exporting to parquet needs pyarrow (pip install pyarrow)')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self.batch_size = batch_size
+        self._batch = []
+        self._writer = None
+
+
+    def write(self, rows):
+        self._batch.extend(rows)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+
+    def close(self):
+        if self._batch or self._writer is None:
+            self._flush()
+        self._writer.close()
+
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+    def _flush(self):
+        pa = self._pa
+        rows, self._batch = self._batch, []
+        if self._writer is None:
+            names = list(rows[0].keys()) if rows else []
+            fields = []
+            for name in names:
+                try:
+                    data_type = pa.array([ row.get(name) for row in rows ]).type
+                except (pa.ArrowInvalid, pa.ArrowTypeError):  # mixed types
+                    data_type = pa.string()
+                fields.append(pa.field(name, pa.string() if data_type == pa.null() or pa.types.is_nested(data_type) else data_type))
+            self._schema = pa.schema(fields)
+            self._writer = self._pq.ParquetWriter(self.path, self._schema)
+
+        arrays = []
+        for field in self._schema:
+            values = [ row.get(field.name) for row in rows ]
+            if field.type == pa.string():
+                values = [ i if i is None or isinstance(i, str) else json.dumps(i) for i in values ]
+            try:
+                arrays.append(pa.array(values, type=field.type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                raise ValueError('The values of the column "{}" do not match the type ({}) inferred from the first rows. '
+                                 'Use a larger batch_size.'.format(field.name, field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
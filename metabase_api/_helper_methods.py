@@ -1,3 +1,9 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from ._item_index import ItemIndex
+from ._collection_tree import CollectionTree
 
 def get_item_info(self, item_type
                 , item_id=None, item_name=None
@@ -47,21 +53,19 @@ def get_item_id(self, item_type, item_name, collection_id=None, collection_name=
     assert item_type in ['database', 'table', 'card', 'collection', 'dashboard', 'pulse', 'segment']
 
     if item_type in ['card', 'dashboard', 'pulse']:
+        items = self._get_item_index(item_type).get(item_name, [])
         if not collection_id:
             if not collection_name:
                 # Collection name/id is not provided. Searching in all collections 
-                item_IDs = [ i['id'] for i in self.get("/api/{}/".format(item_type)) if i['name'] == item_name 
-                                                                                    and i['archived'] == False ]
+                item_IDs = [ i['id'] for i in items if i['archived'] == False ]
             else:
                 collection_id = self.get_item_id('collection', collection_name) if collection_name != 'root' else None
-                item_IDs = [ i['id'] for i in self.get("/api/{}/".format(item_type)) if i['name'] == item_name 
-                                                                                    and i['collection_id'] == collection_id 
-                                                                                    and i['archived'] == False ]
+                item_IDs = [ i['id'] for i in items if i['collection_id'] == collection_id 
+                                                    and i['archived'] == False ]
         else:
             collection_name = self.get_item_name('collection', collection_id)
-            item_IDs = [ i['id'] for i in self.get("/api/{}/".format(item_type)) if i['name'] == item_name 
-                                                                                and i['collection_id'] == collection_id 
-                                                                                and i['archived'] == False ]
+            item_IDs = [ i['id'] for i in items if i['collection_id'] == collection_id 
+                                                and i['archived'] == False ]
 
         if len(item_IDs) > 1:
             if not collection_name:
@@ -79,7 +83,10 @@ def get_item_id(self, item_type, item_name, collection_id=None, collection_name=
 
 
     if item_type == 'collection':
-        collection_IDs = [ i['id'] for i in self.get("/api/collection/") if i['name'] == item_name ]
+        collection_IDs = [ i['id'] for i in self._get_item_index('collection').get(item_name, []) ]
+        if len(collection_IDs) == 0 and '/' in item_name:
+            # e.g. 'Finance/Reports/Monthly'
+            collection_IDs = self.get_collection_tree().get_ids(item_name)
 
         if len(collection_IDs) > 1:
             raise ValueError('There is more than one collection with the name "{}"'.format(item_name))
@@ -90,10 +97,7 @@ def get_item_id(self, item_type, item_name, collection_id=None, collection_name=
 
 
     if item_type == 'database':
-        res = self.get("/api/database/")
-        if type(res) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
-            res = res['data']
-        db_IDs = [ i['id'] for i in res if i['name'] == item_name ]
+        db_IDs = [ i['id'] for i in self._get_item_index('database').get(item_name, []) ]
 
         if len(db_IDs) > 1:
             raise ValueError('There is more than one DB with the name "{}"'.format(item_name))
@@ -104,14 +108,14 @@ def get_item_id(self, item_type, item_name, collection_id=None, collection_name=
 
 
     if item_type == 'table':
-        tables = self.get("/api/table/")
+        tables = self._get_item_index('table').get(item_name, [])
 
         if db_id:
-            table_IDs = [ i['id'] for i in tables if i['name'] == item_name and i['db']['id'] == db_id ]
+            table_IDs = [ i['id'] for i in tables if i['db_id'] == db_id ]
         elif db_name:
-            table_IDs = [ i['id'] for i in tables if i['name'] == item_name and i['db']['name'] == db_name ]
+            table_IDs = [ i['id'] for i in tables if i['db_name'] == db_name ]
         else:
-            table_IDs = [ i['id'] for i in tables if i['name'] == item_name ]
+            table_IDs = [ i['id'] for i in tables ]
 
         if len(table_IDs) > 1:
             raise ValueError('There is more than one table with the name {}. Provide db id/name.'.format(item_name))
@@ -122,8 +126,8 @@ def get_item_id(self, item_type, item_name, collection_id=None, collection_name=
 
 
     if item_type == 'segment':
-        segment_IDs = [ i['id'] for i in self.get("/api/segment/") if i['name'] == item_name 
-                                                                    and (not table_id or i['table_id'] == table_id) ]
+        segment_IDs = [ i['id'] for i in self._get_item_index('segment').get(item_name, []) 
+                                                                    if not table_id or i['table_id'] == table_id ]
         if len(segment_IDs) > 1:
             raise ValueError('There is more than one segment with the name "{}"'.format(item_name))
         if len(segment_IDs) == 0:
@@ -133,6 +137,210 @@ def get_item_id(self, item_type, item_name, collection_id=None, collection_name=
 
 
 
+def resolve_item_ids(self, items):
+    '''
+    Resolve the ids of many items in one pass. Each needed listing (e.g. GET /api/card/) is fetched at most once.
+
+    Parameters
+    ----------
+    items : list of (item_type, item_name) or (item_type, item_name, scope) tuples. The scope limits the search space:
+            - card, dashboard, pulse: id or name of the collection ('root' for the root collection)
+            - table: id or name of the DB
+            - segment: id of the table
+            - collection, database: no scope
+
+    Returns a dictionary with these keys:
+        'ids' : {item: id} for the items that were resolved
+        'not_found' : list of the items with no match
+        'ambiguous' : {item: [ids]} for the items with more than one match
+        'invalid_scope' : {item: [collection ids]} for the items whose scope is the name of no collection (empty list)
+                          or of more than one collection; these items are not searched
+    '''
+    items = [ tuple(item) for item in items ]
+    for item in items:
+        assert item[0] in ['database', 'table', 'card', 'collection', 'dashboard', 'pulse', 'segment']
+
+    item_types = { item[0] for item in items }
+    if any(item[0] in ['card', 'dashboard', 'pulse'] and len(item) > 2 and isinstance(item[2], str) and item[2] != 'root' 
+            for item in items):
+        item_types.add('collection')  # for resolving the collection names used as scope
+
+    indexes = { item_type: self._get_item_index(item_type) for item_type in item_types }
+    return ItemIndex.resolve(indexes, items)
+
+
+
+def get_collection_tree(self):
+    '''
+    Return the tree of the collections (see CollectionTree), built from a single GET /api/collection/.
+    The tree is rebuilt only when the collection index is fetched again (see the 'cache_ttl' argument of the class).
+    '''
+    index = self._get_item_index('collection')
+    if self._collection_tree is None or self._collection_tree[0] is not index:
+        tree = CollectionTree([ record for records in index.values() for record in records ])
+        self._collection_tree = (index, tree)
+    return self._collection_tree[1]
+
+
+
+def get_collection_id_by_path(self, path):
+    '''
+    Return the id of the collection with the given path, i.e. the names of the collections 
+    from the top level down, separated by '/' (e.g. 'Finance/Reports/Monthly').
+    '''
+    collection_IDs = self.get_collection_tree().get_ids(path)
+
+    if len(collection_IDs) > 1:
+        raise ValueError('There is more than one collection with the path "{}"'.format(path))
+    if len(collection_IDs) == 0:
+        raise ValueError('There is no collection with the path "{}"'.format(path))
+
+    return collection_IDs[0]
+
+
+
+def _get_collection_contents(self, collection_id, concurrency=4):
+    '''
+    Return {collection_id: [items]} for the given collection and all its sub-collections, where the items are 
+    {'model', 'id', 'name'} dictionaries of the sub-collections, dashboards, cards (questions only) and pulses (as 
+    GET /api/collection/:id/items). The sub-collections are taken from the collection tree. The other items are taken 
+    from the dashboard/card/pulse listings if they are cached (see the 'cache_ttl' argument of the class), otherwise 
+    GET /api/collection/:id/items is called for each collection, using up to `concurrency` threads (the listings hold 
+    all the items of Metabase, so they are not fetched for a single subtree).
+    '''
+    tree = self.get_collection_tree()
+    contents = { i: [ {'model': 'collection', 'id': child_id, 'name': tree.get_name(child_id)} for child_id in tree.get_children(i) ] 
+                    for i in tree.iter_subtree(collection_id) }
+
+    indexes = { model: self._item_index.get(model) for model in ['dashboard', 'card', 'pulse'] }
+    if None not in indexes.values():
+        _add_indexed_items(contents, indexes)
+        return contents
+
+    def get_items(collection_id):
+        items = self.get('/api/collection/{}/items'.format(collection_id))
+        if items is False:
+            raise ValueError('Could not get the items of the collection with the id "{}"'.format(collection_id))
+        return collection_id, items
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        for collection_id, items in executor.map(get_items, list(contents)):
+            contents[collection_id].extend(_get_collection_items(items))
+    return contents
+
+
+
+def _add_indexed_items(contents, indexes):
+    '''Add the dashboards, cards and pulses of the given {model: index} indexes to the contents of their collections'''
+    for model, index in indexes.items():
+        for records in index.values():
+            for i in records:
+                # (the dashboard subscriptions are in the pulse listing too, but they are not items of a collection)
+                if (i['collection_id'] in contents and i['archived'] == False and i['dashboard_id'] is None 
+                        and i['type'] in [None, 'question']):
+                    contents[i['collection_id']].append({'model': model, 'id': i['id'], 'name': i['name']})
+
+
+
+def _get_collection_items(items):
+    '''The dashboards, cards (questions only) and pulses of a response of GET /api/collection/:id/items'''
+    if type(items) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
+        items = items['data']
+    # (the models are 'dataset' items and the metrics 'metric' items)
+    return [ {'model': i['model'], 'id': i['id'], 'name': i['name']} for i in items if i['model'] in ['dashboard', 'card', 'pulse'] ]
+
+
+
+def _get_item_index(self, item_type):
+    '''
+    Return the name -> items index of the given item type (see ItemIndex), built from a single list fetch.
+    The index is reused until it expires (see the 'cache_ttl' argument of the class) or is invalidated.
+    If a metadata store is set, it is consulted before calling the API.
+    '''
+    index = self._item_index.get(item_type)
+    if index is None and self.metadata_store:
+        records = self.metadata_store.get_records(item_type)
+        if records is not None:
+            index = self._item_index.set_records(item_type, records)
+    if index is None:
+        res = self._get_item_list(item_type)
+        if self.metadata_store:
+            self.metadata_store.update_items(item_type, res)
+        index = self._item_index.set(item_type, res)
+    return index
+
+
+
+def _get_item_list(self, item_type):
+    res = self.get("/api/{}/".format(item_type))
+    if res is False:
+        raise ValueError('Could not get the list of {}s'.format(item_type))
+    if type(res) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
+        res = res['data']
+    return res
+
+
+
+def refresh_metadata_store(self, item_types=None, fields=True):
+    '''
+    Update the metadata store (see the 'metadata_store' argument of the class) incrementally: the listings are fetched 
+    again but only the objects whose 'updated_at' changed are rewritten, and the fields are pulled again only for 
+    the tables that changed. Return the number of changed objects per item type (and the number of tables whose 
+    fields were pulled, under the 'fields' key).
+
+    Parameters
+    ----------
+    item_types : the item types to refresh (default: database, table, collection, card and dashboard)
+    fields : whether to pull the fields of the new/changed tables (default True)
+    '''
+    if not self.metadata_store:
+        raise ValueError('No metadata store is set. Use the "metadata_store" argument when creating the client.')
+
+    summary = {}
+    for item_type in item_types or ['database', 'table', 'collection', 'card', 'dashboard']:
+        summary[item_type] = self.metadata_store.update_items(item_type, self._get_item_list(item_type))
+        self._item_index.invalidate(item_type)
+
+    if fields:
+        outdated_tables = self.metadata_store.get_outdated_tables()
+        tables_by_db = {}
+        for table in self.metadata_store.get_records('table') or []:
+            if table['id'] in outdated_tables:
+                tables_by_db.setdefault(table['db_id'], []).append(table['id'])
+        for db_id, table_IDs in tables_by_db.items():
+            if len(table_IDs) > 10:
+                # one call for the whole DB is cheaper than one call per table
+                tables = self.get("/api/database/{}/metadata".format(db_id))['tables']
+            else:
+                tables = [ self.get("/api/table/{}/query_metadata".format(table_id)) for table_id in table_IDs ]
+            for table in tables:
+                if table and table['id'] in table_IDs:
+                    fields_list = [ {key: i.get(key) for key in ['id', 'name', 'position', 'database_position']} for i in table['fields'] ]
+                    self.metadata_store.set_table_fields(table['id'], fields_list, self.metadata_store.get_table_version(table['id']))
+        summary['fields'] = sum(len(table_IDs) for table_IDs in tables_by_db.values())
+        self._table_fields_cache.invalidate()
+        self._db_fields_cache.invalidate()
+
+    return summary
+
+
+
+def invalidate_cache(self, item_type=None):
+    '''
+    Drop the cached data of the given item type (or all the cached data if item_type is None), so it is fetched again on next use.
+    The functions of this package that create, copy, archive or delete items call this automatically.
+    '''
+    self._item_index.invalidate(item_type)
+    if self.metadata_store:
+        self.metadata_store.mark_stale(item_type)
+    if item_type in [None, 'table', 'database']:
+        self._table_fields_cache.invalidate()
+        self._db_fields_cache.invalidate()
+    if item_type is None:
+        self._settings_cache.invalidate()
+
+
+
 def get_collection_id(self, collection_name):
     import warnings
     warnings.warn("The function get_collection_id will be removed in the next version. Use get_item_id function instead.", DeprecationWarning)
@@ -204,12 +412,12 @@ def get_segment_id(self, segment_name, table_id=None):
 
 
 def get_db_id_from_table_id(self, table_id):
-    tables = [ i['db_id'] for i in self.get("/api/table/") if i['id'] == table_id ]
+    res = self.get("/api/table/{}".format(table_id))
 
-    if len(tables) == 0:
+    if not res:
         raise ValueError('There is no DB containing the table with the ID "{}"'.format(table_id))
 
-    return tables[0]
+    return res['db_id']
 
 
 
@@ -252,38 +460,70 @@ def get_columns_name_id(self, table_name=None, db_name=None, table_id=None, db_i
     Return a dictionary with col_name key and col_id value, for the given table_id/table_name in the given db_id/db_name.
     If column_id_name is True, return a dictionary with col_id key and col_name value.
     '''
-    if not self.friendly_names_is_disabled():
-        raise ValueError('Please disable "Friendly Table and Field Names" from Admin Panel > Settings > General, and try again.')
+    if not table_id and not table_name:
+        raise ValueError('Either the name or id of the table must be provided.')
 
-    if not table_name:
+    if table_id or not (db_id or db_name):
+        # Get the fields of the table only
         if not table_id:
-            raise ValueError('Either the name or id of the table must be provided.')
-        table_name = self.get_item_name(item_type='table', item_id=table_id)
-
-    # Get db_id
-    if not db_id:
-        if db_name:
+            table_id = self.get_item_id('table', table_name)
+        name_id_mapping = { i['name']: i['id'] for i in self._get_table_fields(table_id) }
+    else:
+        # Get the fields of the whole DB (grouped by table name)
+        if not self.friendly_names_is_disabled():
+            raise ValueError('Please disable "Friendly Table and Field Names" from Admin Panel > Settings > General, and try again.')
+        if not db_id:
             db_id = self.get_item_id('database', db_name)
-        else:
-            if not table_id:
-                table_id = self.get_item_id('table', table_name)
-            db_id = self.get_db_id_from_table_id(table_id)
+        name_id_mapping = self._get_db_fields(db_id).get(table_name, {})
 
-    # Get column names and IDs 
     if column_id_name:
-        return {i['id']: i['name'] for i in self.get("/api/database/{}/fields".format(db_id)) 
-                                                                if i['table_name'] == table_name}
+        return { col_id: col_name for col_name, col_id in name_id_mapping.items() }
     else:
-        return {i['name']: i['id'] for i in self.get("/api/database/{}/fields".format(db_id)) 
-                                                                if i['table_name'] == table_name}
+        return dict(name_id_mapping)
+
+
+
+def _get_table_fields(self, table_id):
+    '''
+    Return the fields (id, name, position, database_position) of the given table using GET /api/table/:id/query_metadata.
+    The result is cached per table (see the 'cache_ttl' argument of the class). If a metadata store is set, it is consulted first.
+    '''
+    fields = self._table_fields_cache.get(table_id)
+    if fields is None and self.metadata_store:
+        fields = self.metadata_store.get_table_fields(table_id)
+    if fields is None:
+        res = self.get("/api/table/{}/query_metadata".format(table_id))
+        if not res:
+            raise ValueError('There is no table with the id "{}"'.format(table_id))
+        fields = [ {key: i.get(key) for key in ['id', 'name', 'position', 'database_position']} for i in res['fields'] ]
+        if self.metadata_store:
+            self.metadata_store.set_table_fields(table_id, fields, res.get('updated_at'))
+    return self._table_fields_cache.set(table_id, fields)
+
 
 
+def _get_db_fields(self, db_id):
+    '''
+    Return a {table_name: {col_name: col_id}} dictionary for all the fields of the given DB using GET /api/database/:id/fields.
+    The result is cached per DB (see the 'cache_ttl' argument of the class). If a metadata store is set, it is consulted first.
+    '''
+    db_fields = self._db_fields_cache.get(db_id)
+    if db_fields is None and self.metadata_store:
+        db_fields = self.metadata_store.get_db_fields(db_id)
+    if db_fields is None:
+        db_fields = {}
+        for i in self.get("/api/database/{}/fields".format(db_id)):
+            db_fields.setdefault(i['table_name'], {})[i['name']] = i['id']
+    return self._db_fields_cache.set(db_id, db_fields)
+
 
-def friendly_names_is_disabled(self):
+
+def friendly_names_is_disabled(self, refresh=False):
     '''
     The endpoint /api/database/:db-id/fields which is used in the function get_columns_name_id relies on the display name of fields. 
     If "Friendly Table and Field Names" (in Admin Panel > Settings > General) is not disabled, it changes the display name of fields.
     So it is important to make sure this setting is disabled, before running the get_columns_name_id function.
+    The setting is checked on first use and cached (see the 'settings_ttl' argument of the class). Use refresh=True to check it again.
     '''
     # checking whether friendly_name is disabled required admin access. 
     # So to let non-admin users also use this package we skip this step for them.
@@ -291,11 +531,33 @@ def friendly_names_is_disabled(self):
     if not self.is_admin:  
         return True
 
-    friendly_name_setting = [ i['value'] for i in self.get('/api/setting') if i['key'] == 'humanization-strategy' ][0]
+    friendly_name_setting = None if refresh else self._settings_cache.get('humanization-strategy')
+    if friendly_name_setting is None:
+        res = self.get('/api/setting/humanization-strategy', 'raw')
+        friendly_name_setting = _parse_setting_value(res.status_code, res.text)
+        if friendly_name_setting is None:  # fall back to the list of all settings
+            friendly_name_setting = [ i['value'] for i in self.get('/api/setting') if i['key'] == 'humanization-strategy' ][0]
+        self._settings_cache.set('humanization-strategy', friendly_name_setting)
     return friendly_name_setting == 'none'  # 'none' means disabled
 
 
 
+def _parse_setting_value(status_code, text):
+    '''
+    Return the value of a setting from the response of /api/setting/:key, or None if it cannot be parsed.
+    Depending on the version of Metabase the value is returned as a JSON string ("none") or as a bare value (none).
+    '''
+    if status_code != 200:
+        return None
+    text = text.strip()
+    try:
+        value = json.loads(text)
+    except ValueError:
+        value = text.strip('"') if re.match(r'^"?[\w-]+"?$', text) else None
+    return value if isinstance(value, str) else None
+
+
+
 @staticmethod
 def verbose_print(verbose, msg):
     if verbose:
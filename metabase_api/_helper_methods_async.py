@@ -1,3 +1,7 @@
+import asyncio
+from ._item_index import ItemIndex
+from ._collection_tree import CollectionTree
+from ._helper_methods import _add_indexed_items, _get_collection_items, _parse_setting_value
 
 async def get_item_info(self, item_type, item_id=None, item_name=None,
                             collection_id=None, collection_name=None,
@@ -42,22 +46,18 @@ async def get_item_id(self, item_type, item_name, collection_id=None, collection
     assert item_type in ['database', 'table', 'card', 'collection', 'dashboard', 'pulse', 'segment']
 
     if item_type in ['card', 'dashboard', 'pulse']:
+        items = (await self._get_item_index(item_type)).get(item_name, [])
         if not collection_id:
             if not collection_name:
                 # Collection name/id is not provided. Searching in all collections 
-                items = await self.get(f"/api/{item_type}/")
-                item_IDs = [i['id'] for i in items if i['name'] == item_name and i['archived'] == False]
+                item_IDs = [i['id'] for i in items if i['archived'] == False]
             else:
                 collection_id = await self.get_item_id('collection', collection_name) if collection_name != 'root' else None
-                items = await self.get(f"/api/{item_type}/")
-                item_IDs = [i['id'] for i in items if i['name'] == item_name 
-                            and i['collection_id'] == collection_id 
+                item_IDs = [i['id'] for i in items if i['collection_id'] == collection_id 
                             and i['archived'] == False]
         else:
             collection_name = await self.get_item_name('collection', collection_id)
-            items = await self.get(f"/api/{item_type}/")
-            item_IDs = [i['id'] for i in items if i['name'] == item_name 
-                        and i['collection_id'] == collection_id 
+            item_IDs = [i['id'] for i in items if i['collection_id'] == collection_id 
                         and i['archived'] == False]
 
         if len(item_IDs) > 1:
@@ -73,8 +73,11 @@ async def get_item_id(self, item_type, item_name, collection_id=None, collection
         return item_IDs[0]
 
     if item_type == 'collection':
-        collections = await self.get("/api/collection/")
-        collection_IDs = [i['id'] for i in collections if i['name'] == item_name]
+        collections = (await self._get_item_index('collection')).get(item_name, [])
+        collection_IDs = [i['id'] for i in collections]
+        if len(collection_IDs) == 0 and '/' in item_name:
+            # e.g. 'Finance/Reports/Monthly'
+            collection_IDs = (await self.get_collection_tree()).get_ids(item_name)
 
         if len(collection_IDs) > 1:
             raise ValueError(f'There is more than one collection with the name "{item_name}"')
@@ -84,10 +87,8 @@ async def get_item_id(self, item_type, item_name, collection_id=None, collection
         return collection_IDs[0]
 
     if item_type == 'database':
-        res = await self.get("/api/database/")
-        if type(res) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
-            res = res['data']
-        db_IDs = [i['id'] for i in res if i['name'] == item_name]
+        dbs = (await self._get_item_index('database')).get(item_name, [])
+        db_IDs = [i['id'] for i in dbs]
 
         if len(db_IDs) > 1:
             raise ValueError(f'There is more than one DB with the name "{item_name}"')
@@ -97,14 +98,14 @@ async def get_item_id(self, item_type, item_name, collection_id=None, collection
         return db_IDs[0]
 
     if item_type == 'table':
-        tables = await self.get("/api/table/")
+        tables = (await self._get_item_index('table')).get(item_name, [])
 
         if db_id:
-            table_IDs = [i['id'] for i in tables if i['name'] == item_name and i['db']['id'] == db_id]
+            table_IDs = [i['id'] for i in tables if i['db_id'] == db_id]
         elif db_name:
-            table_IDs = [i['id'] for i in tables if i['name'] == item_name and i['db']['name'] == db_name]
+            table_IDs = [i['id'] for i in tables if i['db_name'] == db_name]
         else:
-            table_IDs = [i['id'] for i in tables if i['name'] == item_name]
+            table_IDs = [i['id'] for i in tables]
 
         if len(table_IDs) > 1:
             raise ValueError(f'There is more than one table with the name {item_name}. Provide db id/name.')
@@ -114,8 +115,8 @@ async def get_item_id(self, item_type, item_name, collection_id=None, collection
         return table_IDs[0]
 
     if item_type == 'segment':
-        segments = await self.get("/api/segment/")
-        segment_IDs = [i['id'] for i in segments if i['name'] == item_name and (not table_id or i['table_id'] == table_id)]
+        segments = (await self._get_item_index('segment')).get(item_name, [])
+        segment_IDs = [i['id'] for i in segments if not table_id or i['table_id'] == table_id]
         
         if len(segment_IDs) > 1:
             raise ValueError(f'There is more than one segment with the name "{item_name}"')
@@ -125,15 +126,166 @@ async def get_item_id(self, item_type, item_name, collection_id=None, collection
         return segment_IDs[0]
 
 
+async def resolve_item_ids(self, items):
+    """
+    Async version of resolve_item_ids.
+    Resolve the ids of many items in one pass. The needed listings are fetched concurrently, each at most once.
+    """
+    items = [tuple(item) for item in items]
+    for item in items:
+        assert item[0] in ['database', 'table', 'card', 'collection', 'dashboard', 'pulse', 'segment']
+
+    item_types = {item[0] for item in items}
+    if any(item[0] in ['card', 'dashboard', 'pulse'] and len(item) > 2 and isinstance(item[2], str) and item[2] != 'root'
+            for item in items):
+        item_types.add('collection')  # for resolving the collection names used as scope
+
+    item_types = list(item_types)
+    indexes = dict(zip(item_types, await asyncio.gather(*[self._get_item_index(item_type) for item_type in item_types])))
+    return ItemIndex.resolve(indexes, items)
+
+
+async def get_collection_tree(self):
+    """
+    Async version of get_collection_tree.
+    Return the tree of the collections (see CollectionTree), built from a single GET /api/collection/.
+    """
+    index = await self._get_item_index('collection')
+    if self._collection_tree is None or self._collection_tree[0] is not index:
+        tree = CollectionTree([record for records in index.values() for record in records])
+        self._collection_tree = (index, tree)
+    return self._collection_tree[1]
+
+
+async def get_collection_id_by_path(self, path):
+    """Async version of get_collection_id_by_path"""
+    collection_IDs = (await self.get_collection_tree()).get_ids(path)
+
+    if len(collection_IDs) > 1:
+        raise ValueError(f'There is more than one collection with the path "{path}"')
+    if len(collection_IDs) == 0:
+        raise ValueError(f'There is no collection with the path "{path}"')
+
+    return collection_IDs[0]
+
+
+async def _get_collection_contents(self, collection_id, concurrency=4):
+    """
+    Async version of _get_collection_contents.
+    The items of the collections are fetched concurrently (up to `concurrency` at the same time) unless the 
+    dashboard/card/pulse listings are cached.
+    """
+    tree = await self.get_collection_tree()
+    contents = {i: [{'model': 'collection', 'id': child_id, 'name': tree.get_name(child_id)} for child_id in tree.get_children(i)]
+                for i in tree.iter_subtree(collection_id)}
+
+    indexes = {model: self._item_index.get(model) for model in ['dashboard', 'card', 'pulse']}
+    if None not in indexes.values():
+        _add_indexed_items(contents, indexes)
+        return contents
+
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def get_items(collection_id):
+        async with semaphore:
+            items = await self.get(f'/api/collection/{collection_id}/items')
+        if items is False:
+            raise ValueError(f'Could not get the items of the collection with the id "{collection_id}"')
+        contents[collection_id].extend(_get_collection_items(items))
+
+    await asyncio.gather(*[get_items(i) for i in list(contents)])
+    return contents
+
+
+async def _get_item_index(self, item_type):
+    """
+    Async version of _get_item_index.
+    Return the name -> items index of the given item type (see ItemIndex), built from a single list fetch.
+    """
+    index = self._item_index.get(item_type)
+    if index is None and self.metadata_store:
+        records = self.metadata_store.get_records(item_type)
+        if records is not None:
+            index = self._item_index.set_records(item_type, records)
+    if index is None:
+        res = await self._get_item_list(item_type)
+        if self.metadata_store:
+            self.metadata_store.update_items(item_type, res)
+        index = self._item_index.set(item_type, res)
+    return index
+
+
+async def _get_item_list(self, item_type):
+    """Async version of _get_item_list"""
+    res = await self.get(f"/api/{item_type}/")
+    if res is False:
+        raise ValueError(f'Could not get the list of {item_type}s')
+    if type(res) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
+        res = res['data']
+    return res
+
+
+async def refresh_metadata_store(self, item_types=None, fields=True):
+    """
+    Async version of refresh_metadata_store.
+    The listings are fetched concurrently and so are the fields of the changed tables.
+    """
+    if not self.metadata_store:
+        raise ValueError('No metadata store is set. Use the "metadata_store" argument when creating the client.')
+
+    item_types = item_types or ['database', 'table', 'collection', 'card', 'dashboard']
+    listings = await asyncio.gather(*[self._get_item_list(item_type) for item_type in item_types])
+    summary = {}
+    for item_type, res in zip(item_types, listings):
+        summary[item_type] = self.metadata_store.update_items(item_type, res)
+        self._item_index.invalidate(item_type)
+
+    if fields:
+        outdated_tables = self.metadata_store.get_outdated_tables()
+        tables_by_db = {}
+        for table in self.metadata_store.get_records('table') or []:
+            if table['id'] in outdated_tables:
+                tables_by_db.setdefault(table['db_id'], []).append(table['id'])
+
+        async def get_tables(db_id, table_IDs):
+            if len(table_IDs) > 10:
+                # one call for the whole DB is cheaper than one call per table
+                return (await self.get(f"/api/database/{db_id}/metadata"))['tables']
+            return await asyncio.gather(*[self.get(f"/api/table/{table_id}/query_metadata") for table_id in table_IDs])
+
+        results = await asyncio.gather(*[get_tables(db_id, table_IDs) for db_id, table_IDs in tables_by_db.items()])
+        for table_IDs, tables in zip(tables_by_db.values(), results):
+            for table in tables:
+                if table and table['id'] in table_IDs:
+                    fields_list = [{key: i.get(key) for key in ['id', 'name', 'position', 'database_position']} for i in table['fields']]
+                    self.metadata_store.set_table_fields(table['id'], fields_list, self.metadata_store.get_table_version(table['id']))
+        summary['fields'] = sum(len(table_IDs) for table_IDs in tables_by_db.values())
+        self._table_fields_cache.invalidate()
+        self._db_fields_cache.invalidate()
+
+    return summary
+
+
+def invalidate_cache(self, item_type=None):
+    """Same as the synchronous version - no need for async here"""
+    self._item_index.invalidate(item_type)
+    if self.metadata_store:
+        self.metadata_store.mark_stale(item_type)
+    if item_type in [None, 'table', 'database']:
+        self._table_fields_cache.invalidate()
+        self._db_fields_cache.invalidate()
+    if item_type is None:
+        self._settings_cache.invalidate()
+
+
 async def get_db_id_from_table_id(self, table_id):
     """Async version of get_db_id_from_table_id"""
-    tables = await self.get("/api/table/")
-    tables_filtered = [i['db_id'] for i in tables if i['id'] == table_id]
+    res = await self.get(f"/api/table/{table_id}")
 
-    if len(tables_filtered) == 0:
+    if not res:
         raise ValueError(f'There is no DB containing the table with the ID "{table_id}"')
 
-    return tables_filtered[0]
+    return res['db_id']
 
 
 async def get_db_info(self, db_name=None, db_id=None, params=None):
@@ -172,37 +324,68 @@ async def get_columns_name_id(self, table_name=None, db_name=None, table_id=None
     Return a dictionary with col_name key and col_id value, for the given table_id/table_name in the given db_id/db_name.
     If column_id_name is True, return a dictionary with col_id key and col_name value.
     """
-    if not await self.friendly_names_is_disabled():
-        raise ValueError('Please disable "Friendly Table and Field Names" from Admin Panel > Settings > General, and try again.')
+    if not table_id and not table_name:
+        raise ValueError('Either the name or id of the table must be provided.')
 
-    if not table_name:
+    if table_id or not (db_id or db_name):
+        # Get the fields of the table only
         if not table_id:
-            raise ValueError('Either the name or id of the table must be provided.')
-        table_name = await self.get_item_name(item_type='table', item_id=table_id)
-
-    # Get db_id
-    if not db_id:
-        if db_name:
+            table_id = await self.get_item_id('table', table_name)
+        name_id_mapping = {i['name']: i['id'] for i in await self._get_table_fields(table_id)}
+    else:
+        # Get the fields of the whole DB (grouped by table name)
+        if not await self.friendly_names_is_disabled():
+            raise ValueError('Please disable "Friendly Table and Field Names" from Admin Panel > Settings > General, and try again.')
+        if not db_id:
             db_id = await self.get_item_id('database', db_name)
-        else:
-            if not table_id:
-                table_id = await self.get_item_id('table', table_name)
-            db_id = await self.get_db_id_from_table_id(table_id)
+        name_id_mapping = (await self._get_db_fields(db_id)).get(table_name, {})
 
-    # Get column names and IDs
-    fields = await self.get(f"/api/database/{db_id}/fields")
     if column_id_name:
-        return {i['id']: i['name'] for i in fields if i['table_name'] == table_name}
+        return {col_id: col_name for col_name, col_id in name_id_mapping.items()}
     else:
-        return {i['name']: i['id'] for i in fields if i['table_name'] == table_name}
+        return dict(name_id_mapping)
+
+
+async def _get_table_fields(self, table_id):
+    """
+    Async version of _get_table_fields.
+    Return the fields (id, name, position, database_position) of the given table using GET /api/table/:id/query_metadata.
+    """
+    fields = self._table_fields_cache.get(table_id)
+    if fields is None and self.metadata_store:
+        fields = self.metadata_store.get_table_fields(table_id)
+    if fields is None:
+        res = await self.get(f"/api/table/{table_id}/query_metadata")
+        if not res:
+            raise ValueError(f'There is no table with the id "{table_id}"')
+        fields = [{key: i.get(key) for key in ['id', 'name', 'position', 'database_position']} for i in res['fields']]
+        if self.metadata_store:
+            self.metadata_store.set_table_fields(table_id, fields, res.get('updated_at'))
+    return self._table_fields_cache.set(table_id, fields)
+
+
+async def _get_db_fields(self, db_id):
+    """
+    Async version of _get_db_fields.
+    Return a {table_name: {col_name: col_id}} dictionary for all the fields of the given DB using GET /api/database/:id/fields.
+    """
+    db_fields = self._db_fields_cache.get(db_id)
+    if db_fields is None and self.metadata_store:
+        db_fields = self.metadata_store.get_db_fields(db_id)
+    if db_fields is None:
+        db_fields = {}
+        for i in await self.get(f"/api/database/{db_id}/fields"):
+            db_fields.setdefault(i['table_name'], {})[i['name']] = i['id']
+    return self._db_fields_cache.set(db_id, db_fields)
 
 
-async def friendly_names_is_disabled(self):
+async def friendly_names_is_disabled(self, refresh=False):
     """
     Async version of friendly_names_is_disabled.
     The endpoint /api/database/:db-id/fields which is used in the function get_columns_name_id relies on the display name of fields.
     If "Friendly Table and Field Names" (in Admin Panel > Settings > General) is not disabled, it changes the display name of fields.
     So it is important to make sure this setting is disabled, before running the get_columns_name_id function.
+    The setting is checked on first use and cached (see the 'settings_ttl' argument of the class). Use refresh=True to check it again.
     """
     # checking whether friendly_name is disabled required admin access.
     # So to let non-admin users also use this package we skip this step for them.
@@ -210,8 +393,14 @@ async def friendly_names_is_disabled(self):
     if not self.is_admin:
         return True
 
-    settings = await self.get('/api/setting')
-    friendly_name_setting = [i['value'] for i in settings if i['key'] == 'humanization-strategy'][0]
+    friendly_name_setting = None if refresh else self._settings_cache.get('humanization-strategy')
+    if friendly_name_setting is None:
+        res = await self.get('/api/setting/humanization-strategy', 'raw')
+        friendly_name_setting = _parse_setting_value(res.status_code, res.text)
+        if friendly_name_setting is None:  # Fall back to the list of all settings
+            settings = await self.get('/api/setting')
+            friendly_name_setting = [i['value'] for i in settings if i['key'] == 'humanization-strategy'][0]
+        self._settings_cache.set('humanization-strategy', friendly_name_setting)
     return friendly_name_setting == 'none'  # 'none' means disabled
 
 
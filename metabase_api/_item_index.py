@@ -0,0 +1,88 @@
+from ._cache import TTLCache
+
+
+class ItemIndex(TTLCache):
+    """
+    In-memory name -> items index used by get_item_id. The index of each item type is built from a single
+    list fetch (e.g. GET /api/card/) and only keeps the fields needed for resolving names and walking
+    collections (id, collection_id, db_id, db_name, table_id, archived, location, dashboard_id, type).
+
+    Parameters
+    ----------
+    ttl : number of seconds an index is kept before it is fetched again.
+          If None (default) nothing is kept and every lookup uses a fresh listing.
+    """
+    def set(self, item_type, items):
+        """Build the index of the given item type from its listing, cache it (if ttl is set) and return it"""
+        return self.set_records(item_type, [ self.make_record(i) for i in items ])
+
+
+    def set_records(self, item_type, records):
+        """Same as set, but from records already made by make_record (e.g. loaded from a MetadataStore)"""
+        return super().set(item_type, self.index_records(records))
+
+
+    @staticmethod
+    def make_record(item):
+        db = item.get('db') or {}
+        return {
+            'id': item['id'],
+            'name': item['name'],
+            'collection_id': item.get('collection_id'),
+            'db_id': item.get('db_id', db.get('id')),
+            'db_name': db.get('name'),
+            'table_id': item.get('table_id'),
+            'archived': item.get('archived', False),
+            'location': item.get('location'),
+            'dashboard_id': item.get('dashboard_id'),
+            'type': item.get('type') or ('model' if item.get('dataset') else None),
+        }
+
+
+    @staticmethod
+    def index_records(records):
+        index = {}
+        for record in records:
+            index.setdefault(record['name'], []).append(record)
+        return index
+
+
+    @staticmethod
+    def resolve(indexes, items):
+        """
+        Resolve many (item_type, item_name[, scope]) tuples using the given {item_type: index} indexes.
+        See resolve_item_ids for the format of the tuples and of the returned dictionary.
+        """
+        result = {'ids': {}, 'not_found': [], 'ambiguous': {}, 'invalid_scope': {}}
+        for item in items:
+            item_type, item_name = item[0], item[1]
+            scope = item[2] if len(item) > 2 else None
+            candidates = indexes[item_type].get(item_name, [])
+
+            if item_type in ['card', 'dashboard', 'pulse']:
+                candidates = [ i for i in candidates if i['archived'] == False ]
+                if scope == 'root':
+                    candidates = [ i for i in candidates if i['collection_id'] is None ]
+                elif isinstance(scope, str):
+                    # the scope must name exactly one collection (the item is not searched in several collections)
+                    collection_IDs = [ i['id'] for i in indexes['collection'].get(scope, []) if i['archived'] == False ]
+                    if len(collection_IDs) != 1:
+                        result['invalid_scope'][item] = collection_IDs
+                        continue
+                    candidates = [ i for i in candidates if i['collection_id'] == collection_IDs[0] ]
+                elif scope is not None:
+                    candidates = [ i for i in candidates if i['collection_id'] == scope ]
+            elif item_type == 'table' and scope is not None:
+                key = 'db_name' if isinstance(scope, str) else 'db_id'
+                candidates = [ i for i in candidates if i[key] == scope ]
+            elif item_type == 'segment' and scope is not None:
+                candidates = [ i for i in candidates if i['table_id'] == scope ]
+
+            if len(candidates) == 1:
+                result['ids'][item] = candidates[0]['id']
+            elif len(candidates) == 0:
+                result['not_found'].append(item)
+            else:
+                result['ambiguous'][item] = [ i['id'] for i in candidates ]
+
+        return result
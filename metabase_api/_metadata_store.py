@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import threading
+import time
+
+from ._item_index import ItemIndex
+
+
+class MetadataStore():
+    """
+    Optional on-disk (SQLite) snapshot of Metabase metadata (databases, tables, fields, collections, cards, dashboards, ...).
+    When a client is given a store, the helper functions (e.g. get_item_id, get_columns_name_id) consult it before
+    calling the API, so a new process can resolve names without downloading the listings again.
+    The snapshot is updated incrementally: only the objects whose 'updated_at' changed are rewritten, and the fields
+    of a table are pulled again only if the table changed (see refresh_metadata_store).
+
+    The snapshot only sees the changes made through the client using it: items created, renamed or deleted by other
+    users or processes are not picked up until the snapshot is refreshed (refresh_metadata_store), invalidated
+    (invalidate_cache) or older than max_age. The stored fields of a table are kept until a refresh finds the table changed.
+
+    Parameters
+    ----------
+    path : path of the SQLite file (created if it does not exist)
+    max_age : number of seconds after which the snapshot of an item type is not used anymore and the listing is
+              fetched again (default 86400, i.e. one day). If None, the snapshot is used until it is refreshed or
+              invalidated, so the changes made by other processes are never picked up on their own.
+    """
+    def __init__(self, path, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS items (item_type TEXT, id, name TEXT, version TEXT, record TEXT,
+                                                  PRIMARY KEY (item_type, id));
+                CREATE TABLE IF NOT EXISTS fields (table_id INTEGER PRIMARY KEY, version TEXT, fields TEXT);
+                CREATE TABLE IF NOT EXISTS snapshots (item_type TEXT PRIMARY KEY, refreshed_at REAL, stale INTEGER);
+            ''')
+
+
+    def close(self):
+        self._conn.close()
+
+
+    @staticmethod
+    def _version(item, record):
+        """The value used for detecting changes ('updated_at' if available, otherwise the record itself)"""
+        return item.get('updated_at') or json.dumps(record, sort_keys=True, default=str)
+
+
+    def get_records(self, item_type):
+        """Return the stored records of the given item type, or None if there is no usable snapshot"""
+        with self._lock:
+            row = self._conn.execute('SELECT refreshed_at, stale FROM snapshots WHERE item_type = ?', (item_type,)).fetchone()
+            if row is None or row[1] or (self.max_age is not None and time.time() - row[0] >= self.max_age):
+                return None
+            return [ json.loads(i[0]) for i in self._conn.execute('SELECT record FROM items WHERE item_type = ?', (item_type,)) ]
+
+
+    def update_items(self, item_type, items):
+        """
+        Update the snapshot of the given item type from its listing. Only new or changed items are written and
+        the items not in the listing are removed. Return the number of items that were written or removed.
+        """
+        with self._lock, self._conn:
+            stored = dict(self._conn.execute('SELECT id, version FROM items WHERE item_type = ?', (item_type,)).fetchall())
+            changed = []
+            for i in items:
+                record = ItemIndex.make_record(i)
+                version = self._version(i, record)
+                if stored.pop(i['id'], None) != version:
+                    changed.append((item_type, i['id'], i['name'], version, json.dumps(record)))
+            self._conn.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)', changed)
+            self._conn.executemany('DELETE FROM items WHERE item_type = ? AND id = ?', [ (item_type, i) for i in stored ])
+            self._conn.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, 0)', (item_type, time.time()))
+        return len(changed) + len(stored)
+
+
+    def get_table_fields(self, table_id):
+        """Return the stored fields of the given table, or None if they are not stored"""
+        with self._lock:
+            row = self._conn.execute('SELECT fields FROM fields WHERE table_id = ?', (table_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+    def set_table_fields(self, table_id, fields, version=None):
+        """Store the fields of the given table. 'version' is the 'updated_at' of the table when the fields were pulled."""
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO fields VALUES (?, ?, ?)', (table_id, version, json.dumps(fields)))
+
+
+    def get_db_fields(self, db_id):
+        """
+        Return a {table_name: {col_name: col_id}} dictionary for the given DB, or None if the snapshot of the tables
+        is not usable or the fields of some tables of the DB are not stored.
+        """
+        tables = self.get_records('table')
+        if tables is None:
+            return None
+        db_fields = {}
+        for table in tables:
+            if table['db_id'] != db_id:
+                continue
+            fields = self.get_table_fields(table['id'])
+            if fields is None:
+                return None
+            db_fields.setdefault(table['name'], {}).update({ i['name']: i['id'] for i in fields })
+        return db_fields
+
+
+    def get_outdated_tables(self):
+        """Return the ids of the stored tables whose fields are missing or were pulled before the last change of the table"""
+        with self._lock:
+            return [ i[0] for i in self._conn.execute('''
+                SELECT items.id FROM items LEFT JOIN fields ON items.id = fields.table_id
+                WHERE items.item_type = 'table' AND (fields.version IS NULL OR fields.version != items.version)
+            ''') ]
+
+
+    def get_table_version(self, table_id):
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM items WHERE item_type = 'table' AND id = ?", (table_id,)).fetchone()
+        return row[0] if row else None
+
+
+    def mark_stale(self, item_type=None):
+        """Stop using the snapshot of the given item type (or all item types) until it is updated again"""
+        with self._lock, self._conn:
+            if item_type is None:
+                self._conn.execute('UPDATE snapshots SET stale = 1')
+            else:
+                self._conn.execute('UPDATE snapshots SET stale = 1 WHERE item_type = ?', (item_type,))
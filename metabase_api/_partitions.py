@@ -0,0 +1,107 @@
+import datetime
+
+# the parameter type used for a single value of each type of variable (i.e. template tags that are not field filters)
+VARIABLE_PARAMETER_TYPES = {'text': 'category', 'number': 'number/=', 'date': 'date/single'}
+
+
+def make_partitions(template_tags, template_tag, values=None, start=None, end=None, n_partitions=None, end_template_tag=None):
+    """
+    Return the 'parameters' (see get_card_data) of each partition of a native card, using its template tags
+    (card['dataset_query']['native']['template-tags']).
+
+    Parameters
+    ----------
+    template_tags : the template tags of the card
+    template_tag : the name of the template tag used for partitioning
+    values : partition by these values of the template tag. If n_partitions is provided, the values are split
+             into n_partitions groups (only for field filters), otherwise there is one partition per value.
+    start, end : partition the range [start, end) of a numeric or date column (dates as datetime.date or 'YYYY-MM-DD')
+                 into n_partitions contiguous ranges. The template tag must be a field filter on the column,
+                 or, if end_template_tag is provided, the two template tags are used as the bounds of the range
+                 (the query should then be like 'WHERE col >= {{start}} AND col < {{end}}').
+    n_partitions : the number of partitions (default 4 for ranges)
+    end_template_tag : the name of the template tag for the (excluded) end of each range
+    """
+    tag = _get_tag(template_tags, template_tag)
+
+    if values is not None:
+        values = list(values)
+        if tag['type'] != 'dimension':
+            if n_partitions is not None:
+                raise ValueError('The template tag "{}" is not a field filter, so it only accepts a single value per partition'
+                                 .format(template_tag))
+            return [ [_variable_parameter(tag, template_tag, value)] for value in values ]
+        n_partitions = n_partitions or len(values)
+        groups = [ values[len(values) * i // n_partitions:len(values) * (i + 1) // n_partitions] for i in range(n_partitions) ]
+        return [ [_field_filter_parameter(tag, template_tag, group)] for group in groups if group ]
+
+    if start is None or end is None:
+        raise ValueError('Either values or start and end must be provided.')
+    bounds = _split_range(start, end, n_partitions or 4)
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+
+    if end_template_tag:
+        end_tag = _get_tag(template_tags, end_template_tag)
+        return [ [_variable_parameter(tag, template_tag, _to_value(low)), _variable_parameter(end_tag, end_template_tag, _to_value(high))]
+                 for low, high in ranges ]
+
+    if tag['type'] != 'dimension':
+        raise ValueError('The template tag "{}" is not a field filter. Provide end_template_tag for partitioning '
+                         'with two variables.'.format(template_tag))
+    target = ['dimension', ['template-tag', template_tag]]
+    if isinstance(bounds[0], datetime.date):
+        # date/range includes both ends
+        return [ [{'type': 'date/range', 'value': '{}~{}'.format(low, high - datetime.timedelta(days=1)), 'target': target}]
+                 for low, high in ranges ]
+    if all(isinstance(bound, int) for bound in bounds):
+        # number/between includes both ends
+        return [ [{'type': 'number/between', 'value': [low, high - 1], 'target': target}] for low, high in ranges ]
+    raise ValueError('Ranges of non-integer numbers need two variables (see end_template_tag)')
+
+
+
+def _get_tag(template_tags, name):
+    if name not in template_tags:
+        raise ValueError('The card has no template tag "{}". The template tags of the card are: {}'
+                         .format(name, list(template_tags)))
+    return template_tags[name]
+
+
+
+def _variable_parameter(tag, name, value):
+    if tag['type'] == 'dimension':
+        return _field_filter_parameter(tag, name, [value])
+    return {'type': VARIABLE_PARAMETER_TYPES.get(tag['type'], 'category'), 'value': value,
+            'target': ['variable', ['template-tag', name]]}
+
+
+
+def _field_filter_parameter(tag, name, values):
+    return {'type': tag.get('widget-type') or 'category', 'value': values, 'target': ['dimension', ['template-tag', name]]}
+
+
+
+def _to_value(bound):
+    return bound.isoformat() if isinstance(bound, datetime.date) else bound
+
+
+
+def _split_range(start, end, n_partitions):
+    """Return the bounds of n_partitions contiguous ranges covering [start, end) (fewer if the range is too small)"""
+    if isinstance(start, str):
+        start, end = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    if isinstance(start, datetime.datetime) or isinstance(end, datetime.datetime):
+        raise ValueError('Use dates (not datetimes) for the bounds of date ranges')
+    if not start < end:
+        raise ValueError('start must be smaller than end')
+
+    if isinstance(start, datetime.date):
+        days = (end - start).days
+        bounds = [ start + datetime.timedelta(days=days * i // n_partitions) for i in range(n_partitions + 1) ]
+    elif isinstance(start, int) and isinstance(end, int):
+        bounds = [ start + (end - start) * i // n_partitions for i in range(n_partitions + 1) ]
+    else:
+        bounds = [ start + (end - start) * i / n_partitions for i in range(n_partitions + 1) ]
+        bounds[-1] = end
+
+    return [ bound for i, bound in enumerate(bounds) if i == 0 or bound != bounds[i - 1] ]
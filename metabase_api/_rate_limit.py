@@ -0,0 +1,70 @@
+import asyncio
+import re
+import threading
+import time
+
+
+class _TokenBucket():
+
+    def __init__(self, rate, burst):
+        assert rate > 0 and burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before using it (must be called with the lock held)"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        self._tokens -= 1
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+
+class RateLimiter():
+    """
+    Client-side token-bucket rate limiter. The same instance can be shared by several clients, threads and coroutines.
+
+    Parameters
+    ----------
+    rate : maximum average number of requests per second
+    burst : maximum number of requests that can be sent at once after an idle period (default: rate, at least 1)
+    endpoint_budgets : additional budgets for classes of endpoints, as a dict of {regex: (rate, burst)}.
+                       The regex is matched against the endpoint (e.g. '/api/card/12/query/json') and a request
+                       must fit in both the global budget and the budget of the first matching class.
+                       RateLimiter.QUERY_ENDPOINTS matches the endpoints that run queries.
+                       E.g. RateLimiter(20, endpoint_budgets={RateLimiter.QUERY_ENDPOINTS: (2, 4)})
+    """
+    QUERY_ENDPOINTS = r'^/api/(card/\d+/query|dataset)'
+
+    def __init__(self, rate, burst=None, endpoint_budgets=None):
+        self._bucket = _TokenBucket(rate, burst if burst is not None else max(1, rate))
+        self._endpoint_buckets = [ (re.compile(pattern), _TokenBucket(r, b)) for pattern, (r, b) in (endpoint_budgets or {}).items() ]
+        self._lock = threading.Lock()
+
+
+    def _reserve(self, endpoint):
+        with self._lock:
+            delay = self._bucket.reserve()
+            for pattern, bucket in self._endpoint_buckets:
+                if pattern.match(endpoint):
+                    delay = max(delay, bucket.reserve())
+                    break
+        return delay
+
+
+    def acquire(self, endpoint=''):
+        """Block until the request to the given endpoint is allowed"""
+        delay = self._reserve(endpoint)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    async def acquire_async(self, endpoint=''):
+        """Async version of acquire"""
+        delay = self._reserve(endpoint)
+        if delay > 0:
+            await asyncio.sleep(delay)
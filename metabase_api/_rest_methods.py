@@ -1,8 +1,83 @@
-import requests 
+import time
+import requests
+import urllib3
+
+
+def _send(self, method, endpoint, **kwargs):
+    """
+    Send a single request to the given endpoint using the pooled session and return the response.
+    Requests are throttled by self.rate_limiter (if set), transient failures are retried according to 
+    self.retry_policy (if set), and self.circuit_breaker (if set) refuses requests while Metabase keeps failing.
+    """
+    kwargs.setdefault('timeout', self.timeout)
+    attempt = 0
+    while True:
+        if self.rate_limiter:
+            self.rate_limiter.acquire(endpoint)
+        is_trial = self.circuit_breaker.before_request() if self.circuit_breaker else False
+        try:
+            res = self._session.request(method, self.domain + endpoint, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if self.circuit_breaker:
+                self.circuit_breaker.record_failure()
+            # the request was not sent if the connection could not be established
+            connect_error = isinstance(e, requests.exceptions.ConnectTimeout) \
+                            or isinstance(getattr(e.args[0] if e.args else None, 'reason', None), urllib3.exceptions.NewConnectionError)
+            if not self.retry_policy or not self.retry_policy.should_retry_error(method, endpoint, attempt, connect_error):
+                raise
+            time.sleep(self.retry_policy.get_backoff(attempt))
+            attempt += 1
+            continue
+        except requests.exceptions.RequestException:  # e.g. ChunkedEncodingError
+            if self.circuit_breaker:
+                self.circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            if is_trial:  # otherwise the circuit would stay half-open
+                self.circuit_breaker.record_failure()
+            raise
+
+        if self.circuit_breaker:
+            if self.circuit_breaker.is_failure(res.status_code):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        if not self.retry_policy or not self.retry_policy.should_retry_status(method, endpoint, res.status_code, attempt):
+            return res
+
+        res.close()
+        time.sleep(self.retry_policy.get_backoff(attempt, res.headers.get('Retry-After')))
+        attempt += 1
+
+
+def _request(self, method, endpoint, **kwargs):
+    """
+    Send the request using the pooled session and return the response.
+    By default the session is validated before every request. If reauth_on_401 is set, the request is sent directly 
+    and only a 401 response makes the client re-authenticate and replay the request (once).
+    """
+    if self.email and self.session_is_expired():
+        with self._auth_lock:
+            if self.session_is_expired():  # another thread may have already refreshed the session
+                self.authenticate()
+    if not self.reauth_on_401:
+        self.validate_session()
+
+    session_id = self.session_id
+    res = self._send(method, endpoint, headers=self.header, **kwargs, auth=self.auth)
+
+    if res.status_code == 401 and self.reauth_on_401 and self.email:
+        res.close()
+        with self._auth_lock:
+            if self.session_id == session_id:  # another thread may have already re-authenticated
+                self.authenticate()
+        res = self._send(method, endpoint, headers=self.header, **kwargs, auth=self.auth)
+
+    return res
+
 
 def get(self, endpoint, *args, **kwargs):
-    self.validate_session()
-    res = requests.get(self.domain + endpoint, headers=self.header, **kwargs, auth=self.auth)
+    res = self._request('GET', endpoint, **kwargs)
     if 'raw' in args:
         return res
     else:
@@ -10,8 +85,7 @@ def get(self, endpoint, *args, **kwargs):
 
 
 def post(self, endpoint, *args, **kwargs):
-    self.validate_session()
-    res = requests.post(self.domain + endpoint, headers=self.header, **kwargs, auth=self.auth)
+    res = self._request('POST', endpoint, **kwargs)
     if 'raw' in args:
         return res
     else:
@@ -20,8 +94,7 @@ def post(self, endpoint, *args, **kwargs):
 
 def put(self, endpoint, *args, **kwargs):
     """Used for updating objects (cards, dashboards, ...)"""
-    self.validate_session()
-    res = requests.put(self.domain + endpoint, headers=self.header, **kwargs, auth=self.auth)
+    res = self._request('PUT', endpoint, **kwargs)
     if 'raw' in args:
         return res
     else:
@@ -29,9 +102,8 @@ def put(self, endpoint, *args, **kwargs):
 
 
 def delete(self, endpoint, *args, **kwargs):
-    self.validate_session()
-    res = requests.delete(self.domain + endpoint, headers=self.header, **kwargs, auth=self.auth)
+    res = self._request('DELETE', endpoint, **kwargs)
     if 'raw' in args:
         return res
     else:
-        return res.status_code
\ No newline at end of file
+        return res.status_code
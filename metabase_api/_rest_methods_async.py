@@ -1,29 +1,93 @@
+import asyncio
 import httpx
 
-async def get(self, endpoint, *args, **kwargs):
-    await self.validate_session_async()
+async def _send(self, method, endpoint, **kwargs):
+    """
+    Async version of _send.
+    Send a single request to the given endpoint using the pooled client and return the response.
+    Requests are throttled by self.rate_limiter (if set), transient failures are retried according to 
+    self.retry_policy (if set), and self.circuit_breaker (if set) refuses requests while Metabase keeps failing.
+    With stream=True the body is not read (use res.aiter_bytes() and close the response with res.aclose()).
+    """
+    stream = kwargs.pop('stream', False)
+    auth = kwargs.pop('auth', None)
+    attempt = 0
+    while True:
+        if self.rate_limiter:
+            await self.rate_limiter.acquire_async(endpoint)
+        is_trial = self.circuit_breaker.before_request() if self.circuit_breaker else False
+        try:
+            request = self._client.build_request(method, endpoint, **kwargs)
+            res = await self._client.send(request, auth=auth, stream=stream)
+        except httpx.TransportError as e:
+            if self.circuit_breaker:
+                self.circuit_breaker.record_failure()
+            # the request was not sent if the connection could not be established
+            connect_error = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+            if not self.retry_policy or not self.retry_policy.should_retry_error(method, endpoint, attempt, connect_error):
+                raise
+            await asyncio.sleep(self.retry_policy.get_backoff(attempt))
+            attempt += 1
+            continue
+        except httpx.HTTPError:  # e.g. DecodingError
+            if self.circuit_breaker:
+                self.circuit_breaker.record_failure()
+            raise
+        except BaseException:  # e.g. asyncio.CancelledError
+            if is_trial:  # otherwise the circuit would stay half-open
+                self.circuit_breaker.record_failure()
+            raise
+
+        if self.circuit_breaker:
+            if self.circuit_breaker.is_failure(res.status_code):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        if not self.retry_policy or not self.retry_policy.should_retry_status(method, endpoint, res.status_code, attempt):
+            return res
+
+        await res.aclose()
+        await asyncio.sleep(self.retry_policy.get_backoff(attempt, res.headers.get('Retry-After')))
+        attempt += 1
+
+async def _request(self, method, endpoint, **kwargs):
+    """
+    Async version of _request.
+    By default the session is validated before every request. If reauth_on_401 is set, the request is sent directly 
+    and only a 401 response makes the client re-authenticate and replay the request (once).
+    """
+    if self.email and (self.session_id is None or self.session_is_expired()):
+        async with self._auth_lock:
+            if self.session_id is None or self.session_is_expired():  # another task may have already authenticated
+                await self.authenticate_async()
+    if not self.reauth_on_401:
+        await self.validate_session_async()
+
     auth = (self.email, self.password) if self.auth else None
+    session_id = self.session_id
+    res = await self._send(method, endpoint, auth=auth, **kwargs)
+
+    if res.status_code == 401 and self.reauth_on_401 and self.email:
+        await res.aclose()
+        async with self._auth_lock:
+            if self.session_id == session_id:  # another task may have already re-authenticated
+                await self.authenticate_async()
+        res = await self._send(method, endpoint, auth=auth, **kwargs)
+
+    return res
 
-    res = await self._client.get(endpoint, auth=auth, **kwargs)
+async def get(self, endpoint, *args, **kwargs):
+    res = await self._request("GET", endpoint, **kwargs)
     return res if "raw" in args else (res.json() if res.status_code == 200 else False)
 
 async def post(self, endpoint, *args, **kwargs):
-    await self.validate_session_async()
-    auth = (self.email, self.password) if self.auth else None
-
-    res = await self._client.post(endpoint, auth=auth, **kwargs)
+    res = await self._request("POST", endpoint, **kwargs)
     return res if "raw" in args else (res.json() if res.status_code == 200 else False)
 
 async def put(self, endpoint, *args, **kwargs):
-    await self.validate_session_async()
-    auth = (self.email, self.password) if self.auth else None
-
-    res = await self._client.put(endpoint, auth=auth, **kwargs)
+    res = await self._request("PUT", endpoint, **kwargs)
     return res if "raw" in args else res.status_code
 
 async def delete(self, endpoint, *args, **kwargs):
-    await self.validate_session_async()
-    auth = (self.email, self.password) if self.auth else None
-
-    res = await self._client.delete(endpoint, auth=auth, **kwargs)
+    res = await self._request("DELETE", endpoint, **kwargs)
     return res if "raw" in args else res.status_code
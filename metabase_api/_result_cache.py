@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache():
+    """
+    Local cache for the results of card queries (see get_card_data), shared by the clients it is given to.
+    An entry is keyed by the card id, its 'updated_at' (so editing the card invalidates its entries), the normalized
+    parameters, format_rows and the data format. Results are kept in memory (least recently used entries are evicted
+    first) and optionally on disk, both serialized as JSON (so reading the disk tier cannot run code) and with a maximum
+    size in bytes (of the serialized results). The results must be JSON serializable.
+
+    Parameters
+    ----------
+    ttl : number of seconds a result is kept (default None, i.e. until it is evicted)
+    max_memory_bytes : maximum size of the memory tier (default 256MB)
+    path : directory of the disk tier (default None, i.e. no disk tier). Created if it does not exist.
+    max_disk_bytes : maximum size of the disk tier (default 1GB)
+    """
+    def __init__(self, ttl=None, max_memory_bytes=256 * 2**20, path=None, max_disk_bytes=2**30):
+        self.ttl = ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> (created_at, result serialized as JSON)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+
+    @staticmethod
+    def make_key(card_id, updated_at, parameters=None, format_rows=False, data_format='json'):
+        normalized = json.dumps([card_id, updated_at, parameters or [], bool(format_rows), data_format], sort_keys=True, default=str)
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+    def get(self, key):
+        """Return the cached result, or None if there is no (fresh) result for the key"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._is_expired(entry[0]):
+                    self._memory.move_to_end(key)
+                    return json.loads(entry[1])
+                self._remove_from_memory(key)
+
+            if not self.path:
+                return None
+            file_path = os.path.join(self.path, key)
+            try:
+                with open(file_path, 'rb') as f:
+                    created_at, data = json.load(f)
+            except (OSError, ValueError, TypeError):  # e.g. a missing, partial or invalid file
+                return None
+            if self._is_expired(created_at):
+                self._remove_file(file_path)
+                return None
+            os.utime(file_path)  # the files are evicted in the order of their last use
+            self._add_to_memory(key, created_at, _dumps(data))
+            return data
+
+
+    def set(self, key, result):
+        with self._lock:
+            created_at = time.time()
+            data = _dumps(result)
+            self._add_to_memory(key, created_at, data)
+            if self.path:
+                tmp_path = os.path.join(self.path, key + '.tmp')
+                with open(tmp_path, 'wb') as f:
+                    f.write(_dumps([created_at, result]))
+                os.replace(tmp_path, os.path.join(self.path, key))
+                self._evict_files()
+
+
+    def clear(self):
+        """Remove all the cached results (from memory and disk)"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self.path:
+                for name in os.listdir(self.path):
+                    self._remove_file(os.path.join(self.path, name))
+
+
+    def _is_expired(self, created_at):
+        return self.ttl is not None and time.time() - created_at >= self.ttl
+
+
+    def _add_to_memory(self, key, created_at, data):
+        self._remove_from_memory(key)
+        if len(data) > self.max_memory_bytes:
+            return
+        self._memory[key] = (created_at, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            self._remove_from_memory(next(iter(self._memory)))
+
+
+    def _remove_from_memory(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[1])
+
+
+    def _evict_files(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(i[1] for i in files)
+        for mtime, size, file_path in sorted(files):
+            if total_size <= self.max_disk_bytes:
+                break
+            self._remove_file(file_path)
+            total_size -= size
+
+
+    @staticmethod
+    def _remove_file(file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
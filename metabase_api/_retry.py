@@ -0,0 +1,150 @@
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class CircuitBreakerOpen(Exception):
+    """Raised when a request is refused because the circuit breaker is open"""
+
+
+
+class RetryPolicy():
+    """
+    Retry policy used by the REST methods for transient failures (e.g. 502/503 from a Metabase under load).
+
+    Parameters
+    ----------
+    max_retries : maximum number of retries for a single request (default 3)
+    backoff_factor : base of the exponential backoff in seconds. The delay before retry n is a random value
+                     between 0 and backoff_factor * 2**n (i.e. "full jitter") (default 0.5)
+    max_backoff : maximum delay in seconds between two attempts, also applied to the Retry-After header (default 30)
+    status_forcelist : status codes that are retried (default 429, 502, 503, 504)
+    retry_non_idempotent : whether to retry non-idempotent requests (POST) on any of the above (default False).
+                           When False, a POST is retried only if the server did not process it: a 429 response
+                           or a failure to connect. POSTs that only read data (running card/dataset queries) are
+                           always considered idempotent.
+    respect_retry_after : whether to use the delay given in the Retry-After header of 429/503 responses (default True)
+    """
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+    READ_ONLY_POST_ENDPOINTS = re.compile(r'^/api/(card/\d+/query(/\w+)?|dataset(/\w+)?)/?$')
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30, status_forcelist=(429, 502, 503, 504),
+                 retry_non_idempotent=False, respect_retry_after=True):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.status_forcelist = frozenset(status_forcelist)
+        self.retry_non_idempotent = retry_non_idempotent
+        self.respect_retry_after = respect_retry_after
+
+
+    def is_idempotent(self, method, endpoint):
+        if method.upper() in self.IDEMPOTENT_METHODS:
+            return True
+        return bool(self.READ_ONLY_POST_ENDPOINTS.match(endpoint.split('?')[0]))
+
+
+    def should_retry_status(self, method, endpoint, status_code, attempt):
+        if attempt >= self.max_retries or status_code not in self.status_forcelist:
+            return False
+        return status_code == 429 or self.retry_non_idempotent or self.is_idempotent(method, endpoint)
+
+
+    def should_retry_error(self, method, endpoint, attempt, connect_error=False):
+        """connect_error : whether the request failed before it was sent (so it is safe to retry)"""
+        if attempt >= self.max_retries:
+            return False
+        return connect_error or self.retry_non_idempotent or self.is_idempotent(method, endpoint)
+
+
+    def get_backoff(self, attempt, retry_after=None):
+        """Return the number of seconds to wait before the given retry attempt (starting from 0)"""
+        if retry_after is not None and self.respect_retry_after:
+            delay = self.parse_retry_after(retry_after)
+            if delay is not None:
+                return min(delay, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+
+    @staticmethod
+    def parse_retry_after(value):
+        """The Retry-After header is either a number of seconds or an HTTP date"""
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+
+
+class CircuitBreaker():
+    """
+    Per-client circuit breaker. After 'failure_threshold' consecutive failures (connection errors, 5xx or 429 responses)
+    the circuit opens and requests are refused (CircuitBreakerOpen is raised) without reaching Metabase.
+    After 'recovery_time' seconds a single trial request is let through: if it succeeds the circuit closes,
+    otherwise it opens again.
+
+    Parameters
+    ----------
+    failure_threshold : number of consecutive failures that opens the circuit (default 5)
+    recovery_time : number of seconds the circuit stays open before a trial request is allowed (default 30)
+    """
+    def __init__(self, failure_threshold=5, recovery_time=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+
+    @property
+    def state(self):
+        """One of 'closed', 'open' or 'half-open'"""
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial_in_progress or time.monotonic() - self._opened_at >= self.recovery_time:
+                return 'half-open'
+            return 'open'
+
+
+    def before_request(self):
+        """
+        Raise CircuitBreakerOpen if the request should not be sent. Otherwise return whether the request is the trial 
+        request of a half-open circuit: its outcome must be recorded (with record_failure if it fails in any other way, 
+        e.g. is cancelled), or no other request would be let through.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if self._trial_in_progress or time.monotonic() - self._opened_at < self.recovery_time:
+                raise CircuitBreakerOpen('The circuit breaker is open after {} consecutive failures. Metabase is not reachable or is overloaded.'
+                                         .format(self._failures))
+            self._trial_in_progress = True
+            return True
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+    @staticmethod
+    def is_failure(status_code):
+        return status_code >= 500 or status_code == 429
@@ -0,0 +1,207 @@
+import codecs
+import csv
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# an unquoted cell containing only 'null' in a CSV body (group 1 is the separator before it)
+NULL_CSV_CELL = re.compile(r'(^|,)null(?=,|\r?$)', re.MULTILINE)
+
+
+class JSONArrayDecoder():
+    """
+    Incremental decoder for a JSON array (e.g. the body of POST /api/card/:id/query/json).
+    Feed it the chunks of the body as they arrive and get back the elements that are complete so far,
+    so only the current (incomplete) element is kept in memory. With pairs, the elements that are objects 
+    (e.g. the rows of the export) are returned as lists of (key, value) pairs, so the duplicate keys are kept.
+    """
+    def __init__(self, pairs=False):
+        self._decoder = json.JSONDecoder(object_pairs_hook=_Pairs) if pairs else json.JSONDecoder()
+        self._pairs = pairs
+        self._text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._buffer = ''
+        self._started = False
+        self._ended = False
+
+
+    def feed(self, chunk):
+        """Add a chunk (bytes) of the body and return the list of the elements completed by it"""
+        self._buffer += self._text_decoder.decode(chunk)
+        return self._parse(final=False)
+
+
+    def close(self):
+        """Return the last elements and make sure the whole array was received"""
+        self._buffer += self._text_decoder.decode(b'', final=True)
+        items = self._parse(final=True)
+        if not self._ended:
+            raise ValueError('The JSON array is incomplete')
+        return items
+
+
+    def _parse(self, final):
+        items = []
+        buffer = self._buffer
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if not self._started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expected a JSON array but received: {}'.format(buffer[pos:pos + 200]))
+                self._started = True
+                pos += 1
+                continue
+            if self._ended:
+                raise ValueError('Unexpected data after the end of the JSON array: {}'.format(buffer[pos:pos + 200]))
+            if buffer[pos] == ']':
+                self._ended = True
+                pos += 1
+                continue
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break  # the element is not complete yet
+            if end == len(buffer) and not final and isinstance(item, (int, float)):
+                break  # a number at the end of the chunk may continue in the next one
+            if self._pairs:
+                item = [ (key, _restore(value)) for key, value in item ] if isinstance(item, _Pairs) else _restore(item)
+            items.append(item)
+            pos = end
+        self._buffer = buffer[pos:]
+        return items
+
+
+
+class _Pairs(list):
+    """The (key, value) pairs of a JSON object (see JSONArrayDecoder)"""
+
+
+
+def _restore(value):
+    """Turn the objects nested in a value (decoded as _Pairs) back into dictionaries"""
+    if isinstance(value, _Pairs):
+        return { key: _restore(i) for key, i in value }
+    if isinstance(value, list):
+        return [ _restore(i) for i in value ]
+    return value
+
+
+
+class CSVDecoder():
+    """
+    Incremental decoder for a CSV body (e.g. the body of POST /api/card/:id/query/csv).
+    Feed it the chunks of the body as they arrive and get back the rows (lists of cells) that are complete so far.
+    The first row is the header. Cells containing only 'null' are returned as empty strings.
+    """
+    def __init__(self):
+        self._text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._buffer = ''
+
+
+    def feed(self, chunk):
+        """Add a chunk (bytes) of the body and return the list of the rows completed by it"""
+        self._buffer += self._text_decoder.decode(chunk)
+        records = []
+        record_start = 0
+        quotes = 0
+        pos = 0
+        while True:
+            newline = self._buffer.find('\n', pos)
+            if newline == -1:
+                break
+            quotes += self._buffer.count('"', pos, newline)
+            pos = newline + 1
+            if quotes % 2 == 0:  # the newline is not inside a quoted cell, so the record is complete
+                records.append(self._buffer[record_start:pos])
+                record_start = pos
+                quotes = 0
+        self._buffer = self._buffer[record_start:]
+        return self._parse(records)
+
+
+    def close(self):
+        """Return the last row (if the body does not end with a newline)"""
+        self._buffer += self._text_decoder.decode(b'', final=True)
+        records = [self._buffer] if self._buffer.strip() else []
+        self._buffer = ''
+        return self._parse(records)
+
+
+    @staticmethod
+    def _parse(records):
+        return [ [ '' if cell == 'null' else cell for cell in row ] for row in csv.reader(records) ]
+
+
+
+def iter_rows(decoder, chunks, batch_size=None, row_limit=None):
+    """
+    Feed the chunks of a body to the decoder and yield the decoded rows (or lists of up to batch_size rows).
+    Stop after row_limit rows (not counting the header of a CSV body).
+    """
+    if row_limit is not None and isinstance(decoder, CSVDecoder):
+        row_limit += 1  # the header
+    batch = []
+    count = 0
+    for rows in _decode_chunks(decoder, chunks):
+        if row_limit is not None:
+            rows = rows[:row_limit - count]
+            count += len(rows)
+        if batch_size is None:
+            yield from rows
+        else:
+            batch.extend(rows)
+            complete = len(batch) - len(batch) % batch_size
+            for i in range(0, complete, batch_size):
+                yield batch[i:i + batch_size]
+            batch = batch[complete:]
+        if row_limit is not None and count >= row_limit:
+            break
+    if batch:
+        yield batch
+
+
+
+async def aiter_rows(decoder, chunks, batch_size=None, row_limit=None):
+    """Async version of iter_rows, for an async iterator of chunks"""
+    if row_limit is not None and isinstance(decoder, CSVDecoder):
+        row_limit += 1  # the header
+    batch = []
+    count = 0
+    async for rows in _adecode_chunks(decoder, chunks):
+        if row_limit is not None:
+            rows = rows[:row_limit - count]
+            count += len(rows)
+        if batch_size is None:
+            for row in rows:
+                yield row
+        else:
+            batch.extend(rows)
+            complete = len(batch) - len(batch) % batch_size
+            for i in range(0, complete, batch_size):
+                yield batch[i:i + batch_size]
+            batch = batch[complete:]
+        if row_limit is not None and count >= row_limit:
+            break
+    if batch:
+        yield batch
+
+
+
+def _decode_chunks(decoder, chunks):
+    for chunk in chunks:
+        yield decoder.feed(chunk)
+    yield decoder.close()
+
+
+
+async def _adecode_chunks(decoder, chunks):
+    async for chunk in chunks:
+        yield decoder.feed(chunk)
+    yield decoder.close()
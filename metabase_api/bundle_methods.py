@@ -0,0 +1,323 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from ._bundle import BundleWriter, read_bundle, find_references, remap_references, get_card_references, \
+                     get_dashboard_references, get_pulse_references, make_card_json, make_pulse_json, REFERENCE_KINDS, \
+                     remap_visualization_settings, find_visualization_references, get_visualization_settings, strip_item_links
+from .copy_methods import _get_dashboard_layout
+
+
+def export_collection_bundle(self, path, source_collection_name=None, source_collection_id=None, concurrency=4):
+    """
+    Export the collection with the given name/id and all its sub-collections to a bundle file, for importing them
+    into another Metabase (see import_collection_bundle). The bundle is a gzip-compressed JSON lines file holding the
+    collections, cards, dashboards and pulses of the subtree, the cards outside of the subtree that they use, the
+    segments used by the cards, and the names of the databases, tables and fields they reference.
+    The definitions are fetched using up to `concurrency` threads and written to the file as they are received.
+
+    Parameters
+    ----------
+    path : path of the bundle file to write (e.g. 'finance.bundle.jsonl.gz')
+    source_collection_name : name of the collection to export (default None)
+    source_collection_id : id of the collection to export (default None)
+    concurrency : number of definitions fetched at the same time (default 4)
+
+    Returns a report: {'path', 'bytes', 'counts': {kind: number of exported objects}}
+    """
+    if not source_collection_id:
+        if not source_collection_name:
+            raise ValueError('Either the name or id of the source collection must be provided.')
+        else:
+            source_collection_id = self.get_item_id('collection', source_collection_name)
+
+    tree = self.get_collection_tree()
+    contents = self._get_collection_contents(source_collection_id, concurrency)
+    items = [ item for collection_items in contents.values() for item in collection_items if item['model'] != 'collection' ]
+    get_references = { 'card': get_card_references, 'dashboard': get_dashboard_references, 'pulse': get_pulse_references }
+    references = { kind: set() for kind in REFERENCE_KINDS }
+
+    writer = BundleWriter(path)
+    try:
+        ### the collections (parents before children)
+        for collection_id in tree.iter_subtree(source_collection_id):
+            parent_id = tree.get_parent_id(collection_id) if collection_id != source_collection_id else None
+            writer.write('collection', {'id': collection_id, 'name': tree.get_name(collection_id), 'parent_id': parent_id})
+
+        ### the cards, dashboards and pulses
+        exported_cards = set()
+        fetch = lambda item: (item, self.get('/api/{}/{}'.format(item['model'], item['id'])))
+        for item, definition in _map(fetch, items, concurrency):
+            if not definition:
+                raise ValueError('There is no {} with the id "{}"'.format(item['model'], item['id']))
+            writer.write(item['model'], definition)
+            find_references(get_references[item['model']](definition), references)
+            for settings in get_visualization_settings(definition):
+                find_visualization_references(settings, references)
+            if item['model'] == 'card':
+                exported_cards.add(item['id'])
+
+        ### the cards used by the exported items that are outside of the subtree (they are imported into the top collection)
+        while references['card'] - exported_cards:
+            fetch = lambda card_id: (card_id, self.get('/api/card/{}'.format(card_id)))
+            for card_id, card in _map(fetch, sorted(references['card'] - exported_cards), concurrency):
+                if not card:
+                    raise ValueError('There is no card with the id "{}"'.format(card_id))
+                writer.write('card', dict(card, collection_id=source_collection_id))
+                find_references(get_card_references(card), references)
+                find_visualization_references(card.get('visualization_settings'), references)
+                exported_cards.add(card_id)
+
+        ### the segments used by the cards
+        fetch = lambda segment_id: (segment_id, self.get('/api/segment/{}'.format(segment_id)))
+        for segment_id, segment in _map(fetch, sorted(references['segment']), concurrency):
+            if not segment:
+                raise ValueError('There is no segment with the id "{}"'.format(segment_id))
+            writer.write('segment', segment)
+            find_references({ 'table_id': segment['table_id'], 'definition': segment['definition'] }, references)
+
+        ### the names of the referenced databases, tables and fields
+        for kind, names in self._get_bundle_names(references, concurrency).items():
+            for name in names:
+                writer.write(kind, name)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+
+def _get_bundle_names(self, references, concurrency=4):
+    """
+    Return {'database': [{'id', 'name'}], 'table': [{'id', 'name', 'db_id'}], 'field': [{'id', 'name', 'table_id'}]}
+    for the referenced databases, tables and fields (and the tables and databases they belong to).
+    """
+    fields = {}
+    for table_id, table_fields in _map(lambda table_id: (table_id, self._get_table_fields(table_id)), sorted(references['table']), concurrency):
+        for field in table_fields:
+            fields[field['id']] = { 'id': field['id'], 'name': field['name'], 'table_id': table_id }
+    for field_id, field in _map(lambda field_id: (field_id, self.get('/api/field/{}'.format(field_id))),
+                                sorted(references['field'] - fields.keys()), concurrency):
+        if not field:
+            raise ValueError('There is no field with the id "{}"'.format(field_id))
+        fields[field_id] = { 'id': field_id, 'name': field['name'], 'table_id': field['table_id'] }
+
+    tables = { i['id']: i for records in self._get_item_index('table').values() for i in records }
+    databases = { i['id']: i for records in self._get_item_index('database').values() for i in records }
+    table_IDs = references['table'] | { fields[field_id]['table_id'] for field_id in references['field'] }
+    for table_id in table_IDs:
+        if table_id not in tables:
+            raise ValueError('There is no table with the id "{}"'.format(table_id))
+    database_IDs = references['database'] | { tables[table_id]['db_id'] for table_id in table_IDs }
+
+    return { 'database': [ {'id': i, 'name': databases[i]['name']} for i in sorted(database_IDs) ],
+             'table': [ {'id': i, 'name': tables[i]['name'], 'db_id': tables[i]['db_id']} for i in sorted(table_IDs) ],
+             'field': [ fields[i] for i in sorted(references['field']) ] }
+
+
+
+def import_collection_bundle(self, path, destination_parent_collection_name=None, destination_parent_collection_id=None,
+                             destination_collection_name=None, database_mapping=None, concurrency=4):
+    """
+    Import a bundle made by export_collection_bundle (possibly in another Metabase) into the given destination parent collection.
+    The referenced databases, tables and fields are found by name in this Metabase, in bulk (using the cached listings
+    and metadata, see the 'cache_ttl' and 'metadata_store' arguments of the class), and their ids are rewritten in the
+    queries. Then the objects are created in dependency order: the collections (parents before children), the segments
+    (an existing segment with the same name on the same table is reused), the cards (a card is created after the cards
+    it uses), the dashboards and the pulses. Up to `concurrency` cards (and dashboards) are created at the same time.
+    The click behaviors linking to other cards and dashboards are set in a second pass, once all the items are created
+    (with the dashcards of the dashboards). The settings whose references are not in the bundle (e.g. a click behavior
+    linking to a dashboard that was not exported) cannot be imported: they are dropped and listed in the report.
+
+    Parameters
+    ----------
+    path : path of the bundle file
+    destination_parent_collection_name : name of the collection to import the bundle into (default None).
+                                         Use 'Root' for the root collection.
+    destination_parent_collection_id : id of the collection to import the bundle into (default None)
+    destination_collection_name : name of the imported top collection (default None, i.e. the name in the bundle)
+    database_mapping : {database name in the source Metabase: database name in this Metabase}, for the databases
+                       whose names are different (default None)
+    concurrency : number of objects created at the same time (default 4)
+
+    Returns a report: {'collection_id': id of the imported top collection,
+                       'created': {kind: {id in the bundle: id in this Metabase}} for the collections, segments, cards, dashboards and pulses,
+                       'dropped': [{'kind': 'card' or 'dashboard', 'id': id in the bundle, 'setting': path of the setting
+                                    in the visualization settings (of the card, or of a dashcard for a dashboard), 'error'}]}
+    """
+    if not destination_parent_collection_id:
+        if not destination_parent_collection_name:
+            raise ValueError('Either the name or id of the destination parent collection must be provided.')
+        elif destination_parent_collection_name != 'Root':
+            destination_parent_collection_id = self.get_item_id('collection', destination_parent_collection_name)
+
+    bundle = read_bundle(path)
+    mapping = self._resolve_bundle_names(bundle, database_mapping or {}, concurrency)
+    mapping['segment'] = {}
+    mapping['card'] = {}
+
+    def remap(kind, source_id):
+        if source_id not in mapping[kind]:
+            raise ValueError('The {} with the id "{}" (in the source Metabase) is not in the bundle'.format(kind, source_id))
+        return mapping[kind][source_id]
+
+    created = { kind: {} for kind in ['collection', 'segment', 'card', 'dashboard', 'pulse'] }
+    report = { 'collection_id': None, 'created': created, 'dropped': [] }
+    mapping['dashboard'] = created['dashboard']  # only used once all the dashboards are created
+
+    def remap_settings(kind, source_id, settings, path=()):
+        dropped = []
+        settings = remap_visualization_settings(settings, remap, dropped)
+        report['dropped'].extend({ 'kind': kind, 'id': source_id, 'setting': list(path) + i['setting'], 'error': i['error'] } for i in dropped)
+        return settings
+
+    ### the collections (parents before children)
+    for collection in bundle['collection']:
+        if collection['parent_id'] is None:
+            name = destination_collection_name or collection['name']
+            parent_id = destination_parent_collection_id
+        else:
+            name = collection['name']
+            parent_id = created['collection'][collection['parent_id']]
+        res = self.create_collection(name, parent_collection_id=parent_id, parent_collection_name='Root', return_results=True)
+        created['collection'][collection['id']] = res['id']
+    report['collection_id'] = created['collection'][bundle['collection'][0]['id']]
+
+    ### the segments (reused if a segment with the same name exists on the same table)
+    items = [ ('segment', segment['name'], remap('table', segment['table_id'])) for segment in bundle['segment'] ]
+    existing = self.resolve_item_ids(items)['ids']
+    for segment, item in zip(bundle['segment'], items):
+        if item in existing:
+            mapping['segment'][segment['id']] = existing[item]
+            continue
+        res = self.post('/api/segment/', json={ 'name': segment['name'], 'description': segment.get('description'),
+                                                'table_id': item[2], 'definition': remap_references(segment['definition'], remap) })
+        if not res:
+            raise ValueError('Error creating the segment "{}"'.format(segment['name']))
+        mapping['segment'][segment['id']] = created['segment'][segment['id']] = res['id']
+    if created['segment']:
+        self.invalidate_cache('segment')
+
+    ### the cards (in waves: a card is created after the cards it uses), without their links to other items
+    def create_card(card):
+        collection_id = created['collection'].get(card['collection_id'], report['collection_id'])
+        card_json = make_card_json(card, collection_id, remap)
+        if card['id'] in linking_cards:  # the links are set once all the items are created (see below)
+            card_json['visualization_settings'] = remap_visualization_settings(strip_item_links(card['visualization_settings']), remap)
+        elif 'visualization_settings' in card_json:
+            card_json['visualization_settings'] = remap_settings('card', card['id'], card['visualization_settings'])
+        res = self.create_card(custom_json=card_json, return_card=True)
+        if not res or not res.get('id'):
+            raise ValueError('Error creating the card "{}": {}'.format(card['name'], res))
+        return card['id'], res['id']
+
+    linking_cards = { card['id'] for card in bundle['card']
+                      if strip_item_links(card.get('visualization_settings')) != (card.get('visualization_settings') or {}) }
+    pending = bundle['card']
+    while pending:
+        ready = [ card for card in pending if find_references(get_card_references(card))['card'] <= mapping['card'].keys() ]
+        if not ready:
+            raise ValueError('The cards {} use each other'.format([ card['id'] for card in pending ]))
+        for source_id, card_id in _map(create_card, ready, concurrency):
+            mapping['card'][source_id] = created['card'][source_id] = card_id
+        pending = [ card for card in pending if card['id'] not in mapping['card'] ]
+
+    ### the dashboards (created without their tabs and dashcards)
+    def create_dashboard(dashboard):
+        res = self.post('/api/dashboard/', 'raw', json={ 'name': dashboard['name'],
+                                                          'description': dashboard.get('description') or None,
+                                                          'collection_id': created['collection'][dashboard['collection_id']],
+                                                          'collection_position': dashboard.get('collection_position'),
+                                                          'parameters': remap_references(dashboard.get('parameters') or [], remap) })
+        if not res.ok:
+            raise ValueError('Error creating the dashboard "{}": {}'.format(dashboard['name'], res.text))
+        return dashboard['id'], res.json()['id']
+
+    for source_id, dashboard_id in _map(create_dashboard, bundle['dashboard'], concurrency):
+        created['dashboard'][source_id] = dashboard_id
+    if created['dashboard']:
+        self.invalidate_cache('dashboard')
+
+    ### the links to other items (now that all the cards and dashboards are created): the visualization settings
+    ### of the cards that have them, and the tabs and dashcards of the dashboards (written in a single update)
+    def update_card(card):
+        settings = remap_settings('card', card['id'], card.get('visualization_settings'))
+        res = self.put('/api/card/{}'.format(created['card'][card['id']]), 'raw', json={ 'visualization_settings': settings })
+        if not res.ok:
+            raise ValueError('Error updating the visualization settings of the card "{}": {}'.format(card['name'], res.text))
+
+    def update_dashboard(dashboard):
+        layout = _get_dashboard_layout(dashboard, mapping['card'])
+        for dashcard, source_dashcard in zip(layout['dashcards'], dashboard.get('dashcards') or []):
+            dashcard['parameter_mappings'] = [ dict(i, target=remap_references(i.get('target'), remap)) for i in dashcard['parameter_mappings'] ]
+            dashcard['visualization_settings'] = remap_settings('dashboard', dashboard['id'], dashcard['visualization_settings'],
+                                                                ['dashcards', source_dashcard['id']])
+        res = self.put('/api/dashboard/{}'.format(created['dashboard'][dashboard['id']]), 'raw', json=layout)
+        if not res.ok:
+            raise ValueError('Error creating the dashcards of the dashboard "{}": {}'.format(dashboard['name'], res.text))
+
+    list(_map(update_card, [ card for card in bundle['card'] if card['id'] in linking_cards ], concurrency))
+    list(_map(update_dashboard, bundle['dashboard'], concurrency))
+
+    ### the pulses
+    for pulse in bundle['pulse']:
+        res = self.post('/api/pulse', 'raw', json=make_pulse_json(pulse, created['collection'][pulse['collection_id']], mapping['card']))
+        if not res.ok:
+            raise ValueError('Error creating the pulse "{}": {}'.format(pulse['name'], res.text))
+        created['pulse'][pulse['id']] = res.json()['id']
+    if created['pulse']:
+        self.invalidate_cache('pulse')
+
+    return report
+
+
+
+def _resolve_bundle_names(self, bundle, database_mapping, concurrency=4):
+    """
+    Find the databases, tables and fields of the bundle by name in this Metabase (in bulk) and return
+    {'database': {source id: id}, 'table': {source id: id}, 'field': {source id: id}}.
+    """
+    mapping = { 'database': {}, 'table': {}, 'field': {} }
+    errors = []
+
+    databases = [ (i['id'], ('database', database_mapping.get(i['name'], i['name']))) for i in bundle['database'] ]
+    res = self.resolve_item_ids([ item for source_id, item in databases ])
+    for source_id, item in databases:
+        _add_resolved(mapping['database'], source_id, item, res, errors)
+
+    tables = [ (i['id'], ('table', i['name'], mapping['database'][i['db_id']])) for i in bundle['table'] if i['db_id'] in mapping['database'] ]
+    res = self.resolve_item_ids([ item for source_id, item in tables ])
+    for source_id, item in tables:
+        _add_resolved(mapping['table'], source_id, item, res, errors)
+
+    table_fields = dict(_map(lambda table_id: (table_id, { i['name']: i['id'] for i in self._get_table_fields(table_id) }),
+                             sorted(set(mapping['table'].values())), concurrency))
+    for field in bundle['field']:
+        if field['table_id'] not in mapping['table']:
+            continue
+        field_id = table_fields[mapping['table'][field['table_id']]].get(field['name'])
+        if field_id is None:
+            errors.append('field "{}" (table id {})'.format(field['name'], mapping['table'][field['table_id']]))
+        else:
+            mapping['field'][field['id']] = field_id
+
+    if errors:
+        raise ValueError('These items of the bundle were not found (or are ambiguous) in this Metabase: {}'.format(', '.join(errors)))
+    return mapping
+
+
+
+def _add_resolved(mapping, source_id, item, res, errors):
+    if item in res['ids']:
+        mapping[source_id] = res['ids'][item]
+    else:
+        errors.append('{} "{}"'.format(item[0], item[1]) + (' (DB id {})'.format(item[2]) if len(item) > 2 else ''))
+
+
+
+def _map(func, items, concurrency):
+    """Yield func(item) for the items (in order), calling func in up to `concurrency` threads"""
+    if concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from executor.map(func, items)
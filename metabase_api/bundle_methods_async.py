@@ -0,0 +1,302 @@
+import asyncio
+
+from ._bundle import BundleWriter, read_bundle, find_references, remap_references, get_card_references, \
+                     get_dashboard_references, get_pulse_references, make_card_json, make_pulse_json, REFERENCE_KINDS, \
+                     remap_visualization_settings, find_visualization_references, get_visualization_settings, strip_item_links
+from .copy_methods import _get_dashboard_layout
+from .bundle_methods import _add_resolved
+
+
+async def export_collection_bundle(self, path, source_collection_name=None, source_collection_id=None, concurrency=4):
+    """
+    Async version of export_collection_bundle.
+    Export the collection with the given name/id and all its sub-collections to a bundle file (see import_collection_bundle).
+    Up to `concurrency` definitions are fetched at the same time, and written to the file as they are received.
+    """
+    if not source_collection_id:
+        if not source_collection_name:
+            raise ValueError('Either the name or id of the source collection must be provided.')
+        else:
+            source_collection_id = await self.get_item_id('collection', source_collection_name)
+
+    tree = await self.get_collection_tree()
+    contents = await self._get_collection_contents(source_collection_id, concurrency)
+    items = [item for collection_items in contents.values() for item in collection_items if item['model'] != 'collection']
+    get_references = {'card': get_card_references, 'dashboard': get_dashboard_references, 'pulse': get_pulse_references}
+    references = {kind: set() for kind in REFERENCE_KINDS}
+
+    writer = BundleWriter(path)
+    try:
+        # The collections (parents before children)
+        for collection_id in tree.iter_subtree(source_collection_id):
+            parent_id = tree.get_parent_id(collection_id) if collection_id != source_collection_id else None
+            writer.write('collection', {'id': collection_id, 'name': tree.get_name(collection_id), 'parent_id': parent_id})
+
+        # The cards, dashboards and pulses
+        exported_cards = set()
+
+        async def fetch(item):
+            return item, await self.get(f'/api/{item["model"]}/{item["id"]}')
+
+        async for item, definition in _amap(fetch, items, concurrency):
+            if not definition:
+                raise ValueError(f'There is no {item["model"]} with the id "{item["id"]}"')
+            writer.write(item['model'], definition)
+            find_references(get_references[item['model']](definition), references)
+            for settings in get_visualization_settings(definition):
+                find_visualization_references(settings, references)
+            if item['model'] == 'card':
+                exported_cards.add(item['id'])
+
+        # The cards used by the exported items that are outside of the subtree (they are imported into the top collection)
+        async def fetch_card(card_id):
+            return card_id, await self.get(f'/api/card/{card_id}')
+
+        while references['card'] - exported_cards:
+            async for card_id, card in _amap(fetch_card, sorted(references['card'] - exported_cards), concurrency):
+                if not card:
+                    raise ValueError(f'There is no card with the id "{card_id}"')
+                writer.write('card', dict(card, collection_id=source_collection_id))
+                find_references(get_card_references(card), references)
+                find_visualization_references(card.get('visualization_settings'), references)
+                exported_cards.add(card_id)
+
+        # The segments used by the cards
+        async def fetch_segment(segment_id):
+            return segment_id, await self.get(f'/api/segment/{segment_id}')
+
+        async for segment_id, segment in _amap(fetch_segment, sorted(references['segment']), concurrency):
+            if not segment:
+                raise ValueError(f'There is no segment with the id "{segment_id}"')
+            writer.write('segment', segment)
+            find_references({'table_id': segment['table_id'], 'definition': segment['definition']}, references)
+
+        # The names of the referenced databases, tables and fields
+        for kind, names in (await self._get_bundle_names(references, concurrency)).items():
+            for name in names:
+                writer.write(kind, name)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+async def _get_bundle_names(self, references, concurrency=4):
+    """Async version of _get_bundle_names"""
+    fields = {}
+
+    async def fetch_table_fields(table_id):
+        return table_id, await self._get_table_fields(table_id)
+
+    async for table_id, table_fields in _amap(fetch_table_fields, sorted(references['table']), concurrency):
+        for field in table_fields:
+            fields[field['id']] = {'id': field['id'], 'name': field['name'], 'table_id': table_id}
+
+    async def fetch_field(field_id):
+        return field_id, await self.get(f'/api/field/{field_id}')
+
+    async for field_id, field in _amap(fetch_field, sorted(references['field'] - fields.keys()), concurrency):
+        if not field:
+            raise ValueError(f'There is no field with the id "{field_id}"')
+        fields[field_id] = {'id': field_id, 'name': field['name'], 'table_id': field['table_id']}
+
+    tables = {i['id']: i for records in (await self._get_item_index('table')).values() for i in records}
+    databases = {i['id']: i for records in (await self._get_item_index('database')).values() for i in records}
+    table_IDs = references['table'] | {fields[field_id]['table_id'] for field_id in references['field']}
+    for table_id in table_IDs:
+        if table_id not in tables:
+            raise ValueError(f'There is no table with the id "{table_id}"')
+    database_IDs = references['database'] | {tables[table_id]['db_id'] for table_id in table_IDs}
+
+    return {'database': [{'id': i, 'name': databases[i]['name']} for i in sorted(database_IDs)],
+            'table': [{'id': i, 'name': tables[i]['name'], 'db_id': tables[i]['db_id']} for i in sorted(table_IDs)],
+            'field': [fields[i] for i in sorted(references['field'])]}
+
+
+async def import_collection_bundle(self, path, destination_parent_collection_name=None, destination_parent_collection_id=None,
+                                   destination_collection_name=None, database_mapping=None, concurrency=4):
+    """
+    Async version of import_collection_bundle.
+    Import a bundle made by export_collection_bundle into the given destination parent collection, finding the referenced
+    databases, tables and fields by name and creating the objects in dependency order (up to `concurrency` at the same time).
+    The links to other cards and dashboards are set once all the items are created; the settings that cannot be remapped
+    are dropped and listed in the report.
+    """
+    if not destination_parent_collection_id:
+        if not destination_parent_collection_name:
+            raise ValueError('Either the name or id of the destination parent collection must be provided.')
+        elif destination_parent_collection_name != 'Root':
+            destination_parent_collection_id = await self.get_item_id('collection', destination_parent_collection_name)
+
+    bundle = read_bundle(path)
+    mapping = await self._resolve_bundle_names(bundle, database_mapping or {}, concurrency)
+    mapping['segment'] = {}
+    mapping['card'] = {}
+
+    def remap(kind, source_id):
+        if source_id not in mapping[kind]:
+            raise ValueError(f'The {kind} with the id "{source_id}" (in the source Metabase) is not in the bundle')
+        return mapping[kind][source_id]
+
+    created = {kind: {} for kind in ['collection', 'segment', 'card', 'dashboard', 'pulse']}
+    report = {'collection_id': None, 'created': created, 'dropped': []}
+    mapping['dashboard'] = created['dashboard']  # Only used once all the dashboards are created
+
+    def remap_settings(kind, source_id, settings, path=()):
+        dropped = []
+        settings = remap_visualization_settings(settings, remap, dropped)
+        report['dropped'].extend({'kind': kind, 'id': source_id, 'setting': list(path) + i['setting'], 'error': i['error']} for i in dropped)
+        return settings
+
+    # The collections (parents before children)
+    for collection in bundle['collection']:
+        if collection['parent_id'] is None:
+            name = destination_collection_name or collection['name']
+            parent_id = destination_parent_collection_id
+        else:
+            name = collection['name']
+            parent_id = created['collection'][collection['parent_id']]
+        res = await self.create_collection(name, parent_collection_id=parent_id, parent_collection_name='Root', return_results=True)
+        created['collection'][collection['id']] = res['id']
+    report['collection_id'] = created['collection'][bundle['collection'][0]['id']]
+
+    # The segments (reused if a segment with the same name exists on the same table)
+    items = [('segment', segment['name'], remap('table', segment['table_id'])) for segment in bundle['segment']]
+    existing = (await self.resolve_item_ids(items))['ids']
+    for segment, item in zip(bundle['segment'], items):
+        if item in existing:
+            mapping['segment'][segment['id']] = existing[item]
+            continue
+        res = await self.post('/api/segment/', json={'name': segment['name'], 'description': segment.get('description'),
+                                                     'table_id': item[2], 'definition': remap_references(segment['definition'], remap)})
+        if not res:
+            raise ValueError(f'Error creating the segment "{segment["name"]}"')
+        mapping['segment'][segment['id']] = created['segment'][segment['id']] = res['id']
+    if created['segment']:
+        self.invalidate_cache('segment')
+
+    # The cards (in waves: a card is created after the cards it uses), without their links to other items
+    async def create_card(card):
+        collection_id = created['collection'].get(card['collection_id'], report['collection_id'])
+        card_json = make_card_json(card, collection_id, remap)
+        if card['id'] in linking_cards:  # The links are set once all the items are created (see below)
+            card_json['visualization_settings'] = remap_visualization_settings(strip_item_links(card['visualization_settings']), remap)
+        elif 'visualization_settings' in card_json:
+            card_json['visualization_settings'] = remap_settings('card', card['id'], card['visualization_settings'])
+        res = await self.create_card(custom_json=card_json, return_card=True)
+        if not res or not res.get('id'):
+            raise ValueError(f'Error creating the card "{card["name"]}": {res}')
+        return card['id'], res['id']
+
+    linking_cards = {card['id'] for card in bundle['card']
+                     if strip_item_links(card.get('visualization_settings')) != (card.get('visualization_settings') or {})}
+    pending = bundle['card']
+    while pending:
+        ready = [card for card in pending if find_references(get_card_references(card))['card'] <= mapping['card'].keys()]
+        if not ready:
+            raise ValueError(f'The cards {[card["id"] for card in pending]} use each other')
+        async for source_id, card_id in _amap(create_card, ready, concurrency):
+            mapping['card'][source_id] = created['card'][source_id] = card_id
+        pending = [card for card in pending if card['id'] not in mapping['card']]
+
+    # The dashboards (created without their tabs and dashcards)
+    async def create_dashboard(dashboard):
+        res = await self.post('/api/dashboard/', 'raw', json={
+            'name': dashboard['name'],
+            'description': dashboard.get('description') or None,
+            'collection_id': created['collection'][dashboard['collection_id']],
+            'collection_position': dashboard.get('collection_position'),
+            'parameters': remap_references(dashboard.get('parameters') or [], remap)
+        })
+        if res.status_code != 200:
+            raise ValueError(f'Error creating the dashboard "{dashboard["name"]}": {res.text}')
+        return dashboard['id'], res.json()['id']
+
+    async for source_id, dashboard_id in _amap(create_dashboard, bundle['dashboard'], concurrency):
+        created['dashboard'][source_id] = dashboard_id
+    if created['dashboard']:
+        self.invalidate_cache('dashboard')
+
+    # The links to other items (now that all the cards and dashboards are created): the visualization settings
+    # of the cards that have them, and the tabs and dashcards of the dashboards (written in a single update)
+    async def update_card(card):
+        settings = remap_settings('card', card['id'], card.get('visualization_settings'))
+        res = await self.put(f'/api/card/{created["card"][card["id"]]}', 'raw', json={'visualization_settings': settings})
+        if res.status_code != 200:
+            raise ValueError(f'Error updating the visualization settings of the card "{card["name"]}": {res.text}')
+
+    async def update_dashboard(dashboard):
+        layout = _get_dashboard_layout(dashboard, mapping['card'])
+        for dashcard, source_dashcard in zip(layout['dashcards'], dashboard.get('dashcards') or []):
+            dashcard['parameter_mappings'] = [dict(i, target=remap_references(i.get('target'), remap)) for i in dashcard['parameter_mappings']]
+            dashcard['visualization_settings'] = remap_settings('dashboard', dashboard['id'], dashcard['visualization_settings'],
+                                                                ['dashcards', source_dashcard['id']])
+        res = await self.put(f'/api/dashboard/{created["dashboard"][dashboard["id"]]}', 'raw', json=layout)
+        if res.status_code != 200:
+            raise ValueError(f'Error creating the dashcards of the dashboard "{dashboard["name"]}": {res.text}')
+
+    async for _ in _amap(update_card, [card for card in bundle['card'] if card['id'] in linking_cards], concurrency):
+        pass
+    async for _ in _amap(update_dashboard, bundle['dashboard'], concurrency):
+        pass
+
+    # The pulses
+    for pulse in bundle['pulse']:
+        res = await self.post('/api/pulse', 'raw', json=make_pulse_json(pulse, created['collection'][pulse['collection_id']], mapping['card']))
+        if res.status_code != 200:
+            raise ValueError(f'Error creating the pulse "{pulse["name"]}": {res.text}')
+        created['pulse'][pulse['id']] = res.json()['id']
+    if created['pulse']:
+        self.invalidate_cache('pulse')
+
+    return report
+
+
+async def _resolve_bundle_names(self, bundle, database_mapping, concurrency=4):
+    """Async version of _resolve_bundle_names"""
+    mapping = {'database': {}, 'table': {}, 'field': {}}
+    errors = []
+
+    databases = [(i['id'], ('database', database_mapping.get(i['name'], i['name']))) for i in bundle['database']]
+    res = await self.resolve_item_ids([item for source_id, item in databases])
+    for source_id, item in databases:
+        _add_resolved(mapping['database'], source_id, item, res, errors)
+
+    tables = [(i['id'], ('table', i['name'], mapping['database'][i['db_id']])) for i in bundle['table'] if i['db_id'] in mapping['database']]
+    res = await self.resolve_item_ids([item for source_id, item in tables])
+    for source_id, item in tables:
+        _add_resolved(mapping['table'], source_id, item, res, errors)
+
+    async def fetch_table_fields(table_id):
+        return table_id, {i['name']: i['id'] for i in await self._get_table_fields(table_id)}
+
+    table_fields = {table_id: names async for table_id, names in _amap(fetch_table_fields, sorted(set(mapping['table'].values())), concurrency)}
+    for field in bundle['field']:
+        if field['table_id'] not in mapping['table']:
+            continue
+        field_id = table_fields[mapping['table'][field['table_id']]].get(field['name'])
+        if field_id is None:
+            errors.append(f'field "{field["name"]}" (table id {mapping["table"][field["table_id"]]})')
+        else:
+            mapping['field'][field['id']] = field_id
+
+    if errors:
+        raise ValueError(f'These items of the bundle were not found (or are ambiguous) in this Metabase: {", ".join(errors)}')
+    return mapping
+
+
+async def _amap(func, items, concurrency):
+    """Yield the results of func(item) for the items as they complete, running up to `concurrency` of them at the same time"""
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -1,9 +1,13 @@
+import os
+from ._copy_journal import CopyJournal
+
+
 
 def copy_card(self, source_card_name=None, source_card_id=None, 
                 source_collection_name=None, source_collection_id=None,
                 destination_card_name=None, 
                 destination_collection_name=None, destination_collection_id=None,
-                postfix='', verbose=False, return_card=False):
+                postfix='', verbose=False, return_card=False, _source_card=None):
     """
     Copy the card with the given name/id to the given destination collection. 
 
@@ -41,8 +45,8 @@ def copy_card(self, source_card_name=None, source_card_id=None,
             source_card_name = self.get_item_name(item_type='card', item_id=source_card_id)
         destination_card_name = source_card_name + postfix
 
-    # Get the source card info
-    source_card = self.get('/api/card/{}'.format(source_card_id))
+    # Get the source card info (unless it was fetched in advance, see plan_collection_copy)
+    source_card = _source_card or self.get('/api/card/{}'.format(source_card_id))
 
     # Update the name and collection_id
     card_json = source_card
@@ -63,7 +67,7 @@ def copy_card(self, source_card_name=None, source_card_id=None,
 def copy_pulse(self, source_pulse_name=None, source_pulse_id=None, 
                 source_collection_name=None, source_collection_id=None,
                 destination_pulse_name=None, 
-                destination_collection_id=None, destination_collection_name=None, postfix=''):
+                destination_collection_id=None, destination_collection_name=None, postfix='', _source_pulse=None):
     """
     Copy the pulse with the given name/id to the given destination collection. 
 
@@ -100,8 +104,8 @@ def copy_pulse(self, source_pulse_name=None, source_pulse_id=None,
             source_pulse_name = self.get_item_name(item_type='pulse', item_id=source_pulse_id)
         destination_pulse_name = source_pulse_name + postfix
 
-    # Get the source pulse info
-    source_pulse = self.get('/api/pulse/{}'.format(source_pulse_id))
+    # Get the source pulse info (unless it was fetched in advance, see plan_collection_copy)
+    source_pulse = _source_pulse or self.get('/api/pulse/{}'.format(source_pulse_id))
 
     # Updat the name and collection_id
     pulse_json = source_pulse
@@ -109,7 +113,11 @@ def copy_pulse(self, source_pulse_name=None, source_pulse_id=None,
     pulse_json['name'] = destination_pulse_name
 
     # Save as a new pulse
-    self.post('/api/pulse', json=pulse_json)
+    res = self.post('/api/pulse', 'raw', json=pulse_json)
+    self.invalidate_cache('pulse')
+    if not res.ok:
+        raise ValueError('Error copying the pulse: {}'.format(res.text))
+    return res.json()['id']
 
 
 
@@ -117,7 +125,8 @@ def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=None,
                     source_collection_name=None, source_collection_id=None,
                     destination_dashboard_name=None, 
                     destination_collection_name=None, destination_collection_id=None,
-                    deepcopy=False, postfix='', collection_position=1, description=''):
+                    deepcopy=False, postfix='', collection_position=1, description='', 
+                    client_side=False, cards_collection_id=None, concurrency=4):
     """
     Copy the dashboard with the given name/id to the given destination collection. 
 
@@ -134,6 +143,13 @@ def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=None,
     deepcopy : whether to duplicate the cards inside the dashboard (default False). 
     postfix : if destination_dashboard_name is None, adds this string to the end of source_dashboard_name 
         to make destination_dashboard_name 
+    client_side : with deepcopy, duplicate the cards from the client instead of using POST /api/dashboard/:id/copy (default False). 
+        Every distinct card of the dashboard is duplicated only once (up to `concurrency` cards at the same time) 
+        and the dashcards are written with the new cards in a single update of the new dashboard 
+        (PUT /api/dashboard/:id with the tabs and dashcards, which needs Metabase v0.47 or newer).
+    cards_collection_id : with client_side deepcopy, id of an existing collection to save the duplicated cards in (default None). 
+        If None, a collection called "[destination_dashboard_name]'s cards" is created in the destination collection.
+    concurrency : with client_side deepcopy, number of cards duplicated at the same time (default 4)
     """
     ### making sure we have the data that we need 
     if not source_dashboard_id:
@@ -155,6 +171,10 @@ def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=None,
             source_dashboard_name = self.get_item_name(item_type='dashboard', item_id=source_dashboard_id)
         destination_dashboard_name = source_dashboard_name + postfix
 
+    if deepcopy and client_side:
+        return self._deepcopy_dashboard(source_dashboard_id, destination_dashboard_name, destination_collection_id, 
+                                        cards_collection_id, concurrency, collection_position, description)
+
     parameters = {
         'collection_id':destination_collection_id, 
         'name':destination_dashboard_name, 
@@ -163,6 +183,10 @@ def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=None,
         'description': description
     }
     res = self.post('/api/dashboard/{}/copy'.format(source_dashboard_id), 'raw', json=parameters)
+    self.invalidate_cache('dashboard')
+    if deepcopy:  # the duplicated cards are saved in a new collection
+        self.invalidate_cache('card')
+        self.invalidate_cache('collection')
     if res.status_code != 200:
         raise ValueError('Error copying the dashboard: {}'.format(res.text))
     dup_dashboard_id = res.json()['id']
@@ -170,12 +194,179 @@ def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=None,
 
 
 
+def _deepcopy_dashboard(self, source_dashboard_id, destination_dashboard_name, destination_collection_id, 
+                        cards_collection_id=None, concurrency=4, collection_position=1, description=''):
+    """
+    Deepcopy the dashboard from the client (see the client_side argument of copy_dashboard) and return the id of the new dashboard.
+    """
+    dashboard = self.get('/api/dashboard/{}'.format(source_dashboard_id))
+    if not dashboard:
+        raise ValueError('There is no dashboard with the id "{}"'.format(source_dashboard_id))
+    card_names = _get_dashboard_card_names(dashboard)
+
+    ### duplicate every distinct card of the dashboard once
+    if card_names and not cards_collection_id:
+        res = self.create_collection("{}'s cards".format(destination_dashboard_name), 
+                                     parent_collection_id=destination_collection_id, return_results=True)
+        cards_collection_id = res['id']
+    copy = lambda card_id: self.copy_card(source_card_id=card_id, 
+                                          destination_collection_id=cards_collection_id, 
+                                          destination_card_name=card_names[card_id])
+    if concurrency > 1 and len(card_names) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            new_card_ids = list(executor.map(copy, card_names))
+    else:
+        new_card_ids = [ copy(card_id) for card_id in card_names ]
+    card_id_mapping = dict(zip(card_names, new_card_ids))
+
+    ### create the dashboard and write its tabs and dashcards (using the new cards) in a single update
+    res = self.post('/api/dashboard/', 'raw', json={ 'name': destination_dashboard_name, 
+                                                      'collection_id': destination_collection_id, 
+                                                      'collection_position': collection_position,
+                                                      'description': description or None, 
+                                                      'parameters': dashboard.get('parameters') or [] })
+    self.invalidate_cache('dashboard')
+    if not res.ok:
+        raise ValueError('Error copying the dashboard: {}'.format(res.text))
+    dup_dashboard_id = res.json()['id']
+
+    res = self.put('/api/dashboard/{}'.format(dup_dashboard_id), 'raw', json=_get_dashboard_layout(dashboard, card_id_mapping))
+    if not res.ok:
+        raise ValueError('Error copying the dashcards of the dashboard (this needs Metabase v0.47 or newer): {}'.format(res.text))
+    return dup_dashboard_id
+
+
+
+def _get_dashboard_card_names(dashboard):
+    """Return {card_id: card_name} for the distinct cards of the dashboard (including the cards added as series)"""
+    card_names = {}
+    for dashcard in dashboard.get('dashcards') or []:
+        cards = ([dashcard['card']] if dashcard.get('card_id') is not None else []) + (dashcard.get('series') or [])
+        for card in cards:
+            card_names.setdefault(card['id'], card['name'])
+    return card_names
+
+
+
+def _get_dashboard_layout(dashboard, card_id_mapping):
+    """
+    Return the tabs and dashcards of the dashboard, using the new card ids in card_id_mapping, 
+    as the body of PUT /api/dashboard/:id (new tabs and dashcards have negative ids)
+    """
+    tab_id_mapping = { tab['id']: -(i + 1) for i, tab in enumerate(dashboard.get('tabs') or []) }
+    tabs = [ {'id': tab_id_mapping[tab['id']], 'name': tab['name']} for tab in dashboard.get('tabs') or [] ]
+    dashcards = []
+    for i, dashcard in enumerate(dashboard.get('dashcards') or []):
+        dashcards.append({
+            'id': -(i + 1),
+            'card_id': card_id_mapping.get(dashcard.get('card_id')),
+            'dashboard_tab_id': tab_id_mapping.get(dashcard.get('dashboard_tab_id')),
+            'action_id': dashcard.get('action_id'),
+            'row': dashcard['row'], 
+            'col': dashcard['col'], 
+            'size_x': dashcard['size_x'], 
+            'size_y': dashcard['size_y'],
+            'series': [ {'id': card_id_mapping[card['id']]} for card in dashcard.get('series') or [] ],
+            'visualization_settings': dashcard.get('visualization_settings') or {},
+            'parameter_mappings': [ dict(mapping, card_id=card_id_mapping.get(mapping.get('card_id'), mapping.get('card_id'))) 
+                                    for mapping in dashcard.get('parameter_mappings') or [] ]
+        })
+    return { 'tabs': tabs, 'dashcards': dashcards }
+
+
+
+def plan_collection_copy(self, source_collection_name=None, source_collection_id=None, concurrency=4, 
+                         deepcopy_dashboards=False, skip=None):
+    """
+    Plan the copy of the collection with the given name/id (see copy_collection): find the contents of the collection
+    and all its sub-collections (from the collection tree, see _get_collection_contents) and fetch the definitions
+    of their cards and pulses, using up to `concurrency` threads. Dashboards are copied by Metabase (POST /api/dashboard/:id/copy),
+    so their definitions are only fetched with deepcopy_dashboards (to count the cards Metabase duplicates).
+
+    Parameters
+    ----------
+    source_collection_name : name of the collection to copy (default None) 
+    source_collection_id : id of the collection to copy (default None) 
+    concurrency : number of definitions fetched at the same time (default 4)
+    deepcopy_dashboards : whether the dashboards are copied with their cards (see copy_collection) (default False)
+    skip : the (model, id) pairs of the items that were already copied (e.g. found in the journal of an interrupted copy).
+           They are not counted and their definitions are not fetched (default None).
+
+    Returns the plan: {'source_collection_id', 
+                       'contents': {collection_id: [{'model', 'id', 'name'}]} for the collection and its sub-collections,
+                       'definitions': {(model, id): definition} for the cards and pulses (and dashboards with deepcopy_dashboards),
+                       'counts': {'collection', 'card', 'dashboard', 'pulse'}: number of items to copy (including the collection),
+                                 and with deepcopy_dashboards, 'deepcopied_card': number of cards duplicated by Metabase 
+                                 (one per dashcard with a card, created by the POST copying their dashboard),
+                       'skipped': number of items skipped (see skip),
+                       'estimated_requests': number of requests of the copy (the GETs of the definitions and one POST per item)}
+    """
+    if not source_collection_id:
+        if not source_collection_name:
+            raise ValueError('Either the name or id of the source collection must be provided.')
+        else:
+            source_collection_id = self.get_item_id('collection', source_collection_name)
+
+    contents = self._get_collection_contents(source_collection_id, concurrency)
+    counts, skipped, items = _get_plan_items(source_collection_id, contents, deepcopy_dashboards, skip)
+
+    ### fetch the definitions of the cards and pulses (and of the dashboards, to count the cards duplicated by a deepcopy)
+    fetch = lambda item: self.get('/api/{}/{}'.format(item['model'], item['id']))
+    if concurrency > 1 and len(items) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(fetch, items))
+    else:
+        results = [ fetch(item) for item in items ]
+
+    definitions = {}
+    for item, definition in zip(items, results):
+        if not definition:
+            raise ValueError('There is no {} with the id "{}"'.format(item['model'], item['id']))
+        definitions[(item['model'], item['id'])] = definition
+
+    return _make_plan(source_collection_id, contents, definitions, counts, skipped, deepcopy_dashboards)
+
+
+
+def _get_plan_items(source_collection_id, contents, deepcopy_dashboards=False, skip=None):
+    """
+    Return the counts of the items to copy (see plan_collection_copy), the number of items skipped 
+    and the items whose definitions are fetched by the plan
+    """
+    skip = set(skip or [])
+    items = [ {'model': 'collection', 'id': source_collection_id} ] + [ item for items in contents.values() for item in items ]
+    to_copy = [ item for item in items if (item['model'], item['id']) not in skip ]
+    counts = { 'collection': 0, 'card': 0, 'dashboard': 0, 'pulse': 0 }
+    for item in to_copy:
+        counts[item['model']] += 1
+    fetched_models = ['card', 'pulse', 'dashboard'] if deepcopy_dashboards else ['card', 'pulse']
+    return counts, len(items) - len(to_copy), [ item for item in to_copy if item['model'] in fetched_models ]
+
+
+
+def _make_plan(source_collection_id, contents, definitions, counts, skipped, deepcopy_dashboards=False):
+    # one GET per definition and one POST per item (the cards duplicated by a deepcopy are created by the POST of their dashboard)
+    estimated_requests = len(definitions) + sum(counts.values())
+    if deepcopy_dashboards:
+        counts['deepcopied_card'] = sum(1 for (model, _), definition in definitions.items() if model == 'dashboard'
+                                          for dashcard in definition.get('dashcards') or [] if dashcard.get('card_id') is not None)
+    return { 'source_collection_id': source_collection_id, 'contents': contents, 'definitions': definitions, 
+             'counts': counts, 'skipped': skipped, 'estimated_requests': estimated_requests }
+
+
+
 def copy_collection(self, source_collection_name=None, source_collection_id=None, 
                     destination_collection_name=None,
                     destination_parent_collection_name=None, destination_parent_collection_id=None, 
-                    deepcopy_dashboards=False, postfix='', child_items_postfix='', verbose=False):
+                    deepcopy_dashboards=False, postfix='', child_items_postfix='', verbose=False, concurrency=1, 
+                    journal_path=None, dry_run=False, prefetch_concurrency=4):
     """
     Copy the collection with the given name/id into the given destination parent collection. 
+    The copy is planned first (see plan_collection_copy): the contents of the collection and all its sub-collections 
+    are found upfront (from the collection tree and one GET /api/collection/:id/items per collection) and the definitions 
+    of the cards and pulses are fetched, so copying only sends POST requests.
 
     Parameters
     ----------
@@ -194,6 +385,17 @@ def copy_collection(self, source_collection_name=None, source_collection_id=None
     postfix : if destination_collection_name is None, adds this string to the end of source_collection_name to make destination_collection_name.
     child_items_postfix : this string is added to the end of the child items' names, when saving them in the destination (default '').
     verbose : prints extra information (default False) 
+    concurrency : number of cards, dashboards and pulses copied at the same time, using a pool of threads (default 1). 
+                  The sub-collections are always created before their contents are copied.
+    journal_path : path of a journal file where every copied item is recorded as soon as it is created (default None). 
+                   If the copy is interrupted, running it again with the same journal_path skips the items that were 
+                   already copied (without fetching their definitions again) and continues with the rest (see CopyJournal).
+    dry_run : if True, nothing is copied and the plan of the copy is returned (see plan_collection_copy) (default False).
+    prefetch_concurrency : number of definitions fetched at the same time by the plan (default 4)
+
+    Returns a report: {'collection_id': id of the new collection, 
+                       'copied': [{'model', 'source_id', 'destination_id', 'name'} for every copied item, in the order of completion],
+                       'resumed': [the same for the items found in the journal (that were not copied again)]}
     """
     ### making sure we have the data that we need 
     if not source_collection_id:
@@ -217,63 +419,136 @@ def copy_collection(self, source_collection_name=None, source_collection_id=None
             source_collection_name = self.get_item_name(item_type='collection', item_id=source_collection_id)
         destination_collection_name = source_collection_name + postfix
 
-    ### create a collection in the destination to hold the contents of the source collection
-    res = self.create_collection(destination_collection_name, 
-                                    parent_collection_id=destination_parent_collection_id, 
-                                    parent_collection_name=destination_parent_collection_name,
-                                    return_results=True
-                                )
-    destination_collection_id = res['id']    
-
-    ### get the items to copy
-    items = self.get('/api/collection/{}/items'.format(source_collection_id))
-    if type(items) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
-        items = items['data']
-
-    ### copy the items of the source collection to the new collection
-    for item in items:
+    ### open the journal of the copy, if any (a dry run only reads an existing journal)
+    journal = CopyJournal(journal_path) if journal_path and (not dry_run or os.path.exists(journal_path)) else None
+    report = { 'collection_id': None, 'copied': [], 'resumed': [] }
+    try:
+        ### get the items to copy (for the whole subtree) and the definitions of the cards and pulses 
+        ### (except for the items the journal shows were copied by an interrupted copy)
+        skip = [ (entry['model'], entry['source_id']) for entry in journal.entries() ] if journal else None
+        plan = self.plan_collection_copy(source_collection_id=source_collection_id, concurrency=prefetch_concurrency, 
+                                         deepcopy_dashboards=deepcopy_dashboards, skip=skip)
+        if dry_run:
+            plan['destination_collection_name'] = destination_collection_name
+            return plan
+        contents = plan['contents']
+        copy_options = { 'child_items_postfix': child_items_postfix, 'deepcopy_dashboards': deepcopy_dashboards, 
+                         'verbose': verbose, 'journal': journal, 'definitions': plan['definitions'] }
+
+        ### create a collection in the destination to hold the contents of the source collection
+        ### (unless the journal shows it was created by an interrupted copy)
+        entry = _get_journal_entry(journal, report, 'collection', source_collection_id)
+        if entry is None:
+            res = self.create_collection(destination_collection_name, 
+                                            parent_collection_id=destination_parent_collection_id, 
+                                            parent_collection_name=destination_parent_collection_name,
+                                            return_results=True
+                                        )
+            entry = _record_copy(journal, report, 'collection', source_collection_id, res['id'], destination_collection_name)
+        destination_collection_id = entry['destination_id']
+        report['collection_id'] = destination_collection_id
+
+        ### copy the items of the source collection and its sub-collections to the new collection
+        if concurrency <= 1:
+            self._copy_collection_items(source_collection_id, destination_collection_id, contents, report, 
+                                        lambda item, collection_id: self._copy_collection_item(item, collection_id, report, **copy_options),
+                                        **copy_options)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            futures = []
+            try:
+                self._copy_collection_items(source_collection_id, destination_collection_id, contents, report, 
+                                            lambda item, collection_id: futures.append(executor.submit(self._copy_collection_item, 
+                                                                                                      item, collection_id, report, **copy_options)), 
+                                            **copy_options)
+                for future in futures:
+                    future.result()  # raise the error of a failed copy
+            finally:
+                # cancel the copies not started yet (by hand, as shutdown(cancel_futures=True) needs Python 3.9)
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+    finally:
+        if journal:
+            journal.close()
+    return report
+
+
+
+def _copy_collection_items(self, source_collection_id, destination_collection_id, contents, report, copy_item, 
+                           child_items_postfix='', deepcopy_dashboards=False, verbose=False, journal=None, definitions=None):
+    """
+    Create the sub-collections of the source collection (recursively) in the destination collection 
+    and pass the other items (with the id of the collection to copy them to) to copy_item.
+    """
+    for item in contents[source_collection_id]:
 
-        ## copy a collection
+        ## copy a collection (before its contents)
         if item['model'] == 'collection':
-            collection_id = item['id']
-            collection_name = item['name'] 
-            destination_collection_name = collection_name + child_items_postfix
-            self.verbose_print(verbose, 'Copying the collection "{}" ...'.format(collection_name))
-            self.copy_collection(source_collection_id=collection_id,
-                                    destination_parent_collection_id=destination_collection_id,
-                                    child_items_postfix=child_items_postfix,
-                                    deepcopy_dashboards=deepcopy_dashboards,
-                                    verbose=verbose)
-
-        ## copy a dashboard
-        if item['model'] == 'dashboard':
-            dashboard_id = item['id']
-            dashboard_name = item['name']
-            destination_dashboard_name = dashboard_name + child_items_postfix
-            self.verbose_print(verbose, 'Copying the dashboard "{}" ...'.format(dashboard_name))
-            self.copy_dashboard(source_dashboard_id=dashboard_id,
-                                destination_collection_id=destination_collection_id,
-                                destination_dashboard_name=destination_dashboard_name,
-                                deepcopy=deepcopy_dashboards)
-
-        ## copy a card
-        if item['model'] == 'card':
-            card_id = item['id']
-            card_name = item['name']
-            destination_card_name = card_name + child_items_postfix
-            self.verbose_print(verbose, 'Copying the card "{}" ...'.format(card_name))
-            self.copy_card(source_card_id=card_id,
-                            destination_collection_id=destination_collection_id,
-                            destination_card_name=destination_card_name)
-
-        ## copy a pulse
-        if item['model'] == 'pulse':
-            pulse_id = item['id']
-            pulse_name = item['name']
-            destination_pulse_name = pulse_name + child_items_postfix
-            self.verbose_print(verbose, 'Copying the pulse "{}" ...'.format(pulse_name))
-            self.copy_pulse(source_pulse_id=pulse_id,
-                            destination_collection_id=destination_collection_id,
-                            destination_pulse_name=destination_pulse_name)
-
-
+            entry = _get_journal_entry(journal, report, 'collection', item['id'])
+            if entry is None:
+                destination_name = item['name'] + child_items_postfix
+                self.verbose_print(verbose, 'Copying the collection "{}" ...'.format(item['name']))
+                res = self.create_collection(destination_name, parent_collection_id=destination_collection_id, return_results=True)
+                entry = _record_copy(journal, report, 'collection', item['id'], res['id'], destination_name)
+            self._copy_collection_items(item['id'], entry['destination_id'], contents, report, copy_item, 
+                                        child_items_postfix=child_items_postfix, 
+                                        deepcopy_dashboards=deepcopy_dashboards, 
+                                        verbose=verbose,
+                                        journal=journal,
+                                        definitions=definitions)
+
+        ## copy a dashboard, card or pulse
+        else:
+            copy_item(item, destination_collection_id)
+
+
+
+def _copy_collection_item(self, item, destination_collection_id, report, child_items_postfix='', deepcopy_dashboards=False, 
+                          verbose=False, journal=None, definitions=None):
+    """Copy a dashboard, card or pulse of a collection (see copy_collection) and add it to the report (and the journal)"""
+    if _get_journal_entry(journal, report, item['model'], item['id']) is not None:
+        return
+    destination_name = item['name'] + child_items_postfix
+    self.verbose_print(verbose, 'Copying the {} "{}" ...'.format(item['model'], item['name']))
+    definition = (definitions or {}).get((item['model'], item['id']))
+    definition = dict(definition) if definition else None  # the plan is not modified
+
+    if item['model'] == 'dashboard':
+        destination_id = self.copy_dashboard(source_dashboard_id=item['id'],
+                                             destination_collection_id=destination_collection_id,
+                                             destination_dashboard_name=destination_name,
+                                             deepcopy=deepcopy_dashboards)
+    elif item['model'] == 'card':
+        destination_id = self.copy_card(source_card_id=item['id'],
+                                        destination_collection_id=destination_collection_id,
+                                        destination_card_name=destination_name,
+                                        _source_card=definition)
+    elif item['model'] == 'pulse':
+        destination_id = self.copy_pulse(source_pulse_id=item['id'],
+                                         destination_collection_id=destination_collection_id,
+                                         destination_pulse_name=destination_name,
+                                         _source_pulse=definition)
+    else:
+        return
+
+    _record_copy(journal, report, item['model'], item['id'], destination_id, destination_name)
+
+
+
+def _get_journal_entry(journal, report, model, source_id):
+    """Return the journal entry of an item that was already copied (and add it to the report), otherwise None"""
+    entry = journal.get(model, source_id) if journal else None
+    if entry is not None:
+        report['resumed'].append(entry)
+    return entry
+
+
+
+def _record_copy(journal, report, model, source_id, destination_id, name):
+    entry = { 'model': model, 'source_id': source_id, 'destination_id': destination_id, 'name': name }
+    if journal:
+        journal.record(entry)
+    report['copied'].append(entry)
+    return entry
@@ -1,9 +1,15 @@
+import asyncio
+import os
+from ._copy_journal import CopyJournal
+from .copy_methods import _get_journal_entry, _record_copy, _get_dashboard_card_names, _get_dashboard_layout, \
+    _get_plan_items, _make_plan
+
 
 async def copy_card(self, source_card_name=None, source_card_id=None, 
                 source_collection_name=None, source_collection_id=None,
                 destination_card_name=None, 
                 destination_collection_name=None, destination_collection_id=None,
-                postfix='', verbose=False, return_card=False):
+                postfix='', verbose=False, return_card=False, _source_card=None):
     """
     Async version of copy_card.
     Copy the card with the given name/id to the given destination collection.
@@ -29,8 +35,8 @@ async def copy_card(self, source_card_name=None, source_card_id=None,
             source_card_name = await self.get_item_name(item_type='card', item_id=source_card_id)
         destination_card_name = source_card_name + postfix
 
-    # Get the source card info
-    source_card = await self.get(f'/api/card/{source_card_id}')
+    # Get the source card info (unless it was fetched in advance, see plan_collection_copy)
+    source_card = _source_card or await self.get(f'/api/card/{source_card_id}')
 
     # Update the name and collection_id
     card_json = source_card
@@ -50,7 +56,7 @@ async def copy_card(self, source_card_name=None, source_card_id=None,
 async def copy_pulse(self, source_pulse_name=None, source_pulse_id=None, 
                 source_collection_name=None, source_collection_id=None,
                 destination_pulse_name=None, 
-                destination_collection_id=None, destination_collection_name=None, postfix=''):
+                destination_collection_id=None, destination_collection_name=None, postfix='', _source_pulse=None):
     """
     Async version of copy_pulse.
     Copy the pulse with the given name/id to the given destination collection.
@@ -75,8 +81,8 @@ async def copy_pulse(self, source_pulse_name=None, source_pulse_id=None,
             source_pulse_name = await self.get_item_name(item_type='pulse', item_id=source_pulse_id)
         destination_pulse_name = source_pulse_name + postfix
 
-    # Get the source pulse info
-    source_pulse = await self.get(f'/api/pulse/{source_pulse_id}')
+    # Get the source pulse info (unless it was fetched in advance, see plan_collection_copy)
+    source_pulse = _source_pulse or await self.get(f'/api/pulse/{source_pulse_id}')
 
     # Update the name and collection_id
     pulse_json = source_pulse
@@ -84,17 +90,24 @@ async def copy_pulse(self, source_pulse_name=None, source_pulse_id=None,
     pulse_json['name'] = destination_pulse_name
 
     # Save as a new pulse
-    await self.post('/api/pulse', json=pulse_json)
+    res = await self.post('/api/pulse', 'raw', json=pulse_json)
+    self.invalidate_cache('pulse')
+    if res.status_code != 200:
+        raise ValueError(f'Error copying the pulse: {res.text}')
+    return res.json()['id']
 
 
 async def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=None, 
                     source_collection_name=None, source_collection_id=None,
                     destination_dashboard_name=None, 
                     destination_collection_name=None, destination_collection_id=None,
-                    deepcopy=False, postfix='', collection_position=1, description=''):
+                    deepcopy=False, postfix='', collection_position=1, description='', 
+                    client_side=False, cards_collection_id=None, concurrency=4):
     """
     Async version of copy_dashboard.
     Copy the dashboard with the given name/id to the given destination collection.
+    With deepcopy and client_side, every distinct card is duplicated once (up to `concurrency` at the same time) 
+    and the dashcards are written in a single update (see copy_dashboard).
     """
     # Making sure we have the data that we need 
     if not source_dashboard_id:
@@ -116,6 +129,10 @@ async def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=N
             source_dashboard_name = await self.get_item_name(item_type='dashboard', item_id=source_dashboard_id)
         destination_dashboard_name = source_dashboard_name + postfix
 
+    if deepcopy and client_side:
+        return await self._deepcopy_dashboard(source_dashboard_id, destination_dashboard_name, destination_collection_id, 
+                                              cards_collection_id, concurrency, collection_position, description)
+
     parameters = {
         'collection_id': destination_collection_id, 
         'name': destination_dashboard_name, 
@@ -125,21 +142,111 @@ async def copy_dashboard(self, source_dashboard_name=None, source_dashboard_id=N
     }
     
     res = await self.post(f'/api/dashboard/{source_dashboard_id}/copy', 'raw', json=parameters)
-    if res.status != 200:
-        raise ValueError(f'Error copying the dashboard: {await res.text()}')
+    self.invalidate_cache('dashboard')
+    if deepcopy:  # the duplicated cards are saved in a new collection
+        self.invalidate_cache('card')
+        self.invalidate_cache('collection')
+    if res.status_code != 200:
+        raise ValueError(f'Error copying the dashboard: {res.text}')
     
-    data = await res.json()
+    data = res.json()
     dup_dashboard_id = data['id']
     return dup_dashboard_id
 
 
+async def _deepcopy_dashboard(self, source_dashboard_id, destination_dashboard_name, destination_collection_id, 
+                              cards_collection_id=None, concurrency=4, collection_position=1, description=''):
+    """Async version of _deepcopy_dashboard"""
+    dashboard = await self.get(f'/api/dashboard/{source_dashboard_id}')
+    if not dashboard:
+        raise ValueError(f'There is no dashboard with the id "{source_dashboard_id}"')
+    card_names = _get_dashboard_card_names(dashboard)
+
+    # Duplicate every distinct card of the dashboard once
+    if card_names and not cards_collection_id:
+        res = await self.create_collection(f"{destination_dashboard_name}'s cards", 
+                                           parent_collection_id=destination_collection_id, return_results=True)
+        cards_collection_id = res['id']
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def copy(card_id):
+        async with semaphore:
+            return await self.copy_card(
+                source_card_id=card_id, 
+                destination_collection_id=cards_collection_id, 
+                destination_card_name=card_names[card_id]
+            )
+
+    new_card_ids = await asyncio.gather(*[copy(card_id) for card_id in card_names])
+    card_id_mapping = dict(zip(card_names, new_card_ids))
+
+    # Create the dashboard and write its tabs and dashcards (using the new cards) in a single update
+    res = await self.post('/api/dashboard/', 'raw', json={
+        'name': destination_dashboard_name, 
+        'collection_id': destination_collection_id, 
+        'collection_position': collection_position,
+        'description': description or None, 
+        'parameters': dashboard.get('parameters') or []
+    })
+    self.invalidate_cache('dashboard')
+    if res.status_code != 200:
+        raise ValueError(f'Error copying the dashboard: {res.text}')
+    dup_dashboard_id = res.json()['id']
+
+    res = await self.put(f'/api/dashboard/{dup_dashboard_id}', 'raw', json=_get_dashboard_layout(dashboard, card_id_mapping))
+    if res.status_code != 200:
+        raise ValueError(f'Error copying the dashcards of the dashboard (this needs Metabase v0.47 or newer): {res.text}')
+    return dup_dashboard_id
+
+
+async def plan_collection_copy(self, source_collection_name=None, source_collection_id=None, concurrency=4, 
+                               deepcopy_dashboards=False, skip=None):
+    """
+    Async version of plan_collection_copy.
+    Find the contents of the collection and all its sub-collections and fetch the definitions of their cards and pulses 
+    (and dashboards with deepcopy_dashboards), up to `concurrency` at the same time, except for the items in skip. 
+    Returns {'source_collection_id', 'contents', 'definitions', 'counts', 'skipped', 'estimated_requests'}.
+    """
+    if not source_collection_id:
+        if not source_collection_name:
+            raise ValueError('Either the name or id of the source collection must be provided.')
+        else:
+            source_collection_id = await self.get_item_id('collection', source_collection_name)
+
+    contents = await self._get_collection_contents(source_collection_id, concurrency)
+    counts, skipped, items = _get_plan_items(source_collection_id, contents, deepcopy_dashboards, skip)
+
+    # Fetch the definitions of the cards and pulses (and of the dashboards, to count the cards duplicated by a deepcopy)
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def fetch(item):
+        async with semaphore:
+            return await self.get(f'/api/{item["model"]}/{item["id"]}')
+
+    results = await asyncio.gather(*[fetch(item) for item in items])
+
+    definitions = {}
+    for item, definition in zip(items, results):
+        if not definition:
+            raise ValueError(f'There is no {item["model"]} with the id "{item["id"]}"')
+        definitions[(item['model'], item['id'])] = definition
+
+    return _make_plan(source_collection_id, contents, definitions, counts, skipped, deepcopy_dashboards)
+
+
 async def copy_collection(self, source_collection_name=None, source_collection_id=None, 
                     destination_collection_name=None,
                     destination_parent_collection_name=None, destination_parent_collection_id=None, 
-                    deepcopy_dashboards=False, postfix='', child_items_postfix='', verbose=False):
+                    deepcopy_dashboards=False, postfix='', child_items_postfix='', verbose=False, concurrency=1, 
+                    journal_path=None, dry_run=False, prefetch_concurrency=4):
     """
     Async version of copy_collection.
     Copy the collection with the given name/id into the given destination parent collection.
+    The copy is planned first (see plan_collection_copy), so copying only sends POST requests. Up to `concurrency` cards, 
+    dashboards and pulses are copied at the same time; the sub-collections are created before their contents.
+    With journal_path, the copied items are recorded in a journal so an interrupted copy can be resumed (see CopyJournal).
+    The plan fetches up to `prefetch_concurrency` definitions at the same time. With dry_run=True, nothing is copied and the plan of the copy is returned.
+    Returns a report: {'collection_id', 'copied': [{'model', 'source_id', 'destination_id', 'name'}], 'resumed': [...]}
     """
     # Making sure we have the data that we need 
     if not source_collection_id:
@@ -163,69 +270,120 @@ async def copy_collection(self, source_collection_name=None, source_collection_i
             source_collection_name = await self.get_item_name(item_type='collection', item_id=source_collection_id)
         destination_collection_name = source_collection_name + postfix
 
-    # Create a collection in the destination to hold the contents of the source collection
-    res = await self.create_collection(
-        destination_collection_name, 
-        parent_collection_id=destination_parent_collection_id, 
-        parent_collection_name=destination_parent_collection_name,
-        return_results=True
-    )
-    destination_collection_id = res['id']    
-
-    # Get the items to copy
-    items = await self.get(f'/api/collection/{source_collection_id}/items')
-    if type(items) == dict:  # in Metabase version *.40.0 the format of the returned result for this endpoint changed
-        items = items['data']
-
-    # Copy the items of the source collection to the new collection
-    for item in items:
-        # Copy a collection
-        if item['model'] == 'collection':
-            collection_id = item['id']
-            collection_name = item['name'] 
-            destination_collection_name = collection_name + child_items_postfix
-            self.verbose_print(verbose, f'Copying the collection "{collection_name}" ...')
-            await self.copy_collection(
-                source_collection_id=collection_id,
-                destination_parent_collection_id=destination_collection_id,
-                child_items_postfix=child_items_postfix,
-                deepcopy_dashboards=deepcopy_dashboards,
-                verbose=verbose
-            )
+    # Open the journal of the copy, if any (a dry run only reads an existing journal)
+    journal = CopyJournal(journal_path) if journal_path and (not dry_run or os.path.exists(journal_path)) else None
+    report = {'collection_id': None, 'copied': [], 'resumed': []}
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    tasks = []
+    copy_options = {}
 
-        # Copy a dashboard
-        if item['model'] == 'dashboard':
-            dashboard_id = item['id']
-            dashboard_name = item['name']
-            destination_dashboard_name = dashboard_name + child_items_postfix
-            self.verbose_print(verbose, f'Copying the dashboard "{dashboard_name}" ...')
-            await self.copy_dashboard(
-                source_dashboard_id=dashboard_id,
-                destination_collection_id=destination_collection_id,
-                destination_dashboard_name=destination_dashboard_name,
-                deepcopy=deepcopy_dashboards
-            )
+    async def copy_item(item, collection_id):
+        async with semaphore:
+            await self._copy_collection_item(item, collection_id, report, **copy_options)
+
+    async def schedule_item(item, collection_id):
+        if concurrency <= 1:
+            await copy_item(item, collection_id)
+        else:
+            tasks.append(asyncio.ensure_future(copy_item(item, collection_id)))
+
+    try:
+        # Get the items to copy (for the whole subtree) and the definitions of the cards and pulses
+        # (except for the items the journal shows were copied by an interrupted copy)
+        skip = [(entry['model'], entry['source_id']) for entry in journal.entries()] if journal else None
+        plan = await self.plan_collection_copy(source_collection_id=source_collection_id, concurrency=prefetch_concurrency, 
+                                               deepcopy_dashboards=deepcopy_dashboards, skip=skip)
+        if dry_run:
+            plan['destination_collection_name'] = destination_collection_name
+            return plan
+        contents = plan['contents']
+        copy_options.update({'child_items_postfix': child_items_postfix, 'deepcopy_dashboards': deepcopy_dashboards, 
+                             'verbose': verbose, 'journal': journal, 'definitions': plan['definitions']})
 
-        # Copy a card
-        if item['model'] == 'card':
-            card_id = item['id']
-            card_name = item['name']
-            destination_card_name = card_name + child_items_postfix
-            self.verbose_print(verbose, f'Copying the card "{card_name}" ...')
-            await self.copy_card(
-                source_card_id=card_id,
-                destination_collection_id=destination_collection_id,
-                destination_card_name=destination_card_name
+        # Create a collection in the destination to hold the contents of the source collection
+        # (unless the journal shows it was created by an interrupted copy)
+        entry = _get_journal_entry(journal, report, 'collection', source_collection_id)
+        if entry is None:
+            res = await self.create_collection(
+                destination_collection_name, 
+                parent_collection_id=destination_parent_collection_id, 
+                parent_collection_name=destination_parent_collection_name,
+                return_results=True
             )
+            entry = _record_copy(journal, report, 'collection', source_collection_id, res['id'], destination_collection_name)
+        destination_collection_id = entry['destination_id']
+        report['collection_id'] = destination_collection_id
+
+        # Copy the items of the source collection and its sub-collections to the new collection
+        await self._copy_collection_items(source_collection_id, destination_collection_id, contents, report, 
+                                          schedule_item, **copy_options)
+        await asyncio.gather(*tasks)  # raise the error of a failed copy
+    finally:
+        for task in tasks:
+            task.cancel()
+        if journal:
+            journal.close()
+    return report
 
-        # Copy a pulse
-        if item['model'] == 'pulse':
-            pulse_id = item['id']
-            pulse_name = item['name']
-            destination_pulse_name = pulse_name + child_items_postfix
-            self.verbose_print(verbose, f'Copying the pulse "{pulse_name}" ...')
-            await self.copy_pulse(
-                source_pulse_id=pulse_id,
-                destination_collection_id=destination_collection_id,
-                destination_pulse_name=destination_pulse_name
+
+async def _copy_collection_items(self, source_collection_id, destination_collection_id, contents, report, copy_item, 
+                                 child_items_postfix='', deepcopy_dashboards=False, verbose=False, journal=None, definitions=None):
+    """Async version of _copy_collection_items"""
+    for item in contents[source_collection_id]:
+        # Copy a collection (before its contents)
+        if item['model'] == 'collection':
+            entry = _get_journal_entry(journal, report, 'collection', item['id'])
+            if entry is None:
+                destination_name = item['name'] + child_items_postfix
+                self.verbose_print(verbose, f'Copying the collection "{item["name"]}" ...')
+                res = await self.create_collection(destination_name, parent_collection_id=destination_collection_id, return_results=True)
+                entry = _record_copy(journal, report, 'collection', item['id'], res['id'], destination_name)
+            await self._copy_collection_items(
+                item['id'], entry['destination_id'], contents, report, copy_item, 
+                child_items_postfix=child_items_postfix, 
+                deepcopy_dashboards=deepcopy_dashboards, 
+                verbose=verbose,
+                journal=journal,
+                definitions=definitions
             )
+
+        # Copy a dashboard, card or pulse
+        else:
+            await copy_item(item, destination_collection_id)
+
+
+async def _copy_collection_item(self, item, destination_collection_id, report, child_items_postfix='', deepcopy_dashboards=False, 
+                                verbose=False, journal=None, definitions=None):
+    """Async version of _copy_collection_item"""
+    if _get_journal_entry(journal, report, item['model'], item['id']) is not None:
+        return
+    destination_name = item['name'] + child_items_postfix
+    self.verbose_print(verbose, f'Copying the {item["model"]} "{item["name"]}" ...')
+    definition = (definitions or {}).get((item['model'], item['id']))
+    definition = dict(definition) if definition else None  # the plan is not modified
+
+    if item['model'] == 'dashboard':
+        destination_id = await self.copy_dashboard(
+            source_dashboard_id=item['id'],
+            destination_collection_id=destination_collection_id,
+            destination_dashboard_name=destination_name,
+            deepcopy=deepcopy_dashboards
+        )
+    elif item['model'] == 'card':
+        destination_id = await self.copy_card(
+            source_card_id=item['id'],
+            destination_collection_id=destination_collection_id,
+            destination_card_name=destination_name,
+            _source_card=definition
+        )
+    elif item['model'] == 'pulse':
+        destination_id = await self.copy_pulse(
+            source_pulse_id=item['id'],
+            destination_collection_id=destination_collection_id,
+            destination_pulse_name=destination_name,
+            _source_pulse=definition
+        )
+    else:
+        return
+
+    _record_copy(journal, report, item['model'], item['id'], destination_id, destination_name)
@@ -1,3 +1,6 @@
+from ._item_index import ItemIndex
+
+
 
 def create_card(self, card_name=None, collection_name=None, collection_id=None, 
                 db_name=None, db_id=None, table_name=None,    table_id=None, 
@@ -61,6 +64,7 @@ def create_card(self, card_name=None, collection_name=None, collection_id=None,
 
             # Create the card using only the provided custom_json 
             res = self.post("/api/card/", json=custom_json)
+            self.invalidate_cache('card')
             if res and not res.get('error'):
                 self.verbose_print(verbose, 'The card was created successfully.')
                 return res if return_card else None
@@ -104,29 +108,9 @@ def create_card(self, card_name=None, collection_name=None, collection_id=None,
     elif column_order == 'db_table_order':  # default
 
         ### find the actual order of columns in the table as they appear in the database
-        # Create a temporary card for retrieving column ordering
-        json_str = """{{'dataset_query': {{ 'database': {1},
-                                            'native': {{'query': 'SELECT * from "{2}";' }},
-                                            'type': 'native' }},
-                        'display': 'table',
-                        'name': '{0}',
-                        'visualization_settings': {{}} }}""".format(card_name, db_id, table_name)
-
-        res = self.post("/api/card/", json=eval(json_str))    
-        if not res:
-            print('Card Creation Failed!')
-            return res
-        ordered_columns = [ i['name'] for i in res['result_metadata'] ]  # retrieving the column ordering
-
-        # Delete the temporary card
-        card_id = res['id']
-        self.delete("/api/card/{}".format(card_id))    
-
-        column_name_id_dict = self.get_columns_name_id(db_id=db_id, 
-                                                        table_id=table_id, 
-                                                        table_name=table_name, 
-                                                        verbose=verbose)
-        column_id_list = [ column_name_id_dict[i] for i in ordered_columns ]
+        # using the positions in the metadata of the table (cached per table), so no query is run
+        fields = sorted(self._get_table_fields(table_id), key=_get_field_position)
+        column_id_list = [ i['id'] for i in fields ]
         column_id_list_str = [ ['field-id', i] for i in column_id_list ]
 
     elif column_order == 'alphabetical':
@@ -157,6 +141,7 @@ def create_card(self, card_name=None, collection_name=None, collection_id=None,
             json[key] = value
 
     res = self.post("/api/card/", json=json)
+    self.invalidate_cache('card')
 
     # Get collection_name to be used in the final message
     if not collection_name:
@@ -175,6 +160,81 @@ def create_card(self, card_name=None, collection_name=None, collection_id=None,
 
 
 
+def create_cards(self, template, substitutions, concurrency=4, verbose=False):
+    """
+    Create many similar cards (e.g. one card per KPI table) from a template. The ids of all the tables, DBs, collections
+    and columns are resolved in a single pass (one listing per item type and one metadata request per table) and
+    the cards are created using up to `concurrency` threads.
+
+    Parameters
+    ----------
+    template : dictionary of the arguments of create_card that are the same for all the cards 
+               (card_name, collection_name, collection_id, db_name, db_id, table_name, table_id, column_order, custom_json)
+    substitutions : list of dictionaries of the arguments of each card, replacing the ones of the template 
+                    (a 'custom_json' is merged into the 'custom_json' of the template)
+    concurrency : number of cards created at the same time (default 4)
+    verbose : whether to print extra information (default False)
+
+    Returns a list of {'index', 'substitution', 'card', 'error'} dictionaries, one per substitution (in the same order),
+    where 'card' is the created card. A failed card does not stop the others: its 'error' is the raised exception (and 'card' is None).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    cards = [ _get_template_args(template, substitution) for substitution in substitutions ]
+    results = [ {'index': index, 'substitution': substitution, 'card': None, 'error': None} 
+                for index, substitution in enumerate(substitutions) ]
+
+    ### resolve the names of all the cards in one pass
+    items = _get_template_items(cards)
+    item_types = { item[0] for item in items }
+    if any(not args['db_id'] and not _is_complete_json(args['custom_json']) for args in cards):
+        item_types.add('table')  # for finding the DB of the tables
+    indexes = { item_type: self._get_item_index(item_type) for item_type in item_types }
+    resolved = ItemIndex.resolve(indexes, items)
+    tables = { i['id']: i for records in indexes.get('table', {}).values() for i in records }
+
+    ids = {}  # index -> (db_id, table_id, collection_id)
+    for index, args in enumerate(cards):
+        try:
+            ids[index] = _get_template_ids(args, resolved, tables)
+        except Exception as e:
+            results[index]['error'] = e
+
+    ### get the fields of the tables (in the order of the columns)
+    table_IDs = sorted({ ids[index][1] for index in ids if _needs_fields(cards[index]) })
+    fetch = lambda table_id: self._get_table_fields(table_id)
+    table_fields = {}
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        for table_id, future in [ (table_id, executor.submit(fetch, table_id)) for table_id in table_IDs ]:
+            try:
+                table_fields[table_id] = future.result()
+            except Exception as e:
+                table_fields[table_id] = e
+
+    ### create the cards
+    def create(index):
+        try:
+            db_id, table_id, collection_id = ids[index]
+            fields = table_fields.get(table_id)
+            if isinstance(fields, Exception):
+                raise fields
+            card_json = _make_template_card_json(cards[index], db_id, table_id, collection_id, fields)
+            res = self.post('/api/card/', json=card_json)
+            if not res or res.get('error'):
+                raise ValueError('Error creating the card "{}": {}'.format(card_json['name'], res))
+            self.verbose_print(verbose, "The card '{}' was created successfully.".format(card_json['name']))
+            results[index]['card'] = res
+        except Exception as e:
+            results[index]['error'] = e
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        list(executor.map(create, sorted(ids)))
+    self.invalidate_cache('card')
+
+    return results
+
+
+
 def create_collection(self, collection_name, parent_collection_id=None, parent_collection_name=None, return_results=False):
     """
     Create an empty collection, in the given location, utilizing the endpoint 'POST /api/collection/'. 
@@ -196,6 +256,7 @@ def create_collection(self, collection_name, parent_collection_id=None, parent_c
             parent_collection_id = self.get_item_id('collection', parent_collection_name)
 
     res = self.post('/api/collection', json={'name':collection_name, 'parent_id':parent_collection_id, 'color':'#509EE3'})
+    self.invalidate_cache('collection')
     if return_results:
         return res
 
@@ -223,11 +284,8 @@ def create_segment(self, segment_name, column_name, column_values, segment_descr
         raise ValueError('Either the name or id of the table must be provided.')
     if not table_id:
         table_id = self.get_item_id('table', table_name, db_id=db_id, db_name=db_name)
-    if not table_name:
-        table_name = self.get_item_name(item_type='table', item_id=table_id)
-    db_id = self.get_db_id_from_table_id(table_id)
 
-    colmuns_name_id_mapping = self.get_columns_name_id(table_name=table_name, db_id=db_id)
+    colmuns_name_id_mapping = self.get_columns_name_id(table_id=table_id)
     column_id = colmuns_name_id_mapping[column_name]
 
     # Create a segment blueprint
@@ -241,7 +299,122 @@ def create_segment(self, segment_name, column_name, column_values, segment_descr
 
     # Create the segment
     res = self.post('/api/segment/', json=segment_blueprint)
+    self.invalidate_cache('segment')
     if return_segment:
         return res
 
 
+
+def _get_field_position(field):
+    '''Sort key for the fields of a table, in the order of the columns in the database table'''
+    position = field['database_position'] if field.get('database_position') is not None else field.get('position')
+    return (position is None, position or 0, field['id'])
+
+
+
+def _get_template_args(template, substitution):
+    '''The create_card arguments of a card of create_cards: the template with the substitution applied'''
+    args = { key: None for key in ['card_name', 'collection_name', 'collection_id', 'db_name', 'db_id', 'table_name', 'table_id'] }
+    args['column_order'] = 'db_table_order'
+    for key, value in list(template.items()) + list(substitution.items()):
+        if key not in args and key != 'custom_json':
+            raise ValueError("'{}' is not an argument of create_card".format(key))
+    args.update({ key: value for key, value in template.items() if key != 'custom_json' })
+    args.update({ key: value for key, value in substitution.items() if key != 'custom_json' })
+    args['custom_json'] = dict(template.get('custom_json') or {}, **(substitution.get('custom_json') or {}))
+    return args
+
+
+
+def _get_template_items(cards):
+    '''The (item_type, item_name[, scope]) tuples to resolve for the cards of create_cards (see resolve_item_ids)'''
+    items = set()
+    for args in cards:
+        if not args['collection_id'] and args['collection_name']:
+            items.add(('collection', args['collection_name']))
+        if not _is_complete_json(args['custom_json']) and not args['table_id'] and args['table_name']:
+            db = args['db_id'] or args['db_name']
+            items.add(('table', args['table_name'], db) if db else ('table', args['table_name']))
+    return sorted(items, key=str)
+
+
+
+def _get_template_ids(args, resolved, tables):
+    '''Return (db_id, table_id, collection_id) for a card of create_cards, using the resolved names'''
+    def get_id(item):
+        if item in resolved['ids']:
+            return resolved['ids'][item]
+        if item in resolved['ambiguous']:
+            raise ValueError('There is more than one {} with the name "{}"'.format(item[0], item[1]))
+        raise ValueError('There is no {} with the name "{}"'.format(item[0], item[1]))
+
+    collection_id = args['collection_id']
+    if not collection_id and args['collection_name']:
+        collection_id = get_id(('collection', args['collection_name']))
+    if _is_complete_json(args['custom_json']):
+        return None, None, collection_id
+
+    if not args['card_name'] and not args['custom_json'].get('name'):
+        raise ValueError("A name must be provided for the card (either as card_name argument or as part of the custom_json ('name' key)).")
+    table_id = args['table_id']
+    if not table_id:
+        if not args['table_name']:
+            raise ValueError('Either the name or id of the table must be provided.')
+        db = args['db_id'] or args['db_name']
+        table_id = get_id(('table', args['table_name'], db) if db else ('table', args['table_name']))
+    db_id = args['db_id']
+    if not db_id:
+        if table_id not in tables:
+            raise ValueError('There is no table with the id "{}"'.format(table_id))
+        db_id = tables[table_id]['db_id']
+    return db_id, table_id, collection_id
+
+
+
+def _needs_fields(args):
+    return not _is_complete_json(args['custom_json']) and args['column_order'] != 'alphabetical'
+
+
+
+def _is_complete_json(custom_json):
+    return all(key in custom_json for key in ['name', 'dataset_query', 'display'])
+
+
+
+def _make_template_card_json(args, db_id, table_id, collection_id, fields):
+    '''The json for creating a card of create_cards (the same as create_card would make)'''
+    custom_json = dict(args['custom_json'])
+    if custom_json.get('description') == '':  # Fix for the issue #10
+        custom_json['description'] = None
+
+    if _is_complete_json(custom_json):
+        card_json = dict({'visualization_settings': {}}, **custom_json)
+        if args['card_name'] is not None:
+            card_json['name'] = args['card_name']
+        if collection_id:
+            card_json['collection_id'] = collection_id
+        return card_json
+
+    column_order = args['column_order']
+    if type(column_order) == list:
+        column_name_id_dict = { i['name']: i['id'] for i in fields }
+        for column_name in column_order:
+            if column_name not in column_name_id_dict:
+                raise ValueError('The column name {} is not in the table {}'.format(column_name, args['table_name'] or table_id))
+        field_ids = [ ['field-id', column_name_id_dict[i]] for i in column_order ]
+    elif column_order == 'db_table_order':
+        field_ids = [ ['field-id', i['id']] for i in sorted(fields, key=_get_field_position) ]
+    elif column_order == 'alphabetical':
+        field_ids = None
+    else:
+        raise ValueError("Wrong value for 'column_order'. Accepted values: 'alphabetical', 'db_table_order' or a list of column names.")
+
+    card_json = {'dataset_query': {'database': db_id, 'query': {'fields': field_ids, 'source-table': table_id}, 'type': 'query'},
+                 'display': 'table',
+                 'name': args['card_name'] or custom_json['name'],
+                 'collection_id': collection_id,
+                 'visualization_settings': {}}
+    for key, value in custom_json.items():
+        if key not in ['name', 'dataset_query', 'display']:
+            card_json[key] = value
+    return card_json
@@ -1,3 +1,8 @@
+import asyncio
+
+from ._item_index import ItemIndex
+from .create_methods import _get_field_position, _get_template_args, _get_template_items, _get_template_ids, \
+                             _needs_fields, _is_complete_json, _make_template_card_json
 
 async def create_card(self, card_name=None, collection_name=None, collection_id=None, 
                 db_name=None, db_id=None, table_name=None, table_id=None, 
@@ -45,6 +50,7 @@ async def create_card(self, card_name=None, collection_name=None, collection_id=
 
             # Create the card using only the provided custom_json 
             res = await self.post("/api/card/", json=custom_json)
+            self.invalidate_cache('card')
             if res and not res.get('error'):
                 self.verbose_print(verbose, 'The card was created successfully.')
                 return res if return_card else None
@@ -88,37 +94,9 @@ async def create_card(self, card_name=None, collection_name=None, collection_id=
 
     elif column_order == 'db_table_order':  # default
         # Find the actual order of columns in the table as they appear in the database
-        # Create a temporary card for retrieving column ordering
-        json_str = f"""{{
-            'dataset_query': {{ 
-                'database': {db_id},
-                'native': {{'query': 'SELECT * from "{table_name}";' }},
-                'type': 'native' 
-            }},
-            'display': 'table',
-            'name': '{card_name}',
-            'visualization_settings': {{}} 
-        }}"""
-
-        json_dict = eval(json_str.replace("'", '"'))
-        res = await self.post("/api/card/", json=json_dict)
-        if not res:
-            print('Card Creation Failed!')
-            return res
-            
-        ordered_columns = [i['name'] for i in res['result_metadata']]  # retrieving the column ordering
-
-        # Delete the temporary card
-        card_id = res['id']
-        await self.delete(f"/api/card/{card_id}")
-
-        column_name_id_dict = await self.get_columns_name_id(
-            db_id=db_id, 
-            table_id=table_id, 
-            table_name=table_name, 
-            verbose=verbose
-        )
-        column_id_list = [column_name_id_dict[i] for i in ordered_columns]
+        # using the positions in the metadata of the table (cached per table), so no query is run
+        fields = sorted(await self._get_table_fields(table_id), key=_get_field_position)
+        column_id_list = [i['id'] for i in fields]
         column_id_list_str = [['field-id', i] for i in column_id_list]
 
     elif column_order == 'alphabetical':
@@ -155,6 +133,7 @@ async def create_card(self, card_name=None, collection_name=None, collection_id=
             json_dict[key] = value
 
     res = await self.post("/api/card/", json=json_dict)
+    self.invalidate_cache('card')
 
     # Get collection_name to be used in the final message
     if not collection_name:
@@ -172,6 +151,66 @@ async def create_card(self, card_name=None, collection_name=None, collection_id=
         return res
 
 
+async def create_cards(self, template, substitutions, concurrency=4, verbose=False):
+    """
+    Async version of create_cards.
+    Create many similar cards from a template. The ids of all the tables, DBs, collections and columns are resolved
+    in a single pass and up to `concurrency` cards are created at the same time.
+    Returns a list of {'index', 'substitution', 'card', 'error'} dictionaries, one per substitution (in the same order).
+    """
+    cards = [_get_template_args(template, substitution) for substitution in substitutions]
+    results = [{'index': index, 'substitution': substitution, 'card': None, 'error': None}
+               for index, substitution in enumerate(substitutions)]
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    # Resolve the names of all the cards in one pass
+    items = _get_template_items(cards)
+    item_types = {item[0] for item in items}
+    if any(not args['db_id'] and not _is_complete_json(args['custom_json']) for args in cards):
+        item_types.add('table')  # For finding the DB of the tables
+    indexes = {item_type: await self._get_item_index(item_type) for item_type in item_types}
+    resolved = ItemIndex.resolve(indexes, items)
+    tables = {i['id']: i for records in indexes.get('table', {}).values() for i in records}
+
+    ids = {}  # index -> (db_id, table_id, collection_id)
+    for index, args in enumerate(cards):
+        try:
+            ids[index] = _get_template_ids(args, resolved, tables)
+        except Exception as e:
+            results[index]['error'] = e
+
+    # Get the fields of the tables (in the order of the columns)
+    table_IDs = sorted({ids[index][1] for index in ids if _needs_fields(cards[index])})
+
+    async def fetch(table_id):
+        async with semaphore:
+            return await self._get_table_fields(table_id)
+
+    table_fields = dict(zip(table_IDs, await asyncio.gather(*[fetch(table_id) for table_id in table_IDs], return_exceptions=True)))
+
+    # Create the cards
+    async def create(index):
+        try:
+            db_id, table_id, collection_id = ids[index]
+            fields = table_fields.get(table_id)
+            if isinstance(fields, Exception):
+                raise fields
+            card_json = _make_template_card_json(cards[index], db_id, table_id, collection_id, fields)
+            async with semaphore:
+                res = await self.post('/api/card/', json=card_json)
+            if not res or res.get('error'):
+                raise ValueError(f'Error creating the card "{card_json["name"]}": {res}')
+            self.verbose_print(verbose, f"The card '{card_json['name']}' was created successfully.")
+            results[index]['card'] = res
+        except Exception as e:
+            results[index]['error'] = e
+
+    await asyncio.gather(*[create(index) for index in sorted(ids)])
+    self.invalidate_cache('card')
+
+    return results
+
+
 async def create_collection(self, collection_name, parent_collection_id=None, parent_collection_name=None, return_results=False):
     """
     Async version of create_collection.
@@ -187,6 +226,7 @@ async def create_collection(self, collection_name, parent_collection_id=None, pa
             parent_collection_id = await self.get_item_id('collection', parent_collection_name)
 
     res = await self.post('/api/collection', json={'name': collection_name, 'parent_id': parent_collection_id, 'color': '#509EE3'})
+    self.invalidate_cache('collection')
     if return_results:
         return res
 
@@ -202,11 +242,8 @@ async def create_segment(self, segment_name, column_name, column_values, segment
         raise ValueError('Either the name or id of the table must be provided.')
     if not table_id:
         table_id = await self.get_item_id('table', table_name, db_id=db_id, db_name=db_name)
-    if not table_name:
-        table_name = await self.get_item_name(item_type='table', item_id=table_id)
-    db_id = await self.get_db_id_from_table_id(table_id)
 
-    colmuns_name_id_mapping = await self.get_columns_name_id(table_name=table_name, db_id=db_id)
+    colmuns_name_id_mapping = await self.get_columns_name_id(table_id=table_id)
     column_id = colmuns_name_id_mapping[column_name]
 
     # Create a segment blueprint
@@ -222,5 +259,6 @@ async def create_segment(self, segment_name, column_name, column_values, segment
 
     # Create the segment
     res = await self.post('/api/segment/', json=segment_blueprint)
+    self.invalidate_cache('segment')
     if return_segment:
         return res
@@ -1,16 +1,70 @@
 import requests
 import getpass
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from ._item_index import ItemIndex
+from ._cache import TTLCache
+from ._metadata_store import MetadataStore
+from ._streaming import JSONArrayDecoder, CSVDecoder, NULL_CSV_CELL, iter_rows
+from ._columnar import to_columnar, get_export_cols, ColumnarBuilder
+from ._export import CardExporter, EXPORT_FORMATS
 
 class Metabase_API():
 
-    def __init__(self, domain, email=None, password=None, api_key=None, basic_auth=False, is_admin=True):
+    def __init__(self, domain, email=None, password=None, api_key=None, basic_auth=False, is_admin=True, timeout=None,
+                 *, trust_env=True, verify=True, pool_connections=10, pool_maxsize=20, session=None,
+                 reauth_on_401=False, session_max_age=None, retry_policy=None, circuit_breaker=None, rate_limiter=None,
+                 cache_ttl=60, settings_ttl=3600, metadata_store=None, result_cache=None):
         assert email is not None or api_key is not None
         self.domain = domain.rstrip('/')
         self.email = email
         self.auth = None
+        self.timeout = timeout
+        self.session_id = None
+
+        # Session handling. With reauth_on_401, requests are sent without validating the session first 
+        # and a 401 response triggers a re-authentication and a single replay of the request.
+        # session_max_age (in seconds) makes the client get a new session proactively before it expires.
+        self.reauth_on_401 = reauth_on_401
+        self.session_max_age = session_max_age
+        self._session_created_at = None
+        self._auth_lock = threading.Lock()
+
+        # Retrying transient failures (a RetryPolicy) and a per-client CircuitBreaker (both optional)
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        # Client-side throttling (a RateLimiter, can be shared between clients)
+        self.rate_limiter = rate_limiter
+        # Metadata caching (the name -> id index used by get_item_id and the fields of tables/DBs). 
+        # cache_ttl is in seconds (default 60, so the listings are fetched once per operation such as a copy, an export
+        # or a sync rather than once per item, while changes made by other means are picked up within a minute).
+        # None disables caching.
+        self.cache_ttl = cache_ttl
+        self._item_index = ItemIndex(ttl=cache_ttl)
+        self._table_fields_cache = TTLCache(ttl=cache_ttl)
+        self._db_fields_cache = TTLCache(ttl=cache_ttl)
+        self._collection_tree = None  # (collection index, CollectionTree), rebuilt when the index changes
+        # Metabase settings checked by the package (e.g. "Friendly Table and Field Names"), fetched on first use
+        self._settings_cache = TTLCache(ttl=settings_ttl)
+        # Optional cache for the results of card queries (a ResultCache, can be shared between clients)
+        self.result_cache = result_cache
+        # Optional on-disk snapshot of the metadata (a MetadataStore or the path of its SQLite file), shared between runs
+        self._owns_metadata_store = isinstance(metadata_store, str)
+        self.metadata_store = MetadataStore(metadata_store) if self._owns_metadata_store else metadata_store
+
+        # Connection pooling and keep-alive
+        self._session = session or requests.Session()
+        self._owns_session = session is None
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+            self._session.trust_env = trust_env
+            self._session.verify = verify
+
         if email:
             self.password = getpass.getpass(prompt='Please enter your password: ') if password is None else password
-            self.session_id = None
             self.header = None
             if basic_auth:
                 self.auth = (self.email, self.password) 
@@ -18,7 +72,7 @@ class Metabase_API():
         else:
             self.header = {"X-API-KEY": api_key}
             # make sure the provided api key is correct
-            res = requests.get(self.domain + '/api/database/1', headers=self.header)
+            res = self._send('GET', '/api/database/1', headers=self.header)
             if res.status_code == 401:  # unauthenticated
                 raise ValueError('The provided API key is not correct.')
             
@@ -30,6 +84,20 @@ class Metabase_API():
             ''')
 
 
+    def close(self):
+        """Close the pooled HTTP session (only if it was created by this instance)"""
+        if self._owns_session:
+            self._session.close()
+        if self._owns_metadata_store:
+            self.metadata_store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
     def authenticate(self):
         """Get a Session ID"""
         conn_header = {
@@ -37,19 +105,20 @@ class Metabase_API():
             'password':self.password
         }
 
-        res = requests.post(self.domain + '/api/session', json=conn_header, auth=self.auth)
+        res = self._send('POST', '/api/session', json=conn_header, auth=self.auth)
         if not res.ok:
             raise Exception(res)
 
         self.session_id = res.json()['id']
         self.header = {'X-Metabase-Session':self.session_id}
+        self._session_created_at = time.monotonic()
 
 
     def validate_session(self):
         """Get a new session ID if the previous one has expired"""
         if not self.email: # if email was not provided then the authentication would be based on api key so there would be no session to validate
             return
-        res = requests.get(self.domain + '/api/user/current', headers=self.header, auth=self.auth)
+        res = self._send('GET', '/api/user/current', headers=self.header, auth=self.auth)
 
         if res.ok:  # 200
             return True
@@ -60,19 +129,33 @@ class Metabase_API():
 
 
 
+    def session_is_expired(self):
+        """Whether the session is older than session_max_age (always False if session_max_age is not set)"""
+        if self.session_max_age is None or self._session_created_at is None:
+            return False
+        return time.monotonic() - self._session_created_at >= self.session_max_age
+
+
+
     # import REST Methods
-    from ._rest_methods import get, post, put, delete
+    from ._rest_methods import get, post, put, delete, _request, _send
     # import helper functions
     from ._helper_methods import get_item_info, get_item_id, get_item_name, \
                                 get_db_id_from_table_id, get_db_info, get_table_metadata, \
-                                get_columns_name_id, friendly_names_is_disabled, verbose_print
+                                get_columns_name_id, friendly_names_is_disabled, verbose_print, \
+                                _get_item_index, _get_table_fields, _get_db_fields, invalidate_cache, \
+                                resolve_item_ids, _get_item_list, refresh_metadata_store, \
+                                get_collection_tree, get_collection_id_by_path, _get_collection_contents
 
 
     ##################################################################
     ###################### Custom Functions ##########################
     ##################################################################
-    from .create_methods import create_card, create_collection, create_segment
-    from .copy_methods import copy_card, copy_collection, copy_dashboard, copy_pulse
+    from .create_methods import create_card, create_cards, create_collection, create_segment
+    from .copy_methods import copy_card, copy_collection, copy_dashboard, copy_pulse, \
+                              plan_collection_copy, _copy_collection_items, _copy_collection_item, _deepcopy_dashboard
+    from .bundle_methods import export_collection_bundle, import_collection_bundle, _get_bundle_names, _resolve_bundle_names
+    from .sync_methods import sync_collection, _sync_item, _create_synced_item, _update_synced_item, _write_synced_dashboard
     
     def search(self, q, item_type=None):
         """
@@ -97,7 +180,7 @@ class Metabase_API():
 
 
     def get_card_data(self, card_name=None, card_id=None, collection_name=None, collection_id=None, 
-                      data_format='json', parameters=None, format_rows=False):
+                      data_format='json', parameters=None, format_rows=False, columnar_backend='array', use_cache=True):
         '''
         Run the query associated with a card and get the results.
 
@@ -106,12 +189,210 @@ class Metabase_API():
         data_format : specifies the format of the returned data:
             - 'json': every row is a dictionary of <column-header, cell> key-value pairs    
             - 'csv': the entire result is returned as a string, where rows are separated by newlines and cells with commas.
+            - 'columnar': the column names are returned once, with one compact array per column, typed by the base type 
+                          of the column: {'columns': [names], 'base_types': [types], 'data': [arrays]} (see columnar_backend).
+                          The rows are streamed from the json export, so they are not limited to 2000 rows, and their cells
+                          are appended to the arrays as they are received. The types of the columns are taken from the 
+                          result_metadata of the card (the columns are untyped if it does not match the results, e.g. if 
+                          the card was never run). format_rows does not apply to this format.
         parameters : can be used to pass filter values:
             The format is like [{"type":"category","value":["val1","val2"],"target":["dimension",["template-tag","filter_variable_name"]]}]
             See the network tab when exporting the results using the web interface to get the proper format pattern.
         format_rows : whether the returned results should be formatted or not
+        columnar_backend : the type of the arrays of the 'columnar' format (default 'array'):
+            - 'array': array.array for the integer, float and boolean columns (nulls become NaN) and lists for the others
+            - 'numpy': numpy arrays (needs numpy)
+            - 'pyarrow': a pyarrow Table is returned instead of the dictionary (needs pyarrow)
+        use_cache : whether to use the result cache, if one is set (see the 'result_cache' argument of the class)
+        '''
+        assert data_format in [ 'json', 'csv', 'columnar' ]
+        card_id, params_json = self._get_card_query_args(card_name, card_id, collection_name, collection_id, 
+                                                         parameters, format_rows)
+
+        result = self._get_card_result(card_id, data_format, parameters, format_rows, params_json, use_cache)
+        if data_format == 'columnar':
+            return result.finish(columnar_backend)
+        return result
+
+
+
+    def _get_card_result(self, card_id, data_format, parameters, format_rows, params_json, use_cache=True, card=None):
+        '''
+        Run the query of a card (see get_card_data), or get its results from the result cache. For the 'columnar' format, 
+        a ColumnarBuilder is returned (it is cached as the lists of the cells of its columns, to be serialized as JSON).
+        '''
+        if self.result_cache and use_cache:
+            card = self.get("/api/card/{}".format(card_id))
+            if card:  # without its 'updated_at', an edit of the card would not invalidate the cached results
+                cache_key = self.result_cache.make_key(card_id, card['updated_at'], parameters, format_rows, data_format)
+                result = self.result_cache.get(cache_key)
+                if result is not None:
+                    return ColumnarBuilder.from_columns(result['cols'], result['columns']) if data_format == 'columnar' else result
+                result = self._get_card_result(card_id, data_format, parameters, format_rows, params_json, use_cache=False, card=card)
+                if data_format == 'columnar':
+                    self.result_cache.set(cache_key, {'cols': result.cols, 'columns': result.get_columns()})
+                elif not (type(result) == dict and result.get('error')):  # do not cache the error responses
+                    self.result_cache.set(cache_key, result)
+                return result
+
+        if data_format == 'columnar':
+            # the rows are streamed from the json export (which is not limited to 2000 rows, unlike POST /api/card/:id/query) 
+            # and their cells are appended to the buffers of the columns batch by batch. The cells are matched with the 
+            # columns (typed by the metadata of the card) by position, so the columns with the same display name are kept apart
+            card = card or self.get("/api/card/{}".format(card_id))
+            if not card:
+                raise ValueError('There is no card with the id "{}"'.format(card_id))
+            builder = None
+            for batch in self._iter_export_rows("/api/card/{}/query/json".format(card_id), dict(params_json, format_rows='false'), 
+                                                'json', batch_size=10000, pairs=True):
+                if builder is None:
+                    builder = ColumnarBuilder(get_export_cols(card.get('result_metadata'), [ key for key, value in batch[0] ]))
+                builder.add_rows([ [ value for key, value in row ] for row in batch ])
+            return builder or ColumnarBuilder(get_export_cols(card.get('result_metadata'), None))
+
+        # get the results
+        res = self.post("/api/card/{}/query/{}".format(card_id, data_format), 'raw', data=params_json)
+
+        # return the results in the requested format
+        if data_format == 'json':
+            import json
+            return json.loads(res.text)
+        if data_format == 'csv':
+            return NULL_CSV_CELL.sub(r'\1', res.text)
+
+
+
+    def get_card_data_batch(self, parameter_sets, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                            data_format='json', format_rows=False, concurrency=4):
+        '''
+        Run the query associated with a card once for each of the given parameter sets, using up to 'concurrency' 
+        threads (the connections of the pooled session are shared). The results are yielded as they complete, as 
+        {'index', 'parameters', 'data', 'error'} dictionaries, where 'index' is the position of the parameter set. 
+        A failed run does not stop the others: its 'error' is the raised exception (and 'data' is None).
+
+        Parameters
+        ----------
+        parameter_sets : iterable of 'parameters' lists (see get_card_data), e.g. one per region. 
+                         It is consumed lazily, so it can be a generator.
+        data_format : 'json', 'csv' or 'columnar' (see get_card_data)
+        format_rows : whether the returned results should be formatted or not
+        concurrency : maximum number of queries running at the same time (default 4)
+        '''
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        card_id, _ = self._get_card_query_args(card_name, card_id, collection_name, collection_id, None, format_rows)
+
+        def run(index, parameters):
+            try:
+                data = self.get_card_data(card_id=card_id, data_format=data_format, parameters=parameters, format_rows=format_rows)
+                if type(data) == dict and data.get('error'):  # the error response of Metabase for a failed query
+                    raise ValueError(data['error'])
+                return {'index': index, 'parameters': parameters, 'data': data, 'error': None}
+            except Exception as e:
+                return {'index': index, 'parameters': parameters, 'data': None, 'error': e}
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = set()
+        try:
+            for index, parameters in enumerate(parameter_sets):
+                pending.add(executor.submit(run, index, parameters))
+                if len(pending) >= concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # cancel the queries not started yet (by hand, as shutdown(cancel_futures=True) needs Python 3.9)
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+
+    def iter_card_data(self, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                       data_format='json', parameters=None, format_rows=False, batch_size=None, chunk_size=65536):
+        '''
+        Run the query associated with a card and yield the rows of the results as they are received, 
+        so the memory used does not depend on the size of the results (unlike get_card_data).
+
+        Parameters
+        ----------
+        data_format : specifies the format of the yielded rows:
+            - 'json': every row is a dictionary of <column-header, cell> key-value pairs    
+            - 'csv': every row is a list of cells (the first row is the header)
+        parameters : can be used to pass filter values (see get_card_data)
+        format_rows : whether the returned results should be formatted or not
+        batch_size : if provided, lists of (up to) batch_size rows are yielded instead of single rows
+        chunk_size : number of bytes read from the response at a time (default 64KB)
         '''
         assert data_format in [ 'json', 'csv' ]
+        card_id, params_json = self._get_card_query_args(card_name, card_id, collection_name, collection_id, 
+                                                         parameters, format_rows)
+
+        return self._iter_export_rows("/api/card/{}/query/{}".format(card_id, data_format), params_json, data_format, 
+                                      batch_size=batch_size, chunk_size=chunk_size)
+
+
+
+    def _iter_export_rows(self, endpoint, form_data, data_format, batch_size=None, chunk_size=65536, row_limit=None, pairs=False):
+        '''
+        Stream the body of an export endpoint (e.g. /api/card/:id/query/json) and yield its rows (see iter_card_data).
+        With pairs, the rows of the json format are lists of (column header, cell) pairs (see JSONArrayDecoder).
+        '''
+        res = self.post(endpoint, 'raw', data=form_data, stream=True)
+        try:
+            if not res.ok:
+                raise ValueError('Running the query failed ({}): {}'.format(res.status_code, res.text))
+            decoder = JSONArrayDecoder(pairs=pairs) if data_format == 'json' else CSVDecoder()
+            yield from iter_rows(decoder, res.iter_content(chunk_size), batch_size=batch_size, row_limit=row_limit)
+        finally:
+            res.close()
+
+
+
+    def export_card_to_file(self, path, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                            format='csv', parameters=None, format_rows=False, chunk_size=65536, batch_size=10000):
+        '''
+        Run the query associated with a card and write the results to a file as they are received (in chunks of 
+        chunk_size bytes), without holding them in memory. Return a report: {'path', 'format', 'bytes', 'rows'}.
+
+        Parameters
+        ----------
+        path : path of the file to write
+        format : the format of the file:
+            - 'csv', 'json', 'xlsx': the export of Metabase is written as it is (rows is None in the report for xlsx)
+            - 'jsonl': one json object per line (transcoded from the json export)
+            - 'parquet': transcoded from the json export in row groups of batch_size rows (needs pyarrow). 
+                         The types of the columns are inferred from the first batch_size rows.
+        parameters : can be used to pass filter values (see get_card_data)
+        format_rows : whether the returned results should be formatted or not
+        '''
+        assert format in EXPORT_FORMATS
+        card_id, params_json = self._get_card_query_args(card_name, card_id, collection_name, collection_id, 
+                                                         parameters, format_rows)
+
+        res = self.post("/api/card/{}/query/{}".format(card_id, EXPORT_FORMATS[format]), 'raw', data=params_json, stream=True)
+        try:
+            if not res.ok:
+                raise ValueError('Running the query of the card {} failed ({}): {}'.format(card_id, res.status_code, res.text))
+            exporter = CardExporter(path, format, batch_size=batch_size)
+            try:
+                for chunk in res.iter_content(chunk_size):
+                    exporter.feed(chunk)
+                return exporter.close()
+            except BaseException:
+                exporter.abort()
+                raise
+        finally:
+            res.close()
+
+
+
+    def _get_card_query_args(self, card_name, card_id, collection_name, collection_id, parameters, format_rows):
+        '''Return the id of the card and the form data for running its query (used by get_card_data and similar functions)'''
         if parameters:
             assert type(parameters) == list
 
@@ -128,15 +409,98 @@ class Metabase_API():
             'parameters':json.dumps(parameters), 
             'format_rows':'true' if format_rows else 'false' 
         }
+        return card_id, params_json
 
-        # get the results
-        res = self.post("/api/card/{}/query/{}".format(card_id, data_format), 'raw', data=params_json)
 
-        # return the results in the requested format
-        if data_format == 'json':
-            return json.loads(res.text)
-        if data_format == 'csv':
-            return res.text.replace('null', '')
+
+    def run_query(self, query, db_id=None, db_name=None, parameters=None, row_limit=None, data_format='json', 
+                  columnar_backend='array'):
+        '''
+        Run a query without saving it as a card (using POST /api/dataset), e.g. for exploring data or probing metadata.
+        Metabase limits the results of this endpoint (2000 rows by default for queries without aggregation); 
+        use iter_query_data for complete results.
+
+        Parameters
+        ----------
+        query : the query to run:
+            - a string: a native (SQL) query
+            - a dictionary with a 'type' key: a complete dataset_query (as used in cards), e.g. for native queries with template tags
+            - any other dictionary: an MBQL query, e.g. {'source-table': 12, 'limit': 10}
+        db_id, db_name : the id or name of the DB (not needed if query is a complete dataset_query)
+        parameters : can be used to pass filter values (see get_card_data)
+        row_limit : maximum number of rows to return
+        data_format : specifies the format of the returned data:
+            - 'json': every row is a dictionary of <column-header, cell> key-value pairs
+            - 'columnar': the column names once and one compact array per column (see get_card_data)
+            - 'raw': the response of Metabase, with the rows and the metadata of the columns (data.cols, data.results_metadata)
+        columnar_backend : 'array', 'numpy' or 'pyarrow' (only for the 'columnar' format, see get_card_data)
+        '''
+        assert data_format in [ 'json', 'columnar', 'raw' ]
+        dataset_query = self._get_dataset_query(query, db_id, db_name, parameters, row_limit)
+        if row_limit is not None:
+            dataset_query['constraints'] = {'max-results': row_limit, 'max-results-bare-rows': row_limit}
+
+        res = self.post('/api/dataset', json=dataset_query)
+        if not res or res.get('status') == 'failed' or res.get('error'):
+            raise ValueError('Running the query failed: {}'.format(res.get('error') if res else res))
+        if row_limit is not None:
+            res['data']['rows'] = res['data']['rows'][:row_limit]
+
+        if data_format == 'raw':
+            return res
+        if data_format == 'columnar':
+            return to_columnar(res['data']['cols'], res['data']['rows'], columnar_backend)
+        names = [ col['name'] for col in res['data']['cols'] ]
+        return [ dict(zip(names, row)) for row in res['data']['rows'] ]
+
+
+
+    def iter_query_data(self, query, db_id=None, db_name=None, parameters=None, row_limit=None, data_format='json', 
+                        format_rows=False, batch_size=None, chunk_size=65536):
+        '''
+        Run a query without saving it as a card (using the export endpoint POST /api/dataset/:export-format) and yield 
+        the rows as they are received (see iter_card_data). The export endpoint is not limited to 2000 rows.
+
+        Parameters
+        ----------
+        query, db_id, db_name, parameters : see run_query
+        row_limit : maximum number of rows to yield. It is added to MBQL queries; for native queries the response 
+                    is closed once row_limit rows are received.
+        data_format : 'json' (dictionaries) or 'csv' (lists of cells, the first row is the header)
+        format_rows : whether the returned results should be formatted or not
+        batch_size : if provided, lists of (up to) batch_size rows are yielded instead of single rows
+        chunk_size : number of bytes read from the response at a time (default 64KB)
+        '''
+        assert data_format in [ 'json', 'csv' ]
+        import json
+        dataset_query = self._get_dataset_query(query, db_id, db_name, parameters, row_limit)
+        form_data = { 'query': json.dumps(dataset_query), 'format_rows': 'true' if format_rows else 'false' }
+        return self._iter_export_rows('/api/dataset/{}'.format(data_format), form_data, data_format, 
+                                      batch_size=batch_size, chunk_size=chunk_size, row_limit=row_limit)
+
+
+
+    def _get_dataset_query(self, query, db_id, db_name, parameters, row_limit):
+        '''Return the dataset_query (as used by POST /api/dataset) for the arguments of run_query'''
+        if type(query) == dict and 'type' in query:
+            dataset_query = dict(query)
+        else:
+            if db_id is None:
+                if db_name is None:
+                    raise ValueError('Either the name or id of the DB must be provided.')
+                db_id = self.get_item_id('database', db_name)
+            if type(query) == str:
+                dataset_query = {'database': db_id, 'type': 'native', 'native': {'query': query, 'template-tags': {}}}
+            else:
+                dataset_query = {'database': db_id, 'type': 'query', 'query': dict(query)}
+
+        if parameters:
+            assert type(parameters) == list
+            dataset_query['parameters'] = parameters
+        if row_limit is not None and dataset_query['type'] == 'query':
+            limit = dataset_query['query'].get('limit')
+            dataset_query['query'] = dict(dataset_query['query'], limit=row_limit if limit is None else min(limit, row_limit))
+        return dataset_query
 
 
 
@@ -268,6 +632,8 @@ class Metabase_API():
             res = self.put('/api/{}/{}'.format(item_type, item_id), json={'archived':True, 'revision_message':'archived!'})
         else:
             res = self.put('/api/{}/{}'.format(item_type, item_id), json={'archived':True})
+        # archiving a collection also archives its items
+        self.invalidate_cache(item_type if item_type != 'collection' else None)
 
         if res in [200, 202]:  # for segments the success status code returned is 200 for others it is 202
             self.verbose_print(verbose, 'Successfully Archived.')    
@@ -290,7 +656,9 @@ class Metabase_API():
                 raise ValueError('Either the name or id of the {} must be provided.'.format(item_type))
             item_id = self.get_item_id(item_type, item_name, collection_id, collection_name)
 
-        return self.delete('/api/{}/{}'.format(item_type, item_id))
+        res = self.delete('/api/{}/{}'.format(item_type, item_id))
+        self.invalidate_cache(item_type)
+        return res
 
 
 
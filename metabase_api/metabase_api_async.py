@@ -1,9 +1,20 @@
 import httpx
 import getpass
+import asyncio
+import time
+from ._item_index import ItemIndex
+from ._cache import TTLCache
+from ._metadata_store import MetadataStore
+from ._streaming import JSONArrayDecoder, CSVDecoder, NULL_CSV_CELL, aiter_rows
+from ._columnar import to_columnar, get_export_cols, ColumnarBuilder
+from ._export import CardExporter, EXPORT_FORMATS
+from ._partitions import make_partitions
 
 class Metabase_API_Async:
     def __init__(self,domain,email=None,password=None,api_key=None,basic_auth=False,is_admin=True,timeout=None,
-                 *,trust_env=False,http2=False,limits=None,verify=True):
+                 *,trust_env=False,http2=False,limits=None,verify=True,reauth_on_401=False,session_max_age=None,
+                 retry_policy=None,circuit_breaker=None,rate_limiter=None,
+                 cache_ttl=60,settings_ttl=3600,metadata_store=None,result_cache=None):
         assert email is not None or api_key is not None
         self.domain = domain.rstrip("/")
         self.email = email
@@ -14,6 +25,36 @@ class Metabase_API_Async:
         self.is_admin = is_admin
         self.timeout = timeout
 
+        # Session handling. With reauth_on_401, requests are sent without validating the session first 
+        # and a 401 response triggers a re-authentication and a single replay of the request.
+        # session_max_age (in seconds) makes the client get a new session proactively before it expires.
+        self.reauth_on_401 = reauth_on_401
+        self.session_max_age = session_max_age
+        self._session_created_at = None
+        self._auth_lock = asyncio.Lock()
+
+        # Retrying transient failures (a RetryPolicy) and a per-client CircuitBreaker (both optional)
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        # Client-side throttling (a RateLimiter, can be shared between clients)
+        self.rate_limiter = rate_limiter
+        # Metadata caching (the name -> id index used by get_item_id and the fields of tables/DBs). 
+        # cache_ttl is in seconds (default 60, so the listings are fetched once per operation such as a copy, an export
+        # or a sync rather than once per item, while changes made by other means are picked up within a minute).
+        # None disables caching.
+        self.cache_ttl = cache_ttl
+        self._item_index = ItemIndex(ttl=cache_ttl)
+        self._table_fields_cache = TTLCache(ttl=cache_ttl)
+        self._db_fields_cache = TTLCache(ttl=cache_ttl)
+        self._collection_tree = None  # (collection index, CollectionTree), rebuilt when the index changes
+        # Metabase settings checked by the package (e.g. "Friendly Table and Field Names"), fetched on first use
+        self._settings_cache = TTLCache(ttl=settings_ttl)
+        # Optional cache for the results of card queries (a ResultCache, can be shared between clients)
+        self.result_cache = result_cache
+        # Optional on-disk snapshot of the metadata (a MetadataStore or the path of its SQLite file), shared between runs
+        self._owns_metadata_store = isinstance(metadata_store, str)
+        self.metadata_store = MetadataStore(metadata_store) if self._owns_metadata_store else metadata_store
+
         if email:
             self.password = getpass.getpass(prompt="Please enter your password: ") if password is None else password
             self.auth = True if basic_auth else None
@@ -42,6 +83,8 @@ Without this some of the functions of the current package may not work as expect
 
     async def aclose(self):
         await self._client.aclose()
+        if self._owns_metadata_store:
+            self.metadata_store.close()
 
     async def __aenter__(self):
         return self
@@ -53,12 +96,13 @@ Without this some of the functions of the current package may not work as expect
         conn_header = {"username": self.email, "password": self.password}
         auth = (self.email, self.password) if self.auth else None
 
-        res = await self._client.post("/api/session", json=conn_header, auth=auth)
+        res = await self._send("POST", "/api/session", json=conn_header, auth=auth)
         if res.status_code != 200:
             raise Exception(f"Authentication failed with status {res.status_code}")
 
         self.session_id = res.json()["id"]
         self.header = {"X-Metabase-Session": self.session_id}
+        self._session_created_at = time.monotonic()
 
         # Update default headers used by the pooled client
         self._client.headers.clear()
@@ -72,7 +116,7 @@ Without this some of the functions of the current package may not work as expect
             return await self.authenticate_async()
 
         auth = (self.email, self.password) if self.auth else None
-        res = await self._client.get("/api/user/current", auth=auth)
+        res = await self._send("GET", "/api/user/current", auth=auth)
 
         if res.status_code == 200:
             return True
@@ -82,19 +126,33 @@ Without this some of the functions of the current package may not work as expect
 
 
 
+    def session_is_expired(self):
+        """Whether the session is older than session_max_age (always False if session_max_age is not set)"""
+        if self.session_max_age is None or self._session_created_at is None:
+            return False
+        return time.monotonic() - self._session_created_at >= self.session_max_age
+
+
+
     # Import async REST methods
-    from ._rest_methods_async import get, post, put, delete
+    from ._rest_methods_async import get, post, put, delete, _request, _send
     # import helper functions
     from ._helper_methods_async import get_item_info, get_item_id, get_item_name, \
                                 get_db_id_from_table_id, get_db_info, get_table_metadata, \
-                                get_columns_name_id, friendly_names_is_disabled, verbose_print
+                                get_columns_name_id, friendly_names_is_disabled, verbose_print, \
+                                _get_item_index, _get_table_fields, _get_db_fields, invalidate_cache, \
+                                resolve_item_ids, _get_item_list, refresh_metadata_store, \
+                                get_collection_tree, get_collection_id_by_path, _get_collection_contents
     
     
     ##################################################################
     ###################### Custom Functions ##########################
     ##################################################################
-    from .create_methods_async import create_card, create_collection, create_segment
-    from .copy_methods_async import copy_card, copy_collection, copy_dashboard, copy_pulse
+    from .create_methods_async import create_card, create_cards, create_collection, create_segment
+    from .copy_methods_async import copy_card, copy_collection, copy_dashboard, copy_pulse, \
+                                    plan_collection_copy, _copy_collection_items, _copy_collection_item, _deepcopy_dashboard
+    from .bundle_methods_async import export_collection_bundle, import_collection_bundle, _get_bundle_names, _resolve_bundle_names
+    from .sync_methods_async import sync_collection, _sync_item, _create_synced_item, _update_synced_item, _write_synced_dashboard
 
     async def search(self, q, item_type=None):
         """
@@ -120,7 +178,7 @@ Without this some of the functions of the current package may not work as expect
 
 
     async def get_card_data(self, card_name=None, card_id=None, collection_name=None, collection_id=None, 
-                              data_format='json', parameters=None, format_rows=False):
+                              data_format='json', parameters=None, format_rows=False, columnar_backend='array', use_cache=True):
         '''
         Async version of get_card_data.
         Run the query associated with a card and get the results.
@@ -130,12 +188,246 @@ Without this some of the functions of the current package may not work as expect
         data_format : specifies the format of the returned data:
             - 'json': every row is a dictionary of <column-header, cell> key-value pairs    
             - 'csv': the entire result is returned as a string, where rows are separated by newlines and cells with commas.
+            - 'columnar': the column names once and one compact array per column (see get_card_data for details)
         parameters : can be used to pass filter values:
             The format is like [{"type":"category","value":["val1","val2"],"target":["dimension",["template-tag","filter_variable_name"]]}]
             See the network tab when exporting the results using the web interface to get the proper format pattern.
         format_rows : whether the returned results should be formatted or not
+        columnar_backend : 'array', 'numpy' or 'pyarrow' (only for the 'columnar' format)
+        use_cache : whether to use the result cache, if one is set (see the 'result_cache' argument of the class)
+        '''
+        assert data_format in ['json', 'csv', 'columnar']
+        card_id, params_json = await self._get_card_query_args(card_name, card_id, collection_name, collection_id, 
+                                                               parameters, format_rows)
+
+        result = await self._get_card_result(card_id, data_format, parameters, format_rows, params_json, use_cache)
+        if data_format == 'columnar':
+            return result.finish(columnar_backend)
+        return result
+
+
+
+    async def _get_card_result(self, card_id, data_format, parameters, format_rows, params_json, use_cache=True, card=None):
+        '''Async version of _get_card_result'''
+        if self.result_cache and use_cache:
+            card = await self.get(f"/api/card/{card_id}")
+            if card:  # Without its 'updated_at', an edit of the card would not invalidate the cached results
+                cache_key = self.result_cache.make_key(card_id, card['updated_at'], parameters, format_rows, data_format)
+                result = self.result_cache.get(cache_key)
+                if result is not None:
+                    return ColumnarBuilder.from_columns(result['cols'], result['columns']) if data_format == 'columnar' else result
+                result = await self._get_card_result(card_id, data_format, parameters, format_rows, params_json, 
+                                                     use_cache=False, card=card)
+                if data_format == 'columnar':
+                    self.result_cache.set(cache_key, {'cols': result.cols, 'columns': result.get_columns()})
+                elif not (type(result) == dict and result.get('error')):  # do not cache the error responses
+                    self.result_cache.set(cache_key, result)
+                return result
+
+        if data_format == 'columnar':
+            # The rows are streamed from the json export (not limited to 2000 rows) into the buffers of the columns, 
+            # matched by position with the columns typed by the metadata of the card
+            card = card or await self.get(f"/api/card/{card_id}")
+            if not card:
+                raise ValueError(f'There is no card with the id "{card_id}"')
+            builder = None
+            async for batch in self._iter_export_rows(f"/api/card/{card_id}/query/json", dict(params_json, format_rows='false'), 
+                                                      'json', batch_size=10000, pairs=True):
+                if builder is None:
+                    builder = ColumnarBuilder(get_export_cols(card.get('result_metadata'), [key for key, value in batch[0]]))
+                builder.add_rows([[value for key, value in row] for row in batch])
+            return builder or ColumnarBuilder(get_export_cols(card.get('result_metadata'), None))
+
+        # get the results
+        res = await self.post(f"/api/card/{card_id}/query/{data_format}", 'raw', data=params_json)
+
+        # return the results in the requested format
+        if data_format == 'json':
+            import json
+            text = res.text if hasattr(res, 'text') else await res.text()
+            return json.loads(text)
+        if data_format == 'csv':
+            text = res.text if hasattr(res, 'text') else await res.text()
+            return NULL_CSV_CELL.sub(r'\1', text)
+
+
+
+    async def iter_card_data_partitioned(self, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                                         template_tag=None, values=None, start=None, end=None, n_partitions=None, 
+                                         end_template_tag=None, partitions=None, parameters=None, data_format='json', 
+                                         format_rows=False, concurrency=4, batch_size=None, max_queued_batches=4):
+        '''
+        Split the extraction of the results of a (native) card into partitions, defined by the values of a template tag 
+        or by contiguous ranges of a numeric/date column, run the partitions concurrently and yield the rows in the 
+        order of the partitions (the rows of a partition that are received before its turn are kept in memory, 
+        up to max_queued_batches batches). 
+        Each partition is a separate query, so the row limit of Metabase applies to each partition.
+
+        Parameters
+        ----------
+        template_tag : the name of the template tag (i.e. the variable in the SQL query of the card) used for partitioning
+        values : partition by these values of the template tag (one partition per value, or n_partitions groups of values 
+                 if the template tag is a field filter)
+        start, end : partition the range [start, end) of a numeric or date column ('YYYY-MM-DD' or datetime.date) into 
+                     n_partitions (default 4) contiguous ranges. The template tag must be a field filter on the column, 
+                     or a variable used as the start of the range when end_template_tag is provided, e.g. in a query like
+                     'WHERE col >= {{start}} AND col < {{end}}'
+        end_template_tag : the name of the template tag used as the (excluded) end of the range
+        partitions : the 'parameters' of each partition, instead of the above arguments
+        parameters : filter values applied to all the partitions (see get_card_data)
+        data_format : 'json' or 'csv' (see iter_card_data). For csv, only the header of the first partition is yielded.
+        concurrency : maximum number of partitions running at the same time (default 4)
+        batch_size : if provided, lists of (up to) batch_size rows are yielded instead of single rows
+        max_queued_batches : maximum number of batches (of batch_size rows, default 1000) of a partition kept in memory 
+                             before its turn. The extraction of the partition waits when it is reached (default 4).
+        '''
+        assert data_format in ['json', 'csv']
+        card_id, _ = await self._get_card_query_args(card_name, card_id, collection_name, collection_id, None, format_rows)
+
+        if partitions is None:
+            card_info = await self.get_item_info('card', card_id)
+            template_tags = card_info['dataset_query'].get('native', {}).get('template-tags', {})
+            partitions = make_partitions(template_tags, template_tag, values=values, start=start, end=end, 
+                                         n_partitions=n_partitions, end_template_tag=end_template_tag)
+        partitions = [(parameters or []) + partition for partition in partitions]
+
+        done = object()
+        queues = [asyncio.Queue(maxsize=max_queued_batches) for partition in partitions]  # a full queue pauses its partition
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(index):
+            async with semaphore:  # the waiting tasks acquire it in order, so the partitions start in order
+                try:
+                    async for batch in self.iter_card_data(card_id=card_id, data_format=data_format, parameters=partitions[index], 
+                                                           format_rows=format_rows, batch_size=batch_size or 1000):
+                        await queues[index].put(batch)
+                except Exception as e:
+                    await queues[index].put(e)
+                await queues[index].put(done)
+
+        tasks = [asyncio.ensure_future(run(index)) for index in range(len(partitions))]
+        try:
+            for index, queue in enumerate(queues):
+                skip_header = data_format == 'csv' and index > 0
+                while True:
+                    batch = await queue.get()
+                    if batch is done:
+                        break
+                    if isinstance(batch, Exception):
+                        raise ValueError(f'The extraction of the partition {partitions[index]} failed: {batch}') from batch
+                    if skip_header:
+                        batch, skip_header = batch[1:], False
+                    if batch_size:
+                        if batch:
+                            yield batch
+                    else:
+                        for row in batch:
+                            yield row
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+
+    async def get_card_data_batch(self, parameter_sets, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                                  data_format='json', format_rows=False, concurrency=4):
+        '''
+        Async version of get_card_data_batch.
+        Run the query associated with a card once for each of the given parameter sets, with at most 'concurrency' 
+        queries running at the same time, and yield the results as they complete. Use it with 'async for'.
+        '''
+        card_id, _ = await self._get_card_query_args(card_name, card_id, collection_name, collection_id, None, format_rows)
+
+        async def run(index, parameters):
+            try:
+                data = await self.get_card_data(card_id=card_id, data_format=data_format, parameters=parameters, format_rows=format_rows)
+                if type(data) == dict and data.get('error'):  # the error response of Metabase for a failed query
+                    raise ValueError(data['error'])
+                return {'index': index, 'parameters': parameters, 'data': data, 'error': None}
+            except Exception as e:
+                return {'index': index, 'parameters': parameters, 'data': None, 'error': e}
+
+        pending = set()
+        try:
+            for index, parameters in enumerate(parameter_sets):
+                pending.add(asyncio.ensure_future(run(index, parameters)))
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+
+    async def iter_card_data(self, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                             data_format='json', parameters=None, format_rows=False, batch_size=None, chunk_size=65536):
+        '''
+        Async version of iter_card_data.
+        Run the query associated with a card and yield the rows of the results as they are received.
+        Use it with 'async for'.
         '''
         assert data_format in ['json', 'csv']
+        card_id, params_json = await self._get_card_query_args(card_name, card_id, collection_name, collection_id, 
+                                                               parameters, format_rows)
+
+        async for row in self._iter_export_rows(f"/api/card/{card_id}/query/{data_format}", params_json, data_format, 
+                                                batch_size=batch_size, chunk_size=chunk_size):
+            yield row
+
+
+
+    async def _iter_export_rows(self, endpoint, form_data, data_format, batch_size=None, chunk_size=65536, row_limit=None, 
+                                pairs=False):
+        '''Async version of _iter_export_rows'''
+        res = await self.post(endpoint, 'raw', data=form_data, stream=True)
+        try:
+            if not res.is_success:
+                await res.aread()
+                raise ValueError(f'Running the query failed ({res.status_code}): {res.text}')
+            decoder = JSONArrayDecoder(pairs=pairs) if data_format == 'json' else CSVDecoder()
+            async for row in aiter_rows(decoder, res.aiter_bytes(chunk_size), batch_size=batch_size, row_limit=row_limit):
+                yield row
+        finally:
+            await res.aclose()
+
+
+
+    async def export_card_to_file(self, path, card_name=None, card_id=None, collection_name=None, collection_id=None, 
+                                  format='csv', parameters=None, format_rows=False, chunk_size=65536, batch_size=10000):
+        '''
+        Async version of export_card_to_file.
+        Run the query associated with a card and write the results to a file as they are received.
+        '''
+        assert format in EXPORT_FORMATS
+        card_id, params_json = await self._get_card_query_args(card_name, card_id, collection_name, collection_id, 
+                                                               parameters, format_rows)
+
+        res = await self.post(f"/api/card/{card_id}/query/{EXPORT_FORMATS[format]}", 'raw', data=params_json, stream=True)
+        try:
+            if not res.is_success:
+                await res.aread()
+                raise ValueError(f'Running the query of the card {card_id} failed ({res.status_code}): {res.text}')
+            exporter = CardExporter(path, format, batch_size=batch_size)
+            try:
+                async for chunk in res.aiter_bytes(chunk_size):
+                    exporter.feed(chunk)
+                return exporter.close()
+            except BaseException:
+                exporter.abort()
+                raise
+        finally:
+            await res.aclose()
+
+
+
+    async def _get_card_query_args(self, card_name, card_id, collection_name, collection_id, parameters, format_rows):
+        '''Async version of _get_card_query_args'''
         if parameters:
             assert type(parameters) == list
 
@@ -152,17 +444,74 @@ Without this some of the functions of the current package may not work as expect
             'parameters': json.dumps(parameters), 
             'format_rows': 'true' if format_rows else 'false' 
         }
+        return card_id, params_json
 
-        # get the results
-        res = await self.post(f"/api/card/{card_id}/query/{data_format}", 'raw', data=params_json)
 
-        # return the results in the requested format
-        if data_format == 'json':
-            text = res.text if hasattr(res, 'text') else await res.text()
-            return json.loads(text)
-        if data_format == 'csv':
-            text = res.text if hasattr(res, 'text') else await res.text()
-            return text.replace('null', '')
+
+    async def run_query(self, query, db_id=None, db_name=None, parameters=None, row_limit=None, data_format='json', 
+                        columnar_backend='array'):
+        '''
+        Async version of run_query.
+        Run a query without saving it as a card (using POST /api/dataset).
+        '''
+        assert data_format in ['json', 'columnar', 'raw']
+        dataset_query = await self._get_dataset_query(query, db_id, db_name, parameters, row_limit)
+        if row_limit is not None:
+            dataset_query['constraints'] = {'max-results': row_limit, 'max-results-bare-rows': row_limit}
+
+        res = await self.post('/api/dataset', 'raw', json=dataset_query)
+        res = res.json() if res.status_code in [200, 202] else {'error': res.text}
+        if res.get('status') == 'failed' or res.get('error'):
+            raise ValueError(f'Running the query failed: {res.get("error")}')
+        if row_limit is not None:
+            res['data']['rows'] = res['data']['rows'][:row_limit]
+
+        if data_format == 'raw':
+            return res
+        if data_format == 'columnar':
+            return to_columnar(res['data']['cols'], res['data']['rows'], columnar_backend)
+        names = [col['name'] for col in res['data']['cols']]
+        return [dict(zip(names, row)) for row in res['data']['rows']]
+
+
+
+    async def iter_query_data(self, query, db_id=None, db_name=None, parameters=None, row_limit=None, data_format='json', 
+                              format_rows=False, batch_size=None, chunk_size=65536):
+        '''
+        Async version of iter_query_data.
+        Run a query without saving it as a card and yield the rows as they are received. Use it with 'async for'.
+        '''
+        assert data_format in ['json', 'csv']
+        import json
+        dataset_query = await self._get_dataset_query(query, db_id, db_name, parameters, row_limit)
+        form_data = {'query': json.dumps(dataset_query), 'format_rows': 'true' if format_rows else 'false'}
+        async for row in self._iter_export_rows(f'/api/dataset/{data_format}', form_data, data_format, 
+                                                batch_size=batch_size, chunk_size=chunk_size, row_limit=row_limit):
+            yield row
+
+
+
+    async def _get_dataset_query(self, query, db_id, db_name, parameters, row_limit):
+        '''Async version of _get_dataset_query'''
+        if type(query) == dict and 'type' in query:
+            dataset_query = dict(query)
+        else:
+            if db_id is None:
+                if db_name is None:
+                    raise ValueError('Either the name or id of the DB must be provided.')
+                db_id = await self.get_item_id('database', db_name)
+            if type(query) == str:
+                dataset_query = {'database': db_id, 'type': 'native', 'native': {'query': query, 'template-tags': {}}}
+            else:
+                dataset_query = {'database': db_id, 'type': 'query', 'query': dict(query)}
+
+        if parameters:
+            assert type(parameters) == list
+            dataset_query['parameters'] = parameters
+        if row_limit is not None and dataset_query['type'] == 'query':
+            limit = dataset_query['query'].get('limit')
+            dataset_query['query'] = dict(dataset_query['query'], limit=row_limit if limit is None else min(limit, row_limit))
+        return dataset_query
 
 
 
@@ -263,6 +612,8 @@ Without this some of the functions of the current package may not work as expect
             res = await self.put('/api/{}/{}'.format(item_type, item_id), json={'archived':True, 'revision_message':'archived!'})
         else:
             res = await self.put('/api/{}/{}'.format(item_type, item_id), json={'archived':True})
+        # archiving a collection also archives its items
+        self.invalidate_cache(item_type if item_type != 'collection' else None)
 
         if res in [200, 202]:
             await self.verbose_print(verbose, 'Successfully Archived.')    
@@ -284,7 +635,9 @@ Without this some of the functions of the current package may not work as expect
                 raise ValueError('Either the name or id of the {} must be provided.'.format(item_type))
             item_id = await self.get_item_id(item_type, item_name, collection_id, collection_name)
 
-        return await self.delete('/api/{}/{}'.format(item_type, item_id))
+        res = await self.delete('/api/{}/{}'.format(item_type, item_id))
+        self.invalidate_cache(item_type)
+        return res
 
 
 
@@ -0,0 +1,340 @@
+import hashlib
+import itertools
+import json
+
+from ._bundle import CARD_KEYS
+from ._copy_journal import SyncMapping
+from .bundle_methods import _map
+from .copy_methods import _get_dashboard_card_names, _get_dashboard_layout
+
+# the parts of the definitions of the cards and channels of a pulse that are synced
+PULSE_CARD_KEYS = ['include_csv', 'include_xls', 'format_rows', 'pivot_results']
+PULSE_CHANNEL_KEYS = ['channel_type', 'channel_id', 'enabled', 'schedule_type', 'schedule_hour', 'schedule_day', 'schedule_frame',
+                      'recipients', 'details']
+
+
+
+def sync_collection(self, mapping_path, source_collection_name=None, source_collection_id=None,
+                    destination_parent_collection_name=None, destination_parent_collection_id=None,
+                    destination_collection_name=None, child_items_postfix='', archive_removed=False,
+                    concurrency=4, dry_run=False, verbose=False):
+    """
+    Keep a copy of the collection with the given name/id (with its sub-collections, cards, dashboards and pulses) up to date.
+    The first sync copies the collection. The next syncs with the same mapping file only create the new items,
+    update the copies whose definition changed since the last sync (one PUT each) and, with archive_removed,
+    archive the copies of the items removed from the source. In the copied dashboards and pulses, the cards of the
+    source collection are replaced by their copies. The dashcards (and tabs) of a changed dashboard that were already
+    copied are updated in place (the mapping file keeps the ids of their copies), so only the new ones are created.
+
+    Parameters
+    ----------
+    mapping_path : path of the file keeping the source -> destination mapping and the hashes of the synced definitions
+        (see SyncMapping). A mapping file belongs to a single source collection and destination.
+    source_collection_name : name of the collection to sync (default None)
+    source_collection_id : id of the collection to sync (default None)
+    destination_parent_collection_name : name of the collection the copy is in (default None)
+    destination_parent_collection_id : id of the collection the copy is in (default None)
+    destination_collection_name : the name of the copy (default None). If None, it will use the name of the source collection.
+    child_items_postfix : this string is added to the end of the names of the copied items (default '')
+    archive_removed : whether to archive the copies of the items that are not in the source collection anymore (default False)
+    concurrency : number of definitions fetched and cards/dashboards/pulses written at the same time (default 4)
+    dry_run : if True, nothing is written and the report shows what the sync would do (default False)
+
+    Returns a report: {'collection_id': id of the copy,
+                       'created', 'updated', 'unchanged': [{'model', 'source_id', 'destination_id', 'name', 'hash'}],
+                       'removed': [the same for the items that are not in the source anymore (archived if archive_removed)]}
+    """
+    ### making sure we have the data that we need
+    if not source_collection_id:
+        if not source_collection_name:
+            raise ValueError('Either the name or id of the source collection must be provided.')
+        else:
+            source_collection_id = self.get_item_id('collection', source_collection_name)
+
+    if not destination_parent_collection_id:
+        if not destination_parent_collection_name:
+            raise ValueError('Either the name or id of the destination parent collection must be provided.')
+        else:
+            destination_parent_collection_id = (
+                self.get_item_id('collection', destination_parent_collection_name)
+                if destination_parent_collection_name != 'Root'
+                else None
+            )
+
+    ### get the source as it is now (the listings are fetched again)
+    for item_type in ['collection', 'card', 'dashboard', 'pulse']:
+        self.invalidate_cache(item_type)
+    # the card listing has the definitions of the cards, so it is also used for the card index (instead of being fetched twice)
+    card_list = self._get_item_list('card')
+    if self.metadata_store:
+        self.metadata_store.update_items('card', card_list)
+    self._item_index.set('card', card_list)
+    tree = self.get_collection_tree()
+    contents = self._get_collection_contents(source_collection_id, concurrency)
+    if not destination_collection_name:
+        destination_collection_name = tree.get_name(source_collection_id)
+    cards = { i['id']: i for i in card_list }
+    items = [ item for collection_items in contents.values() for item in collection_items if item['model'] in ['card', 'dashboard', 'pulse'] ]
+    definitions = { ('card', item['id']): cards[item['id']] for item in items if item['model'] == 'card' }
+    to_fetch = [ item for item in items if item['model'] in ['dashboard', 'pulse'] ]
+    fetch = lambda item: self.get('/api/{}/{}'.format(item['model'], item['id']))
+    for item, definition in zip(to_fetch, _map(fetch, to_fetch, concurrency)):
+        if not definition:
+            raise ValueError('There is no {} with the id "{}"'.format(item['model'], item['id']))
+        definitions[(item['model'], item['id'])] = definition
+
+    mapping = SyncMapping(mapping_path)
+    report = { 'collection_id': None, 'created': [], 'updated': [], 'unchanged': [], 'removed': [] }
+    try:
+        entries = mapping.entries()  # the first item of a mapping is the synced collection
+        if entries and (entries[0]['model'], entries[0]['source_id']) != ('collection', source_collection_id):
+            raise ValueError('The mapping file {} belongs to the sync of another collection'.format(mapping_path))
+        sync = lambda model, source_id, payload: self._sync_item(mapping, report, model, source_id, payload, dry_run, verbose)
+
+        ### the collections (parents before children)
+        collection_ids = {}
+        for collection_id in tree.iter_subtree(source_collection_id):
+            if collection_id == source_collection_id:
+                payload = { 'name': destination_collection_name, 'parent_id': destination_parent_collection_id }
+            else:
+                payload = { 'name': tree.get_name(collection_id) + child_items_postfix,
+                            'parent_id': collection_ids[tree.get_parent_id(collection_id)] }
+            collection_ids[collection_id] = sync('collection', collection_id, payload)
+        report['collection_id'] = collection_ids[source_collection_id]
+
+        ### the cards
+        source_cards = [ definitions[('card', item['id'])] for item in items if item['model'] == 'card' ]
+        card_payload = lambda card: _get_card_payload(card, collection_ids[card['collection_id']], child_items_postfix)
+        card_ids = dict(zip([ card['id'] for card in source_cards ],
+                            _map(lambda card: sync('card', card['id'], card_payload(card)), source_cards, concurrency)))
+
+        ### the dashboards (using the copies of the cards of the source collection)
+        dashboards = [ definitions[('dashboard', item['id'])] for item in items if item['model'] == 'dashboard' ]
+        dashboard_payload = lambda dashboard: _get_dashboard_payload(dashboard, collection_ids[dashboard['collection_id']],
+                                                                     card_ids, child_items_postfix)
+        list(_map(lambda dashboard: sync('dashboard', dashboard['id'], dashboard_payload(dashboard)), dashboards, concurrency))
+
+        ### the pulses (using the copies of the cards of the source collection)
+        pulses = [ definitions[('pulse', item['id'])] for item in items if item['model'] == 'pulse' ]
+        pulse_payload = lambda pulse: _get_pulse_payload(pulse, collection_ids[pulse['collection_id']], card_ids, child_items_postfix)
+        list(_map(lambda pulse: sync('pulse', pulse['id'], pulse_payload(pulse)), pulses, concurrency))
+
+        ### the items that are not in the source anymore
+        source_items = { ('collection', i) for i in collection_ids } | { (item['model'], item['id']) for item in items }
+        removed = [ entry for entry in mapping.entries() if (entry['model'], entry['source_id']) not in source_items ]
+        for entry in sorted(removed, key=lambda entry: entry['model'] == 'collection'):  # collections last
+            report['removed'].append(entry)
+            if archive_removed and not dry_run:
+                self.verbose_print(verbose, 'Archiving the {} "{}" ...'.format(entry['model'], entry['name']))
+                res = self.put('/api/{}/{}'.format(entry['model'], entry['destination_id']), 'raw', json={'archived': True})
+                if not res.ok and res.status_code != 404:
+                    raise ValueError('Error archiving the {} "{}": {}'.format(entry['model'], entry['name'], res.text))
+                mapping.remove(entry['model'], entry['source_id'])
+    finally:
+        mapping.close()
+        if not dry_run:
+            for item_type in ['collection', 'card', 'dashboard', 'pulse']:
+                self.invalidate_cache(item_type)
+    return report
+
+
+
+def _sync_item(self, mapping, report, model, source_id, payload, dry_run=False, verbose=False):
+    """
+    Create or update the copy of an item (see sync_collection), unless the payload is the same as in the last sync,
+    and return the id of the copy
+    """
+    entry = mapping.get(model, source_id)
+    payload_hash = _get_payload_hash(model, payload)
+    if entry is not None and entry['hash'] == payload_hash:
+        report['unchanged'].append(entry)
+        return entry['destination_id']
+
+    destination_id = entry['destination_id'] if entry is not None else None
+    layout_ids = None
+    if not dry_run:
+        if model == 'dashboard':
+            destination_id, layout_ids = self._write_synced_dashboard(destination_id, payload, entry, verbose)
+        else:
+            if destination_id is not None:
+                self.verbose_print(verbose, 'Updating the {} "{}" ...'.format(model, payload['name']))
+                if not self._update_synced_item(model, destination_id, payload):
+                    destination_id = None  # the copy was deleted
+            if destination_id is None:
+                self.verbose_print(verbose, 'Creating the {} "{}" ...'.format(model, payload['name']))
+                destination_id = self._create_synced_item(model, payload)
+
+    new_entry = { 'model': model, 'source_id': source_id, 'destination_id': destination_id, 'name': payload['name'], 'hash': payload_hash }
+    if layout_ids:
+        new_entry.update(layout_ids)
+    if not dry_run:
+        mapping.record(new_entry)
+    report['created' if entry is None else 'updated'].append(new_entry)
+    return destination_id
+
+
+
+def _create_synced_item(self, model, payload):
+    if model == 'collection':
+        res = self.create_collection(payload['name'], parent_collection_id=payload['parent_id'],
+                                     parent_collection_name='Root', return_results=True)
+        return res['id']
+
+    if model == 'card':
+        res = self.create_card(custom_json=dict(payload), return_card=True)
+        if not res:
+            raise ValueError('Error creating the card "{}"'.format(payload['name']))
+        return res['id']
+
+    res = self.post('/api/{}/'.format(model), 'raw', json=payload)
+    if not res.ok:
+        raise ValueError('Error creating the {} "{}": {}'.format(model, payload['name'], res.text))
+    return res.json()['id']
+
+
+
+def _write_synced_dashboard(self, destination_id, payload, entry=None, verbose=False):
+    """
+    Create or update the copy of a dashboard (see sync_collection). The copies of the tabs and dashcards that are in the
+    mapping entry (and still in the copy) are updated in place, the others are created. Return the id of the copy and the
+    ids of the copies of the tabs and dashcards ({'tabs': {source id: id}, 'dashcards': {source id: id}}, see _get_layout_ids).
+    """
+    current = self.get('/api/dashboard/{}'.format(destination_id)) if destination_id is not None else None
+    if current:
+        self.verbose_print(verbose, 'Updating the dashboard "{}" ...'.format(payload['name']))
+        body = dict(payload)
+    else:  # new, or the copy was deleted
+        self.verbose_print(verbose, 'Creating the dashboard "{}" ...'.format(payload['name']))
+        res = self.post('/api/dashboard/', 'raw', json={ key: value for key, value in payload.items() if key not in ['tabs', 'dashcards'] })
+        if not res.ok:
+            raise ValueError('Error creating the dashboard "{}": {}'.format(payload['name'], res.text))
+        destination_id = res.json()['id']
+        current = {}
+        body = {}
+
+    layout = _get_destination_layout(payload, entry, current)
+    body.update(layout)
+    res = self.put('/api/dashboard/{}'.format(destination_id), 'raw', json=body)
+    if not res.ok:
+        raise ValueError('Error writing the dashcards of the dashboard "{}": {}'.format(payload['name'], res.text))
+
+    # the ids of the tabs and dashcards created by Metabase are read back
+    created = any( i['id'] < 0 for i in layout['tabs'] + layout['dashcards'] )
+    dashboard = self.get('/api/dashboard/{}'.format(destination_id)) if created else None
+    return destination_id, _get_layout_ids(payload, layout, dashboard)
+
+
+
+def _update_synced_item(self, model, destination_id, payload):
+    """Update the copy of an item with a single PUT, return False if the copy does not exist anymore"""
+    res = self.put('/api/{}/{}'.format(model, destination_id), 'raw', json=payload)
+    if res.status_code == 404:
+        return False
+    if not res.ok:
+        raise ValueError('Error updating the {} "{}": {}'.format(model, payload['name'], res.text))
+    return True
+
+
+
+def _get_card_payload(card, collection_id, postfix=''):
+    """The definition of the copy of a card (see sync_collection)"""
+    payload = { key: card[key] for key in CARD_KEYS if key in card }
+    payload['name'] = card['name'] + postfix
+    payload['collection_id'] = collection_id
+    if payload.get('description') == '':  # see the issue #10
+        payload['description'] = None
+    return payload
+
+
+
+def _get_dashboard_payload(dashboard, collection_id, card_ids, postfix=''):
+    """The definition of the copy of a dashboard (see sync_collection), using the copies of the cards in card_ids"""
+    card_id_mapping = { card_id: card_ids.get(card_id, card_id) for card_id in _get_dashboard_card_names(dashboard) }
+    payload = { 'name': dashboard['name'] + postfix,
+                'description': dashboard.get('description') or None,
+                'collection_id': collection_id,
+                'parameters': dashboard.get('parameters') or [] }
+    layout = _get_dashboard_layout(dashboard, card_id_mapping)
+    # the tabs and dashcards keep the ids of the source: they are replaced by the ids of their copies when written
+    # (see _get_destination_layout), so the hash of the payload does not depend on the destination
+    tab_ids = { -(i + 1): tab['id'] for i, tab in enumerate(dashboard.get('tabs') or []) }
+    for tab in layout['tabs']:
+        tab['id'] = tab_ids[tab['id']]
+    for dashcard, source_dashcard in zip(layout['dashcards'], dashboard.get('dashcards') or []):
+        dashcard['id'] = source_dashcard['id']
+        dashcard['dashboard_tab_id'] = tab_ids.get(dashcard['dashboard_tab_id'])
+    payload.update(layout)
+    return payload
+
+
+
+def _get_destination_layout(payload, entry, current):
+    """
+    Return the tabs and dashcards of the payload of a dashboard (see _get_dashboard_payload) with the ids of their copies
+    in the mapping entry, as the body of PUT /api/dashboard/:id. The tabs and dashcards that were not copied yet, or whose
+    copies are not in the current destination dashboard anymore, get negative ids (i.e. they are created).
+    """
+    existing = { 'tabs': { i['id'] for i in current.get('tabs') or [] }, 
+                 'dashcards': { i['id'] for i in current.get('dashcards') or [] } }
+    new_ids = itertools.count(-1, -1)
+
+    def get_id(kind, source_id):
+        destination_id = ((entry or {}).get(kind) or {}).get(str(source_id))  # the keys are strings in the mapping file
+        return destination_id if destination_id in existing[kind] else next(new_ids)
+
+    tab_ids = { tab['id']: get_id('tabs', tab['id']) for tab in payload['tabs'] }
+    return { 'tabs': [ dict(tab, id=tab_ids[tab['id']]) for tab in payload['tabs'] ],
+             'dashcards': [ dict(dashcard, id=get_id('dashcards', dashcard['id']), dashboard_tab_id=tab_ids.get(dashcard['dashboard_tab_id']))
+                            for dashcard in payload['dashcards'] ] }
+
+
+
+def _get_layout_ids(payload, layout, dashboard=None):
+    """
+    Return the ids of the copies of the tabs and dashcards of the payload of a dashboard, {'tabs': {source id: id},
+    'dashcards': {source id: id}} (kept in the mapping entry of the dashboard), from the layout that was written.
+    If some tabs or dashcards were created, their ids are taken from the dashboard as read back after the update:
+    the tabs are matched by position and the dashcards by tab and position in the grid.
+    """
+    if dashboard is None:
+        written_ids = { i['id']: i['id'] for i in layout['tabs'] + layout['dashcards'] }
+        tab_ids = written_ids
+        dashcard_id = lambda dashcard: written_ids.get(dashcard['id'])
+    else:
+        tabs = sorted(dashboard.get('tabs') or [], key=lambda tab: tab.get('position') or 0)
+        tab_ids = { written['id']: tab['id'] for written, tab in zip(layout['tabs'], tabs) }
+        positions = { (i.get('dashboard_tab_id'), i['row'], i['col']): i['id'] for i in dashboard.get('dashcards') or [] }
+        dashcard_id = lambda dashcard: positions.get((tab_ids.get(dashcard['dashboard_tab_id']), dashcard['row'], dashcard['col']))
+
+    ids = { 'tabs': {}, 'dashcards': {} }
+    for source, written in zip(payload['tabs'], layout['tabs']):
+        if tab_ids.get(written['id']) is not None:
+            ids['tabs'][str(source['id'])] = tab_ids[written['id']]
+    for source, written in zip(payload['dashcards'], layout['dashcards']):
+        if dashcard_id(written) is not None:
+            ids['dashcards'][str(source['id'])] = dashcard_id(written)
+    return ids
+
+
+
+def _get_pulse_payload(pulse, collection_id, card_ids, postfix=''):
+    """The definition of the copy of a pulse (see sync_collection), using the copies of the cards in card_ids"""
+    cards = [ dict({ key: card[key] for key in PULSE_CARD_KEYS if key in card }, id=card_ids.get(card['id'], card['id']))
+              for card in pulse.get('cards') or [] ]
+    channels = []
+    for channel in pulse.get('channels') or []:
+        channel = { key: channel[key] for key in PULSE_CHANNEL_KEYS if key in channel }
+        # only the ids of the users (or the addresses of other recipients), as their other details change over time
+        channel['recipients'] = [ {'id': i['id']} if i.get('id') is not None else {'email': i['email']} for i in channel.get('recipients') or [] ]
+        channels.append(channel)
+    return { 'name': pulse['name'] + postfix,
+             'collection_id': collection_id,
+             'cards': cards,
+             'channels': channels,
+             'skip_if_empty': pulse.get('skip_if_empty', False),
+             'parameters': pulse.get('parameters') or [] }
+
+
+
+def _get_payload_hash(model, payload):
+    return hashlib.sha256(json.dumps([model, payload], sort_keys=True).encode('utf-8')).hexdigest()
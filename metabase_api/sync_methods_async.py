@@ -0,0 +1,207 @@
+from ._copy_journal import SyncMapping
+from .bundle_methods_async import _amap
+from .sync_methods import _get_card_payload, _get_dashboard_payload, _get_pulse_payload, _get_payload_hash, \
+                          _get_destination_layout, _get_layout_ids
+
+
+
+async def sync_collection(self, mapping_path, source_collection_name=None, source_collection_id=None,
+                          destination_parent_collection_name=None, destination_parent_collection_id=None,
+                          destination_collection_name=None, child_items_postfix='', archive_removed=False,
+                          concurrency=4, dry_run=False, verbose=False):
+    """
+    Async version of sync_collection.
+    Keep a copy of the collection with the given name/id up to date: only the new items are created, the copies whose
+    definition changed since the last sync (see the mapping file) are updated and, with archive_removed, the copies of
+    the removed items are archived. The dashcards of the changed dashboards that were already copied are updated in place.
+    Up to `concurrency` definitions are fetched and cards/dashboards/pulses written at the same time.
+    """
+    if not source_collection_id:
+        if not source_collection_name:
+            raise ValueError('Either the name or id of the source collection must be provided.')
+        else:
+            source_collection_id = await self.get_item_id('collection', source_collection_name)
+
+    if not destination_parent_collection_id:
+        if not destination_parent_collection_name:
+            raise ValueError('Either the name or id of the destination parent collection must be provided.')
+        elif destination_parent_collection_name != 'Root':
+            destination_parent_collection_id = await self.get_item_id('collection', destination_parent_collection_name)
+
+    # Get the source as it is now (the listings are fetched again)
+    for item_type in ['collection', 'card', 'dashboard', 'pulse']:
+        self.invalidate_cache(item_type)
+    # The card listing has the definitions of the cards, so it is also used for the card index (instead of being fetched twice)
+    card_list = await self._get_item_list('card')
+    if self.metadata_store:
+        self.metadata_store.update_items('card', card_list)
+    self._item_index.set('card', card_list)
+    tree = await self.get_collection_tree()
+    contents = await self._get_collection_contents(source_collection_id, concurrency)
+    if not destination_collection_name:
+        destination_collection_name = tree.get_name(source_collection_id)
+    cards = {i['id']: i for i in card_list}
+    items = [item for collection_items in contents.values() for item in collection_items if item['model'] in ['card', 'dashboard', 'pulse']]
+    definitions = {('card', item['id']): cards[item['id']] for item in items if item['model'] == 'card'}
+    to_fetch = [item for item in items if item['model'] in ['dashboard', 'pulse']]
+
+    async def fetch(item):
+        return item, await self.get(f'/api/{item["model"]}/{item["id"]}')
+
+    async for item, definition in _amap(fetch, to_fetch, concurrency):
+        if not definition:
+            raise ValueError(f'There is no {item["model"]} with the id "{item["id"]}"')
+        definitions[(item['model'], item['id'])] = definition
+
+    mapping = SyncMapping(mapping_path)
+    report = {'collection_id': None, 'created': [], 'updated': [], 'unchanged': [], 'removed': []}
+    try:
+        entries = mapping.entries()  # The first item of a mapping is the synced collection
+        if entries and (entries[0]['model'], entries[0]['source_id']) != ('collection', source_collection_id):
+            raise ValueError(f'The mapping file {mapping_path} belongs to the sync of another collection')
+
+        async def sync(model, source_id, payload):
+            return source_id, await self._sync_item(mapping, report, model, source_id, payload, dry_run, verbose)
+
+        # The collections (parents before children)
+        collection_ids = {}
+        for collection_id in tree.iter_subtree(source_collection_id):
+            if collection_id == source_collection_id:
+                payload = {'name': destination_collection_name, 'parent_id': destination_parent_collection_id}
+            else:
+                payload = {'name': tree.get_name(collection_id) + child_items_postfix,
+                           'parent_id': collection_ids[tree.get_parent_id(collection_id)]}
+            collection_ids[collection_id] = (await sync('collection', collection_id, payload))[1]
+        report['collection_id'] = collection_ids[source_collection_id]
+
+        # The cards
+        source_cards = [definitions[('card', item['id'])] for item in items if item['model'] == 'card']
+
+        async def sync_card(card):
+            return await sync('card', card['id'], _get_card_payload(card, collection_ids[card['collection_id']], child_items_postfix))
+
+        card_ids = {card_id: destination_id async for card_id, destination_id in _amap(sync_card, source_cards, concurrency)}
+
+        # The dashboards (using the copies of the cards of the source collection)
+        dashboards = [definitions[('dashboard', item['id'])] for item in items if item['model'] == 'dashboard']
+
+        async def sync_dashboard(dashboard):
+            return await sync('dashboard', dashboard['id'], _get_dashboard_payload(dashboard, collection_ids[dashboard['collection_id']],
+                                                                                     card_ids, child_items_postfix))
+
+        async for _ in _amap(sync_dashboard, dashboards, concurrency):
+            pass
+
+        # The pulses (using the copies of the cards of the source collection)
+        pulses = [definitions[('pulse', item['id'])] for item in items if item['model'] == 'pulse']
+
+        async def sync_pulse(pulse):
+            return await sync('pulse', pulse['id'], _get_pulse_payload(pulse, collection_ids[pulse['collection_id']], card_ids, child_items_postfix))
+
+        async for _ in _amap(sync_pulse, pulses, concurrency):
+            pass
+
+        # The items that are not in the source anymore
+        source_items = {('collection', i) for i in collection_ids} | {(item['model'], item['id']) for item in items}
+        removed = [entry for entry in mapping.entries() if (entry['model'], entry['source_id']) not in source_items]
+        for entry in sorted(removed, key=lambda entry: entry['model'] == 'collection'):  # collections last
+            report['removed'].append(entry)
+            if archive_removed and not dry_run:
+                self.verbose_print(verbose, f'Archiving the {entry["model"]} "{entry["name"]}" ...')
+                res = await self.put(f'/api/{entry["model"]}/{entry["destination_id"]}', 'raw', json={'archived': True})
+                if res.status_code not in [200, 202, 404]:
+                    raise ValueError(f'Error archiving the {entry["model"]} "{entry["name"]}": {res.text}')
+                mapping.remove(entry['model'], entry['source_id'])
+    finally:
+        mapping.close()
+        if not dry_run:
+            for item_type in ['collection', 'card', 'dashboard', 'pulse']:
+                self.invalidate_cache(item_type)
+    return report
+
+
+async def _sync_item(self, mapping, report, model, source_id, payload, dry_run=False, verbose=False):
+    """Async version of _sync_item"""
+    entry = mapping.get(model, source_id)
+    payload_hash = _get_payload_hash(model, payload)
+    if entry is not None and entry['hash'] == payload_hash:
+        report['unchanged'].append(entry)
+        return entry['destination_id']
+
+    destination_id = entry['destination_id'] if entry is not None else None
+    layout_ids = None
+    if not dry_run:
+        if model == 'dashboard':
+            destination_id, layout_ids = await self._write_synced_dashboard(destination_id, payload, entry, verbose)
+        else:
+            if destination_id is not None:
+                self.verbose_print(verbose, f'Updating the {model} "{payload["name"]}" ...')
+                if not await self._update_synced_item(model, destination_id, payload):
+                    destination_id = None  # the copy was deleted
+            if destination_id is None:
+                self.verbose_print(verbose, f'Creating the {model} "{payload["name"]}" ...')
+                destination_id = await self._create_synced_item(model, payload)
+
+    new_entry = {'model': model, 'source_id': source_id, 'destination_id': destination_id, 'name': payload['name'], 'hash': payload_hash}
+    if layout_ids:
+        new_entry.update(layout_ids)
+    if not dry_run:
+        mapping.record(new_entry)
+    report['created' if entry is None else 'updated'].append(new_entry)
+    return destination_id
+
+
+async def _create_synced_item(self, model, payload):
+    """Async version of _create_synced_item"""
+    if model == 'collection':
+        res = await self.create_collection(payload['name'], parent_collection_id=payload['parent_id'],
+                                           parent_collection_name='Root', return_results=True)
+        return res['id']
+
+    if model == 'card':
+        res = await self.create_card(custom_json=dict(payload), return_card=True)
+        if not res:
+            raise ValueError(f'Error creating the card "{payload["name"]}"')
+        return res['id']
+
+    res = await self.post(f'/api/{model}/', 'raw', json=payload)
+    if res.status_code != 200:
+        raise ValueError(f'Error creating the {model} "{payload["name"]}": {res.text}')
+    return res.json()['id']
+
+
+async def _write_synced_dashboard(self, destination_id, payload, entry=None, verbose=False):
+    """Async version of _write_synced_dashboard"""
+    current = await self.get(f'/api/dashboard/{destination_id}') if destination_id is not None else None
+    if current:
+        self.verbose_print(verbose, f'Updating the dashboard "{payload["name"]}" ...')
+        body = dict(payload)
+    else:  # New, or the copy was deleted
+        self.verbose_print(verbose, f'Creating the dashboard "{payload["name"]}" ...')
+        res = await self.post('/api/dashboard/', 'raw', json={key: value for key, value in payload.items() if key not in ['tabs', 'dashcards']})
+        if res.status_code != 200:
+            raise ValueError(f'Error creating the dashboard "{payload["name"]}": {res.text}')
+        destination_id = res.json()['id']
+        current = {}
+        body = {}
+
+    layout = _get_destination_layout(payload, entry, current)
+    body.update(layout)
+    res = await self.put(f'/api/dashboard/{destination_id}', 'raw', json=body)
+    if res.status_code not in [200, 202]:
+        raise ValueError(f'Error writing the dashcards of the dashboard "{payload["name"]}": {res.text}')
+
+    # The ids of the tabs and dashcards created by Metabase are read back
+    created = any(i['id'] < 0 for i in layout['tabs'] + layout['dashcards'])
+    dashboard = await self.get(f'/api/dashboard/{destination_id}') if created else None
+    return destination_id, _get_layout_ids(payload, layout, dashboard)
+
+
+async def _update_synced_item(self, model, destination_id, payload):
+    """Async version of _update_synced_item"""
+    res = await self.put(f'/api/{model}/{destination_id}', 'raw', json=payload)
+    if res.status_code == 404:
+        return False
+    if res.status_code not in [200, 202]:
+        raise ValueError(f'Error updating the {model} "{payload["name"]}": {res.text}')
+    return True
@@ -5,7 +5,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="metabase-api",
-    version="3.6", 
+    version="3.7", 
     author="Vahid Vaezian",
     author_email="vahid.vaezian@gmail.com",
     description="A Python Wrapper for Metabase API",
@@ -17,6 +17,10 @@ setuptools.setup(
         "requests",
         "httpx",
     ],
+    extras_require={
+        "numpy": ["numpy"],
+        "pyarrow": ["pyarrow"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import httpx
+import requests
+
+from metabase_api import Metabase_API, Metabase_API_Async
+from metabase_api._bundle import BundleWriter, make_card_json, remap_visualization_settings, find_visualization_references, \
+                                 strip_item_links, REFERENCE_KINDS
+
+
+MAPPING = {'database': {1: 11}, 'table': {2: 22}, 'field': {3: 33, 4: 44}, 'segment': {}, 'card': {5: 55}, 'dashboard': {6: 66}}
+
+
+def remap(kind, source_id):
+  if source_id not in MAPPING[kind]:
+    raise ValueError('The {} with the id "{}" is not in the bundle'.format(kind, source_id))
+  return MAPPING[kind][source_id]
+
+
+def click_behavior(link_type, target_id):
+  return {'type': 'link', 'linkType': link_type, 'targetId': target_id,
+          'parameterMapping': {'["dimension",["field",4,null]]': {
+            'id': '["dimension",["field",4,null]]',
+            'source': {'type': 'column', 'id': 'CATEGORY', 'name': 'Category'},
+            'target': {'type': 'dimension', 'id': '["dimension",["field",4,null]]', 'dimension': ['dimension', ['field', 4, None]]}}}}
+
+
+SETTINGS = {
+  'table.pivot': False,
+  'table.columns': [{'name': 'CATEGORY', 'fieldRef': ['field', 3, None], 'enabled': True}],
+  'column_settings': {
+    '["ref",["field",3,null]]': {'column_title': 'Category', 'click_behavior': click_behavior('question', 5)},
+    '["ref",["field",9,null]]': {'column_title': 'Unknown'},
+    '["name","count"]': {'column_title': 'Count'},
+  },
+  'click_behavior': click_behavior('dashboard', 6),
+}
+
+
+class RemapVisualizationSettings_Test(unittest.TestCase):
+
+  def test_column_settings(self):
+    column_settings = remap_visualization_settings(SETTINGS, remap)['column_settings']
+    # the keys are remapped (in the format of Metabase), the columns that cannot be remapped are dropped
+    self.assertEqual(list(column_settings), ['["ref",["field",33,null]]', '["name","count"]'])
+    self.assertEqual(column_settings['["name","count"]'], {'column_title': 'Count'})
+
+
+  def test_click_behaviors(self):
+    settings = remap_visualization_settings(SETTINGS, remap)
+    column_click = settings['column_settings']['["ref",["field",33,null]]']['click_behavior']
+    self.assertEqual(column_click['targetId'], 55)
+    self.assertEqual(list(column_click['parameterMapping']), ['["dimension",["field",44,null]]'])
+    target = column_click['parameterMapping']['["dimension",["field",44,null]]']['target']
+    self.assertEqual(target, {'type': 'dimension', 'id': '["dimension",["field",44,null]]', 'dimension': ['dimension', ['field', 44, None]]})
+    self.assertEqual(settings['click_behavior']['targetId'], 66)
+    self.assertEqual(settings['table.columns'][0]['fieldRef'], ['field', 33, None])
+    self.assertIs(settings['table.pivot'], False)
+
+    # the click behaviors whose target cannot be remapped are dropped (but not the rest of the settings)
+    settings = remap_visualization_settings(dict(SETTINGS, click_behavior=click_behavior('dashboard', 7)), remap)
+    self.assertNotIn('click_behavior', settings)
+    self.assertIn('column_settings', settings)
+    settings = remap_visualization_settings({'column_settings': {'["ref",["field",3,null]]': {
+      'column_title': 'Category', 'click_behavior': click_behavior('question', 8)}}}, remap)
+    self.assertEqual(settings['column_settings'], {'["ref",["field",33,null]]': {'column_title': 'Category'}})
+
+    # the links to urls are kept as they are
+    url_click = {'type': 'link', 'linkType': 'url', 'linkTemplate': 'https://example.com/{{CATEGORY}}'}
+    self.assertEqual(remap_visualization_settings({'click_behavior': url_click}, remap), {'click_behavior': url_click})
+
+
+  def test_source_is_not_modified(self):
+    source = json.dumps(SETTINGS, sort_keys=True)
+    remap_visualization_settings(SETTINGS, remap)
+    self.assertEqual(json.dumps(SETTINGS, sort_keys=True), source)
+    self.assertEqual(remap_visualization_settings(None, remap), {})
+
+
+  def test_dropped(self):
+    dropped = []
+    remap_visualization_settings(dict(SETTINGS, click_behavior=click_behavior('dashboard', 7)), remap, dropped)
+    self.assertEqual([ i['setting'] for i in dropped ], [['column_settings', '["ref",["field",9,null]]'], ['click_behavior']])
+    self.assertIn('"7"', dropped[1]['error'])
+
+
+  def test_strip_item_links(self):
+    stripped = strip_item_links(SETTINGS)
+    self.assertNotIn('click_behavior', stripped)
+    self.assertEqual(stripped['column_settings']['["ref",["field",3,null]]'], {'column_title': 'Category'})
+    url_click = {'type': 'link', 'linkType': 'url', 'linkTemplate': 'https://example.com/{{CATEGORY}}'}
+    self.assertEqual(strip_item_links({'click_behavior': url_click}), {'click_behavior': url_click})
+
+
+  def test_find_references(self):
+    references = find_visualization_references(SETTINGS, { kind: set() for kind in REFERENCE_KINDS })
+    # the targets of click behaviors are not bundle references (they are dropped if they are not imported)
+    self.assertEqual(references, {'database': set(), 'table': set(), 'field': {3, 4, 9}, 'segment': set(), 'card': set()})
+
+
+  def test_make_card_json(self):
+    card = {'id': 5, 'name': 'Orders', 'description': '', 'display': 'table', 'collection_id': 1, 'archived': False,
+            'dataset_query': {'type': 'query', 'database': 1, 'query': {'source-table': 2, 'filter': ['=', ['field', 3, None], 'a']}},
+            'visualization_settings': SETTINGS}
+    card_json = make_card_json(card, 100, remap)
+    self.assertEqual(card_json['collection_id'], 100)
+    self.assertIsNone(card_json['description'])
+    self.assertNotIn('archived', card_json)
+    self.assertEqual(card_json['dataset_query'], {'type': 'query', 'database': 11,
+                                                  'query': {'source-table': 22, 'filter': ['=', ['field', 33, None], 'a']}})
+    self.assertEqual(card_json['visualization_settings'], remap_visualization_settings(SETTINGS, remap))
+
+
+
+def link(link_type, target_id):
+  return {'click_behavior': {'type': 'link', 'linkType': link_type, 'targetId': target_id}}
+
+
+def dashboard(dashboard_id, dashcard_id, card_id, settings):
+  return {'id': dashboard_id, 'name': 'dashboard {}'.format(dashboard_id), 'collection_id': 1, 'parameters': [], 'tabs': [],
+          'dashcards': [{'id': dashcard_id, 'card_id': card_id, 'row': 0, 'col': 0, 'size_x': 4, 'size_y': 4,
+                         'visualization_settings': settings, 'parameter_mappings': [], 'series': []}]}
+
+
+QUERY = {'database': 1, 'type': 'query', 'query': {'source-table': 2}}
+
+# a card linking to a dashboard of the bundle, a card linking to a card of the bundle created in the same wave,
+# a card linking to a dashboard outside of the bundle and two dashboards linking to each other
+BUNDLE = {
+  'collection': [{'id': 1, 'name': 'Top', 'parent_id': None}],
+  'card': [{'id': 10, 'name': 'to dashboard', 'display': 'table', 'dataset_query': QUERY, 'collection_id': 1,
+            'visualization_settings': link('dashboard', 51)},
+           {'id': 11, 'name': 'to card', 'display': 'table', 'dataset_query': QUERY, 'collection_id': 1,
+            'visualization_settings': {'column_settings': {'["ref",["field",3,null]]': link('question', 12)}}},
+           {'id': 12, 'name': 'outside', 'display': 'table', 'dataset_query': QUERY, 'collection_id': 1,
+            'visualization_settings': dict(link('dashboard', 99), **{'table.pivot': False})}],
+  'dashboard': [dashboard(50, 500, 10, link('dashboard', 51)), dashboard(51, 510, 11, link('dashboard', 50))],
+  'database': [{'id': 1, 'name': 'db'}],
+  'table': [{'id': 2, 'name': 'orders', 'db_id': 1}],
+  'field': [{'id': 3, 'name': 'status', 'table_id': 2}],
+}
+
+
+class _FakeMetabase():
+  """The endpoints of a Metabase (with other ids than the bundle) used by import_collection_bundle"""
+
+  def __init__(self):
+    self.next_id = 1000
+    self.created = {}  # id -> json of the created card or dashboard
+    self.updates = {}  # id -> json of the PUT request
+
+  def handle(self, method, path, body):
+    if method == 'GET' and path == '/api/database/':
+      return 200, {'data': [{'id': 7, 'name': 'db'}]}
+    if method == 'GET' and path == '/api/table/':
+      return 200, [{'id': 8, 'name': 'orders', 'db_id': 7}]
+    if method == 'GET' and path == '/api/table/8/query_metadata':
+      return 200, {'fields': [{'id': 9, 'name': 'status'}]}
+    if method == 'POST' and re.match('^/api/(collection|card|dashboard)/?$', path):
+      self.next_id += 1
+      self.created[self.next_id] = body
+      return 200, {'id': self.next_id}
+    if method == 'PUT' and re.match(r'^/api/(card|dashboard)/\d+$', path):
+      self.updates[int(path.split('/')[-1])] = body
+      return 200, {}
+    return 404, {}
+
+
+
+class _FakeSession(requests.Session):
+
+  def __init__(self, metabase):
+    super().__init__()
+    self.metabase = metabase
+
+  def request(self, method, url, **kwargs):
+    status, body = self.metabase.handle(method, url[len('http://metabase'):], kwargs.get('json'))
+    res = requests.Response()
+    res.status_code = status
+    res._content = json.dumps(body).encode()
+    return res
+
+
+
+class ImportCollectionBundle_Test(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'bundle.jsonl.gz')
+    writer = BundleWriter(self.path)
+    for kind, objects in BUNDLE.items():
+      for obj in objects:
+        writer.write(kind, obj)
+    writer.close()
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir, ignore_errors=True)
+
+
+  def check_import(self, metabase, report):
+    cards = report['created']['card']
+    dashboards = report['created']['dashboard']
+    self.assertEqual(sorted(dashboards), [50, 51])
+
+    # the links are set once everything is created, whatever the order of creation
+    self.assertNotIn('click_behavior', metabase.created[cards[10]]['visualization_settings'])
+    self.assertEqual(metabase.updates[cards[10]]['visualization_settings']['click_behavior']['targetId'], dashboards[51])
+    column_settings = metabase.updates[cards[11]]['visualization_settings']['column_settings']
+    self.assertEqual(column_settings, {'["ref",["field",9,null]]': {'click_behavior': {'type': 'link', 'linkType': 'question', 'targetId': cards[12]}}})
+    settings = [ metabase.updates[dashboards[i]]['dashcards'][0]['visualization_settings'] for i in [50, 51] ]
+    self.assertEqual([ i['click_behavior']['targetId'] for i in settings ], [dashboards[51], dashboards[50]])
+    self.assertEqual(metabase.updates[dashboards[50]]['dashcards'][0]['card_id'], cards[10])
+
+    # the link to a dashboard outside of the bundle is dropped and reported
+    self.assertEqual(metabase.updates[cards[12]]['visualization_settings'], {'table.pivot': False})
+    self.assertEqual([ (i['kind'], i['id'], i['setting']) for i in report['dropped'] ], [('card', 12, ['click_behavior'])])
+
+
+  def test_import(self):
+    metabase = _FakeMetabase()
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase))
+    self.check_import(metabase, mb.import_collection_bundle(self.path, destination_parent_collection_id=5, concurrency=3))
+
+
+  def test_import_async(self):
+    metabase = _FakeMetabase()
+
+    def handler(request):
+      status, body = metabase.handle(request.method, request.url.path, json.loads(request.content) if request.content else None)
+      return httpx.Response(status, json=body)
+
+    async def run():
+      mb = Metabase_API_Async('http://metabase', api_key='key')
+      await mb._client.aclose()
+      mb._client = httpx.AsyncClient(base_url=mb.domain, headers=mb.header, transport=httpx.MockTransport(handler))
+      try:
+        return await mb.import_collection_bundle(self.path, destination_parent_collection_id=5, concurrency=3)
+      finally:
+        await mb._client.aclose()
+
+    self.check_import(metabase, asyncio.run(run()))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import re
+import unittest
+
+import httpx
+import requests
+
+from metabase_api import Metabase_API, Metabase_API_Async
+
+
+COLLECTIONS = [{'id': 1, 'name': 'Top', 'location': '/'}, {'id': 2, 'name': 'Sub', 'location': '/1/'},
+               {'id': 3, 'name': 'Other', 'location': '/'}]
+ITEMS = {1: [{'model': 'collection', 'id': 2, 'name': 'Sub'}, {'model': 'card', 'id': 10, 'name': 'q'},
+             {'model': 'dataset', 'id': 11, 'name': 'm'}, {'model': 'pulse', 'id': 30, 'name': 'p'}],
+         2: [{'model': 'dashboard', 'id': 20, 'name': 'd'}]}
+LISTINGS = {'card': [{'id': 10, 'name': 'q', 'collection_id': 1}, {'id': 11, 'name': 'm', 'collection_id': 1, 'type': 'model'},
+                     {'id': 12, 'name': 'x', 'collection_id': 3}],
+            'dashboard': [{'id': 20, 'name': 'd', 'collection_id': 2}],
+            'pulse': [{'id': 30, 'name': 'p', 'collection_id': 1}, {'id': 31, 'name': 's', 'collection_id': 1, 'dashboard_id': 20}]}
+CONTENTS = {1: [{'model': 'collection', 'id': 2, 'name': 'Sub'}, {'model': 'card', 'id': 10, 'name': 'q'},
+                {'model': 'pulse', 'id': 30, 'name': 'p'}],
+            2: [{'model': 'dashboard', 'id': 20, 'name': 'd'}]}
+
+
+def handle(path, requested):
+  if path == '/api/database/1':  # the check of the api key
+    return {}
+  requested.append(path)
+  if path == '/api/collection/':
+    return COLLECTIONS
+  match = re.match(r'^/api/collection/(\d+)/items$', path)
+  if match:
+    return {'data': ITEMS.get(int(match.group(1)), [])}
+  return LISTINGS[path.split('/')[2]]
+
+
+
+class _FakeSession(requests.Session):
+
+  def __init__(self):
+    super().__init__()
+    self.requested = []
+
+  def request(self, method, url, **kwargs):
+    res = requests.Response()
+    res.status_code = 200
+    res._content = json.dumps(handle(url[len('http://metabase'):], self.requested)).encode()
+    return res
+
+
+
+def sort(contents):
+  return { i: sorted(items, key=lambda item: (item['model'], item['id'])) for i, items in contents.items() }
+
+
+
+class CollectionContents_Test(unittest.TestCase):
+
+  def test_items_of_the_subtree(self):
+    session = _FakeSession()
+    mb = Metabase_API('http://metabase', api_key='key', session=session)
+    self.assertEqual(sort(mb._get_collection_contents(1)), sort(CONTENTS))
+    # only the collections of the subtree are fetched, not the listings of all the items
+    self.assertEqual(sorted(session.requested), ['/api/collection/', '/api/collection/1/items', '/api/collection/2/items'])
+
+
+  def test_cached_listings(self):
+    session = _FakeSession()
+    mb = Metabase_API('http://metabase', api_key='key', session=session, cache_ttl=600)
+    for model in ['card', 'dashboard', 'pulse']:
+      mb._get_item_index(model)
+    del session.requested[:]
+    self.assertEqual(sort(mb._get_collection_contents(1)), sort(CONTENTS))
+    self.assertEqual(session.requested, ['/api/collection/'])
+
+
+  def test_async(self):
+    requested = []
+
+    def handler(request):
+      return httpx.Response(200, json=handle(request.url.path, requested))
+
+    async def run():
+      mb = Metabase_API_Async('http://metabase', api_key='key')
+      await mb._client.aclose()
+      mb._client = httpx.AsyncClient(base_url=mb.domain, headers=mb.header, transport=httpx.MockTransport(handler))
+      try:
+        return await mb._get_collection_contents(1, concurrency=2)
+      finally:
+        await mb._client.aclose()
+
+    self.assertEqual(sort(asyncio.run(run())), sort(CONTENTS))
+    self.assertEqual(sorted(requested), ['/api/collection/', '/api/collection/1/items', '/api/collection/2/items'])
+
+
+if __name__ == '__main__':
+  unittest.main()
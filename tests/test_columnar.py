@@ -0,0 +1,114 @@
+import math
+import unittest
+from array import array
+
+from metabase_api._columnar import to_columnar, get_export_cols, ColumnarBuilder
+from metabase_api._streaming import JSONArrayDecoder
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+
+COLS = [{'name': 'i', 'base_type': 'type/Integer'}, {'name': 'n', 'base_type': 'type/BigInteger'},
+        {'name': 'f', 'base_type': 'type/Float'}, {'name': 'b', 'base_type': 'type/Boolean'},
+        {'name': 's', 'base_type': 'type/Text'}, {'name': 'big', 'base_type': 'type/BigInteger'}]
+ROWS = [[1, 1, 1.5, True, 'a', 1], [2, None, None, False, None, 2**70], [3, 3, 2, True, 'c', 3]]
+
+
+class Columnar_Test(unittest.TestCase):
+
+  def check_array(self, result):
+    self.assertEqual(result['columns'], ['i', 'n', 'f', 'b', 's', 'big'])
+    i, n, f, b, s, big = result['data']
+    self.assertEqual((i.typecode, list(i)), ('q', [1, 2, 3]))
+    self.assertEqual(n.typecode, 'd')  # an integer column with nulls
+    self.assertTrue(math.isnan(n[1]))
+    self.assertEqual((f.typecode, f[0], f[2]), ('d', 1.5, 2.0))
+    self.assertTrue(math.isnan(f[1]))
+    self.assertEqual((b.typecode, list(b)), ('b', [1, 0, 1]))
+    self.assertEqual(s, ['a', None, 'c'])
+    self.assertEqual(big, [1, 2**70, 3])  # does not fit in 64 bits
+
+
+  def test_array(self):
+    self.check_array(to_columnar(COLS, ROWS))
+
+
+  def test_batches(self):
+    # the rows are added batch by batch, a column changing type in a later batch
+    builder = ColumnarBuilder(COLS)
+    for row in ROWS:
+      builder.add_rows([row])
+    self.check_array(builder.finish())
+    self.assertEqual(builder.get_columns(), [ list(column) for column in zip(*ROWS) ])
+    self.check_array(ColumnarBuilder.from_columns(COLS, builder.get_columns()).finish())
+
+
+  def test_invalid_cells(self):
+    builder = ColumnarBuilder([{'name': 'i', 'base_type': 'type/Integer'}, {'name': 'b', 'base_type': 'type/Boolean'}])
+    builder.add_rows([[1, None], [None, True]])
+    builder.add_rows([[2, 'x'], ['3', False]])
+    self.assertEqual(builder.finish()['data'], [[1, None, 2, '3'], [None, True, 'x', False]])
+    self.assertEqual(to_columnar(COLS, [])['data'][0], array('q'))
+
+
+  @unittest.skipIf(np is None, 'numpy is not installed')
+  def test_numpy(self):
+    i, n, f, b, s, big = to_columnar(COLS, ROWS, 'numpy')['data']
+    self.assertEqual((i.dtype, list(i)), (np.int64, [1, 2, 3]))
+    self.assertEqual(n.dtype, np.float64)
+    self.assertTrue(np.isnan(n[1]))
+    self.assertEqual(b.dtype, np.bool_)
+    self.assertEqual(list(b), [True, False, True])
+    self.assertEqual((s.dtype, list(s)), (object, ['a', None, 'c']))
+    self.assertEqual(list(big), [1, 2**70, 3])
+
+
+  @unittest.skipIf(pa is None, 'pyarrow is not installed')
+  def test_pyarrow(self):
+    table = to_columnar(COLS, ROWS, 'pyarrow')
+    self.assertEqual([ str(i) for i in table.schema.types ], ['int64', 'int64', 'double', 'bool', 'string', 'string'])
+    self.assertEqual(table.column('n').to_pylist(), [1, None, 3])
+    self.assertEqual(table.column('f').to_pylist(), [1.5, None, 2.0])
+    self.assertEqual(table.column('b').to_pylist(), [True, False, True])
+    builder = ColumnarBuilder([{'name': 'b', 'base_type': 'type/Boolean'}])
+    builder.add_rows([[True], [None]])
+    self.assertEqual(builder.finish('pyarrow').column('b').to_pylist(), [True, None])
+
+
+
+class ExportCols_Test(unittest.TestCase):
+
+  def test_duplicate_names(self):
+    # two columns with the same display name are two keys of the objects of the export
+    decoder = JSONArrayDecoder(pairs=True)
+    rows = decoder.feed(b'[{"Total": 1, "Total": 2.5, "Meta": {"a": [{"b": 1}]}},') \
+           + decoder.feed(b'{"Total": 3, "Total": null, "Meta": null}]') + decoder.close()
+    self.assertEqual(len(rows), 2)
+    self.assertEqual(rows[0], [('Total', 1), ('Total', 2.5), ('Meta', {'a': [{'b': 1}]})])
+
+    metadata = [{'name': 'TOTAL', 'base_type': 'type/Integer'}, {'name': 'TOTAL_2', 'base_type': 'type/Float'}, {'name': 'META'}]
+    cols = get_export_cols(metadata, [ key for key, value in rows[0] ])
+    self.assertEqual(cols, metadata)
+    result = to_columnar(cols, [ [ value for key, value in row ] for row in rows ])
+    self.assertEqual(result['columns'], ['TOTAL', 'TOTAL_2', 'META'])
+    self.assertEqual(list(result['data'][0]), [1, 3])
+    self.assertEqual(result['data'][1][0], 2.5)
+
+    # untyped columns named after the keys when the metadata does not match
+    self.assertEqual(get_export_cols(metadata[:1], ['Total', 'Total']), [{'name': 'Total'}, {'name': 'Total'}])
+
+
+  def test_default_decoder(self):
+    decoder = JSONArrayDecoder()
+    self.assertEqual(decoder.feed(b'[{"a": 1, "a": 2}]') + decoder.close(), [{'a': 2}])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,141 @@
+import json
+import re
+import unittest
+
+import requests
+
+from metabase_api import Metabase_API
+from metabase_api.copy_methods import _get_dashboard_card_names, _get_dashboard_layout
+
+
+TARGET = ['dimension', ['field', 7, None]]
+
+# a dashboard (as returned by GET /api/dashboard/:id) with two tabs, a card used twice, a card added as a series
+# of another card and a text card (which has no card)
+DASHBOARD = {
+  'id': 1,
+  'name': 'Sales',
+  'tabs': [{'id': 10, 'name': 'Overview', 'position': 0}, {'id': 11, 'name': 'Details', 'position': 1}],
+  'dashcards': [
+    {'id': 100, 'card_id': 5, 'card': {'id': 5, 'name': 'Orders'}, 'dashboard_tab_id': 10, 'action_id': None,
+     'row': 0, 'col': 0, 'size_x': 6, 'size_y': 4, 'visualization_settings': {'card.title': 'All orders'},
+     'series': [{'id': 6, 'name': 'Returns'}],
+     'parameter_mappings': [{'parameter_id': 'p1', 'card_id': 5, 'target': TARGET}]},
+    {'id': 101, 'card_id': 6, 'card': {'id': 6, 'name': 'Returns'}, 'dashboard_tab_id': 11, 'action_id': None,
+     'row': 0, 'col': 0, 'size_x': 4, 'size_y': 3, 'visualization_settings': None, 'series': [],
+     'parameter_mappings': [{'parameter_id': 'p1', 'card_id': 6, 'target': TARGET}]},
+    {'id': 102, 'card_id': 5, 'card': {'id': 5, 'name': 'Orders'}, 'dashboard_tab_id': 11, 'action_id': None,
+     'row': 3, 'col': 0, 'size_x': 4, 'size_y': 3, 'visualization_settings': {}, 'series': None,
+     'parameter_mappings': []},
+    {'id': 103, 'card_id': None, 'card': {'id': None, 'name': None}, 'dashboard_tab_id': 10, 'action_id': None,
+     'row': 4, 'col': 0, 'size_x': 6, 'size_y': 1, 'visualization_settings': {'text': '# Notes', 'virtual_card': {'display': 'text'}},
+     'series': [], 'parameter_mappings': []},
+  ],
+}
+
+
+class DashboardLayout_Test(unittest.TestCase):
+
+  def test_card_names(self):
+    self.assertEqual(_get_dashboard_card_names(DASHBOARD), {5: 'Orders', 6: 'Returns'})
+    self.assertEqual(_get_dashboard_card_names({'dashcards': []}), {})
+    self.assertEqual(_get_dashboard_card_names({}), {})
+
+
+  def test_layout(self):
+    layout = _get_dashboard_layout(DASHBOARD, {5: 50, 6: 60})
+
+    # the new tabs and dashcards have negative ids, and the dashcards refer to the new tabs
+    self.assertEqual(layout['tabs'], [{'id': -1, 'name': 'Overview'}, {'id': -2, 'name': 'Details'}])
+    self.assertEqual([ i['id'] for i in layout['dashcards'] ], [-1, -2, -3, -4])
+    self.assertEqual([ i['dashboard_tab_id'] for i in layout['dashcards'] ], [-1, -2, -2, -1])
+
+    # the cards, the series and the parameter mappings use the new cards
+    self.assertEqual([ i['card_id'] for i in layout['dashcards'] ], [50, 60, 50, None])
+    self.assertEqual(layout['dashcards'][0]['series'], [{'id': 60}])
+    self.assertEqual(layout['dashcards'][2]['series'], [])
+    self.assertEqual(layout['dashcards'][0]['parameter_mappings'], [{'parameter_id': 'p1', 'card_id': 50, 'target': TARGET}])
+    self.assertEqual(layout['dashcards'][1]['parameter_mappings'], [{'parameter_id': 'p1', 'card_id': 60, 'target': TARGET}])
+
+    # the rest is copied as it is
+    first = layout['dashcards'][0]
+    self.assertEqual([first['row'], first['col'], first['size_x'], first['size_y']], [0, 0, 6, 4])
+    self.assertEqual(first['visualization_settings'], {'card.title': 'All orders'})
+    self.assertEqual(layout['dashcards'][1]['visualization_settings'], {})
+    self.assertEqual(layout['dashcards'][3]['visualization_settings'], DASHBOARD['dashcards'][3]['visualization_settings'])
+
+    # the source dashboard is not modified
+    self.assertEqual(DASHBOARD['dashcards'][0]['parameter_mappings'][0]['card_id'], 5)
+
+
+  def test_layout_without_tabs(self):
+    dashboard = {'dashcards': [ dict(DASHBOARD['dashcards'][1], dashboard_tab_id=None) ]}
+    layout = _get_dashboard_layout(dashboard, {6: 60})
+    self.assertEqual(layout['tabs'], [])
+    self.assertIsNone(layout['dashcards'][0]['dashboard_tab_id'])
+    self.assertEqual(layout['dashcards'][0]['card_id'], 60)
+
+
+
+class _FakeMetabase(requests.Session):
+  """A source collection (1) with a card and a sub-collection (2) holding another card"""
+
+  def __init__(self):
+    super().__init__()
+    self.requested = []
+    self.next_id = 100
+
+  def request(self, method, url, **kwargs):
+    path = url[len('http://metabase'):]
+    status, body = 200, {}
+    if path == '/api/database/1':  # the check of the api key
+      status = 404
+    else:
+      self.requested.append((method, path))
+    if method == 'POST':
+      self.next_id += 1
+      body = {'id': self.next_id}
+    elif path == '/api/collection/':
+      body = [{'id': 1, 'name': 'Top', 'location': '/'}, {'id': 2, 'name': 'Sub', 'location': '/1/'}]
+    elif re.match(r'^/api/collection/\d+/items$', path):
+      body = {'data': [{'model': 'collection', 'id': 2, 'name': 'Sub'}, {'model': 'card', 'id': 10, 'name': 'a'}]
+                      if path == '/api/collection/1/items' else [{'model': 'card', 'id': 11, 'name': 'b'}]}
+    elif re.match(r'^/api/card/\d+$', path):
+      body = {'id': int(path.split('/')[-1]), 'name': 'card', 'display': 'table', 'collection_id': 1,
+              'dataset_query': {'type': 'native', 'database': 1, 'native': {'query': 'select 1'}}}
+    else:
+      status = 404
+    res = requests.Response()
+    res.status_code = status
+    res._content = json.dumps(body).encode()
+    return res
+
+
+
+class CopyCollection_Test(unittest.TestCase):
+
+  def test_requests(self):
+    session = _FakeMetabase()
+    mb = Metabase_API('http://metabase', api_key='key', session=session)
+    plan = mb.copy_collection(source_collection_id=1, destination_collection_name='Copy', destination_parent_collection_id=5, 
+                              dry_run=True)
+    self.assertEqual(plan['counts'], {'collection': 2, 'card': 2, 'dashboard': 0, 'pulse': 0})
+
+    # the contents are found from the collection tree and the items of the collections of the subtree
+    # (not from the listings of all the cards, dashboards and pulses of Metabase)
+    finding = [('GET', '/api/collection/'), ('GET', '/api/collection/1/items'), ('GET', '/api/collection/2/items')]
+    self.assertEqual(sorted(session.requested[:3]), finding)
+    del session.requested[:]
+
+    report = mb.copy_collection(source_collection_id=1, destination_collection_name='Copy', destination_parent_collection_id=5)
+    self.assertEqual(len(report['copied']), 4)
+    # the collection tree is still cached from the dry run (see the 'cache_ttl' argument of the class)
+    self.assertEqual(sorted(session.requested[:2]), finding[1:])
+    # the plan estimated the rest of the requests
+    self.assertEqual(len(session.requested[2:]), plan['estimated_requests'])
+    self.assertEqual(sorted(session.requested[2:4]), [('GET', '/api/card/10'), ('GET', '/api/card/11')])
+    self.assertTrue(all(method == 'POST' for method, path in session.requested[4:]))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from metabase_api._item_index import ItemIndex
+
+
+COLLECTIONS = [
+  {'id': 2, 'name': 'Finance'},
+  {'id': 3, 'name': 'Reports'},
+  {'id': 4, 'name': 'Reports'},
+  {'id': 5, 'name': 'Old', 'archived': True},
+  {'id': 6, 'name': 'Marketing'},
+  {'id': 7, 'name': 'Marketing', 'archived': True},
+]
+
+CARDS = [
+  {'id': 10, 'name': 'Orders', 'collection_id': 2},
+  {'id': 11, 'name': 'Orders', 'collection_id': 3},
+  {'id': 12, 'name': 'Orders', 'collection_id': None},
+  {'id': 13, 'name': 'Orders', 'collection_id': 6},
+  {'id': 14, 'name': 'Returns', 'collection_id': 2},
+  {'id': 15, 'name': 'Returns', 'collection_id': 2, 'archived': True},
+]
+
+
+class ItemIndexResolve_Test(unittest.TestCase):
+
+  def setUp(self):
+    self.indexes = { 'collection': ItemIndex.index_records([ ItemIndex.make_record(i) for i in COLLECTIONS ]),
+                     'card': ItemIndex.index_records([ ItemIndex.make_record(i) for i in CARDS ]) }
+
+
+  def test_scopes(self):
+    res = ItemIndex.resolve(self.indexes, [ ('card', 'Orders', 'Finance'), ('card', 'Orders', 3), ('card', 'Orders', 'root'),
+                                            ('card', 'Returns'), ('card', 'Orders'), ('card', 'xyz', 'Finance') ])
+    self.assertEqual(res['ids'], { ('card', 'Orders', 'Finance'): 10, ('card', 'Orders', 3): 11,
+                                   ('card', 'Orders', 'root'): 12, ('card', 'Returns'): 14 })
+    self.assertEqual(res['ambiguous'], { ('card', 'Orders'): [10, 11, 12, 13] })
+    self.assertEqual(res['not_found'], [('card', 'xyz', 'Finance')])
+    self.assertEqual(res['invalid_scope'], {})
+
+
+  def test_invalid_scope(self):
+    res = ItemIndex.resolve(self.indexes, [ ('card', 'Orders', 'Reports'), ('card', 'Orders', 'Old'),
+                                            ('card', 'Orders', 'xyz'), ('card', 'Orders', 'Marketing') ])
+    # a collection name matching several collections is not merged into one scope, and a missing (or archived)
+    # collection is not reported as a missing card
+    self.assertEqual(res['invalid_scope'], { ('card', 'Orders', 'Reports'): [3, 4], ('card', 'Orders', 'Old'): [],
+                                             ('card', 'Orders', 'xyz'): [] })
+    self.assertEqual(res['not_found'], [])
+    self.assertEqual(res['ambiguous'], {})
+    # an archived collection with the same name does not make the scope ambiguous
+    self.assertEqual(res['ids'], { ('card', 'Orders', 'Marketing'): 13 })
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,6 +1,10 @@
 from metabase_api.metabase_api import Metabase_API
+from metabase_api import ResultCache
 import datetime
 import unittest
+import json
+import os
+import tempfile
 
 
 mb = Metabase_API('http://localhost:3000', 'abc.xyz@gmail.com', 'xzy12345')
@@ -112,6 +116,57 @@ class Metabase_API_Test(unittest.TestCase):
 
 
 
+  def test_get_item_id_cached(self):
+    mb_cached = Metabase_API('http://localhost:3000', 'abc.xyz@gmail.com', 'xzy12345', cache_ttl=600)
+    self.assertEqual(mb_cached.get_item_id('collection', 'test_collection'), 2)
+
+    # creating an item using the package invalidates the cached index
+    t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    res = mb_cached.create_collection(f'test_get_item_id_cached {t}', parent_collection_id=2, return_results=True)
+    self.assertEqual(mb_cached.get_item_id('collection', f'test_get_item_id_cached {t}'), res['id'])
+
+    # add to cleanup list
+    Metabase_API_Test.cleanup_objects['collection'].append(res['id'])
+
+
+
+  def test_resolve_item_ids(self):
+    res = mb.resolve_item_ids([ ('card', 'test_card'), 
+                                ('card', 'test_card', 'test_collection'),
+                                ('table', 'test_table', 'test_db'),
+                                ('collection', 'test_collection_dup'),
+                                ('dashboard', 'xyz'),
+                                ('card', 'test_card', 'test_collection_dup'),
+                                ('card', 'test_card', 'xyz') ])
+    self.assertEqual(res['ids'], { ('card', 'test_card'): 1, 
+                                   ('card', 'test_card', 'test_collection'): 1,
+                                   ('table', 'test_table', 'test_db'): 10 })
+    self.assertEqual(res['ambiguous'], { ('collection', 'test_collection_dup'): [3, 4] })
+    self.assertEqual(res['not_found'], [('dashboard', 'xyz')])
+    self.assertEqual(res['invalid_scope'], { ('card', 'test_card', 'test_collection_dup'): [3, 4],
+                                             ('card', 'test_card', 'xyz'): [] })
+
+
+
+  def test_get_collection_id_by_path(self):
+    self.assertEqual(mb.get_collection_id_by_path('test_collection'), 2)
+
+    with self.assertRaises(ValueError) as error:
+      mb.get_collection_id_by_path('test_collection/test_collection_dup')
+    self.assertEqual(str(error.exception), 'There is more than one collection with the path "test_collection/test_collection_dup"')
+
+    with self.assertRaises(ValueError) as error:
+      mb.get_collection_id_by_path('test_collection/xyz')
+    self.assertEqual(str(error.exception), 'There is no collection with the path "test_collection/xyz"')
+
+    tree = mb.get_collection_tree()
+    self.assertEqual(tree.get_path(3), 'test_collection/test_collection_dup')
+    self.assertEqual(tree.get_parent_id(4), 2)
+    self.assertTrue({3, 4}.issubset(tree.get_children(2)))
+    self.assertEqual(list(tree.iter_subtree(3)), [3])
+
+
+
   def test_get_db_id_from_table_id(self):
     db_id = mb.get_db_id_from_table_id(9)
     self.assertEqual(db_id, 2)
@@ -132,6 +187,22 @@ class Metabase_API_Test(unittest.TestCase):
     self.assertEqual(id_name_mapping[64], 'CATEGORY')
 
 
+  def test_friendly_names_is_disabled(self):
+    # the setting is disabled on the test instance (get_columns_name_id relies on it)
+    self.assertTrue(mb.friendly_names_is_disabled(refresh=True))
+    self.assertTrue(mb.friendly_names_is_disabled())
+
+    # the value of the setting is returned as a JSON string or as a bare value depending on the version of Metabase
+    from metabase_api._helper_methods import _parse_setting_value
+    res = mb.get('/api/setting/humanization-strategy', 'raw')
+    self.assertEqual(_parse_setting_value(res.status_code, res.text), 'none')
+    self.assertEqual(_parse_setting_value(200, 'none'), 'none')
+    self.assertEqual(_parse_setting_value(200, '"simple"\n'), 'simple')
+    self.assertIsNone(_parse_setting_value(200, ''))
+    self.assertIsNone(_parse_setting_value(200, '<html>'))
+    self.assertIsNone(_parse_setting_value(403, '"none"'))
+
+
 
   ### Testing the Custom Functions
 
@@ -189,6 +260,21 @@ class Metabase_API_Test(unittest.TestCase):
 
 
 
+  def test_create_cards(self):
+    t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    template = {'table_name': 'test_table', 'collection_id': 2}
+    substitutions = [ {'card_name': 'test_create_cards_{}_{}'.format(i, t)} for i in range(3) ] + [ {'card_name': 'x', 'table_name': 'no_such_table'} ]
+    res = mb.create_cards(template, substitutions, concurrency=2)
+    cards = [ i['card'] for i in res if i['card'] ]
+    Metabase_API_Test.cleanup_objects['card'].extend([ card['id'] for card in cards ])
+
+    self.assertEqual([ i['index'] for i in res ], [0, 1, 2, 3])
+    self.assertEqual([ card['name'] for card in cards ], [ i['card_name'] for i in substitutions[:3] ])
+    self.assertEqual({ card['collection_id'] for card in cards }, {2})
+    self.assertEqual(str(res[3]['error']), 'There is no table with the name "no_such_table"')
+
+
+
   def test_create_collection(self):
     t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     res = mb.create_collection(f'test_create_collection {t}', parent_collection_id=2, return_results=True)
@@ -231,6 +317,30 @@ class Metabase_API_Test(unittest.TestCase):
 
 
 
+  def test_copy_dashboard_client_side(self):
+    t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    source = mb.get('/api/dashboard/1')
+
+    # client-side deep copy (the duplicated cards are saved in a new collection)
+    dup_dashboard_id = mb.copy_dashboard(source_dashboard_id=1, destination_collection_id=1, postfix='_dup_client_{}'.format(t), 
+                                         deepcopy=True, client_side=True)
+    cards_collection_id = mb.get_item_id('collection', "{}_dup_client_{}'s cards".format(source['name'], t))
+
+    # add to cleanup list
+    Metabase_API_Test.cleanup_objects['dashboard'].append(dup_dashboard_id)
+    Metabase_API_Test.cleanup_objects['collection'].append(cards_collection_id)
+
+    dup = mb.get('/api/dashboard/{}'.format(dup_dashboard_id))
+    source_card_ids = { i['card_id'] for i in source['dashcards'] if i['card_id'] is not None }
+    dup_card_ids = { i['card_id'] for i in dup['dashcards'] if i['card_id'] is not None }
+    self.assertEqual(len(dup['dashcards']), len(source['dashcards']))
+    self.assertEqual(len(dup.get('tabs') or []), len(source.get('tabs') or []))
+    self.assertEqual(len(dup_card_ids), len(source_card_ids))
+    self.assertFalse(dup_card_ids & source_card_ids)
+    self.assertTrue(all(mb.get('/api/card/{}'.format(card_id))['collection_id'] == cards_collection_id for card_id in dup_card_ids))
+
+
+
   def test_copy_collection(self):
     t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, destination_collection_name='test_copy_collection_{}'.format(t))
@@ -239,6 +349,99 @@ class Metabase_API_Test(unittest.TestCase):
     # add to cleanup list
     Metabase_API_Test.cleanup_objects['collection'].append(new_collection_id)
 
+    # concurrent copy
+    report = mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, 
+                                destination_collection_name='test_copy_collection_concurrent_{}'.format(t), concurrency=4)
+    Metabase_API_Test.cleanup_objects['collection'].append(report['collection_id'])
+    self.assertEqual(report['collection_id'], mb.get_item_id('collection', 'test_copy_collection_concurrent_{}'.format(t)))
+    self.assertEqual(report['copied'][0]['source_id'], 3)
+
+    # resumable copy (the second run finds everything in the journal)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      journal_path = os.path.join(tmp_dir, 'journal.jsonl')
+      report = mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, 
+                                  destination_collection_name='test_copy_collection_journal_{}'.format(t), journal_path=journal_path)
+      Metabase_API_Test.cleanup_objects['collection'].append(report['collection_id'])
+      report2 = mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, 
+                                   destination_collection_name='test_copy_collection_journal_{}'.format(t), journal_path=journal_path)
+      self.assertEqual(report2['collection_id'], report['collection_id'])
+      self.assertEqual(report2['copied'], [])
+      self.assertEqual(len(report2['resumed']), len(report['copied']))
+
+    # plan only
+    plan = mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, dry_run=True)
+    self.assertEqual(plan['estimated_requests'], len(plan['definitions']) + len(report['copied']))
+    self.assertEqual(plan['counts']['card'], len(plan['definitions']))
+    self.assertEqual(plan['skipped'], 0)
+
+    # the plan of a resumed copy skips the items in the journal
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      journal_path = os.path.join(tmp_dir, 'journal.jsonl')
+      report = mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, 
+                                  destination_collection_name='test_copy_collection_plan_{}'.format(t), journal_path=journal_path)
+      Metabase_API_Test.cleanup_objects['collection'].append(report['collection_id'])
+      plan = mb.copy_collection(source_collection_id=3, destination_parent_collection_id=1, journal_path=journal_path, dry_run=True)
+      self.assertEqual(plan['skipped'], len(report['copied']))
+      self.assertEqual(plan['definitions'], {})
+      self.assertEqual(plan['estimated_requests'], 0)
+
+
+  def test_copy_collection_with_pulse(self):
+    t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    res = mb.create_collection('test_copy_collection_pulse_{}'.format(t), parent_collection_id=1, return_results=True)
+    source_collection_id = res['id']
+    Metabase_API_Test.cleanup_objects['collection'].append(source_collection_id)
+    card = mb.copy_card(source_card_id=1, destination_collection_id=source_collection_id, return_card=True)
+    pulse = mb.post('/api/pulse', json={'name': 'test_pulse_{}'.format(t), 'collection_id': source_collection_id, 
+                                        'cards': [{'id': card['id'], 'include_csv': False, 'include_xls': False}], 
+                                        'channels': [{'channel_type': 'email', 'enabled': True, 'recipients': [{'email': 'abc.xyz@gmail.com'}],
+                                                      'schedule_type': 'daily', 'schedule_hour': 8}]})
+    Metabase_API_Test.cleanup_objects['pulse'].append(pulse['id'])
+
+    self.assertIn({'model': 'pulse', 'id': pulse['id'], 'name': pulse['name']}, mb._get_collection_contents(source_collection_id)[source_collection_id])
+    report = mb.copy_collection(source_collection_id=source_collection_id, destination_parent_collection_id=1, 
+                                destination_collection_name='test_copy_collection_pulse_copy_{}'.format(t))
+    Metabase_API_Test.cleanup_objects['collection'].append(report['collection_id'])
+    copied_pulses = [ i for i in report['copied'] if i['model'] == 'pulse' ]
+    self.assertEqual([ i['source_id'] for i in copied_pulses ], [pulse['id']])
+    Metabase_API_Test.cleanup_objects['pulse'].append(copied_pulses[0]['destination_id'])
+
+
+
+  def test_export_import_collection_bundle(self):
+    t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      bundle_path = os.path.join(tmp_dir, 'bundle.jsonl.gz')
+      export_report = mb.export_collection_bundle(bundle_path, source_collection_id=3)
+      self.assertTrue(os.path.exists(bundle_path))
+      self.assertEqual(export_report['counts']['collection'], len(list(mb.get_collection_tree().iter_subtree(3))))
+
+      # import into the same Metabase (the databases, tables and fields are found by name)
+      report = mb.import_collection_bundle(bundle_path, destination_parent_collection_id=1, 
+                                           destination_collection_name='test_import_bundle_{}'.format(t))
+      Metabase_API_Test.cleanup_objects['collection'].append(report['collection_id'])
+      self.assertEqual(report['collection_id'], mb.get_item_id('collection', 'test_import_bundle_{}'.format(t)))
+      self.assertEqual(len(report['created']['card']), export_report['counts'].get('card', 0))
+
+
+
+  def test_sync_collection(self):
+    t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      mapping_path = os.path.join(tmp_dir, 'mapping.jsonl')
+      report = mb.sync_collection(mapping_path, source_collection_id=3, destination_parent_collection_id=1, 
+                                  destination_collection_name='test_sync_collection_{}'.format(t))
+      Metabase_API_Test.cleanup_objects['collection'].append(report['collection_id'])
+      self.assertEqual(report['collection_id'], mb.get_item_id('collection', 'test_sync_collection_{}'.format(t)))
+      self.assertEqual(report['updated'], [])
+
+      # nothing changed in the source, so nothing is written
+      report2 = mb.sync_collection(mapping_path, source_collection_id=3, destination_parent_collection_id=1, 
+                                   destination_collection_name='test_sync_collection_{}'.format(t))
+      self.assertEqual(report2['collection_id'], report['collection_id'])
+      self.assertEqual(report2['created'] + report2['updated'], [])
+      self.assertEqual(len(report2['unchanged']), len(report['created']))
+
 
 
   def test_search(self):
@@ -281,6 +484,96 @@ class Metabase_API_Test(unittest.TestCase):
     filtered_data = [{'col1': 'row1 cell1', 'col2': 1}, {'col1': 'row3 cell1', 'col2': None}]
     self.assertEqual(res, filtered_data)
 
+    # columnar
+    res = mb.get_card_data(card_id=1, data_format='columnar')
+    self.assertEqual(res['columns'], ['col1', 'col2'])
+    self.assertEqual(res['data'][0], ['row1 cell1', None, 'row3 cell1', None, 'row5 cell1'])
+    self.assertEqual(res['data'][1].typecode, 'd')  # integer column with nulls
+    self.assertEqual([ i for i in res['data'][1] if i == i ], [1, 2, 5])  # NaN != NaN
+
+
+
+  def test_iter_card_data(self):
+    # json
+    res = list(mb.iter_card_data(card_id=1))
+    self.assertEqual(res, mb.get_card_data(card_id=1))
+
+    # batches
+    res = list(mb.iter_card_data(card_id=1, batch_size=2))
+    self.assertEqual([ len(batch) for batch in res ], [2, 2, 1])
+
+    # csv
+    res = list(mb.iter_card_data(card_id=1, data_format='csv'))
+    csv_data = [['col1', 'col2'], ['row1 cell1', '1'], ['', '2'], ['row3 cell1', ''], ['', ''], ['row5 cell1', '5']]
+    self.assertEqual(res, csv_data)
+
+
+
+  def test_run_query(self):
+    # MBQL
+    res = mb.run_query({'source-table': 9}, db_id=2)
+    self.assertEqual(res, mb.get_card_data(card_id=1))
+    res = mb.run_query({'source-table': 9}, db_name='test_db', row_limit=2)
+    self.assertEqual(len(res), 2)
+
+    # native
+    res = mb.run_query('select * from test_table2', db_id=2, data_format='raw')
+    self.assertEqual(res['status'], 'completed')
+    with self.assertRaises(ValueError):
+      mb.run_query('select * from test_table2')
+
+    # streamed
+    res = list(mb.iter_query_data({'source-table': 9}, db_id=2))
+    self.assertEqual(res, mb.get_card_data(card_id=1))
+    res = list(mb.iter_query_data({'source-table': 9}, db_id=2, row_limit=3, data_format='csv'))
+    self.assertEqual(res, [['col1', 'col2'], ['row1 cell1', '1'], ['', '2'], ['row3 cell1', '']])
+
+
+
+  def test_get_card_data_cached(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      result_cache = ResultCache(ttl=600, path=tmp_dir)
+      mb_cached = Metabase_API('http://localhost:3000', 'abc.xyz@gmail.com', 'xzy12345', result_cache=result_cache)
+      res = mb_cached.get_card_data(card_id=1)
+      self.assertEqual(res, mb.get_card_data(card_id=1))
+      self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+      # the second call is served from the cache
+      self.assertEqual(mb_cached.get_card_data(card_id=1), res)
+      self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+      # different parameters make a different entry
+      mb_cached.get_card_data(card_id=1, format_rows=True)
+      self.assertEqual(len(os.listdir(tmp_dir)), 2)
+
+
+
+  def test_get_card_data_batch(self):
+    parameter_sets = [ [{"type":"string/=","value":[value],"target":["dimension",["template-tag","test_filter"]]}] 
+                        for value in ['row1 cell1', 'row3 cell1', 'xyz'] ]
+    res = sorted(mb.get_card_data_batch(parameter_sets, card_id=2, concurrency=2), key=lambda i: i['index'])
+    self.assertEqual([ i['error'] for i in res ], [None, None, None])
+    self.assertEqual([ i['parameters'] for i in res ], parameter_sets)
+    self.assertEqual(res[0]['data'], [{'col1': 'row1 cell1', 'col2': 1}])
+    self.assertEqual(res[1]['data'], [{'col1': 'row3 cell1', 'col2': None}])
+    self.assertEqual(res[2]['data'], [])
+
+
+
+  def test_export_card_to_file(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      # csv (written as it is received)
+      res = mb.export_card_to_file(os.path.join(tmp_dir, 'card.csv'), card_id=1)
+      self.assertEqual(res['rows'], 5)
+      with open(res['path']) as f:
+        self.assertEqual(f.readline().strip(), 'col1,col2')
+
+      # jsonl (transcoded from json)
+      res = mb.export_card_to_file(os.path.join(tmp_dir, 'card.jsonl'), card_id=1, format='jsonl')
+      with open(res['path']) as f:
+        self.assertEqual([ json.loads(line) for line in f ], mb.get_card_data(card_id=1))
+      self.assertEqual(res['bytes'], os.path.getsize(res['path']))
+
 
 
   def test_clone_card(self):
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import httpx
+import requests
+
+from metabase_api import Metabase_API, Metabase_API_Async, MetadataStore
+
+
+def table(table_id, name, updated_at):
+  return {'id': table_id, 'name': name, 'db_id': 1, 'updated_at': updated_at}
+
+
+class _FakeMetabase():
+  """The listings and table metadata of a Metabase, which the tests change between refreshes"""
+
+  def __init__(self):
+    self.listings = {
+      'database': [{'id': 1, 'name': 'db', 'updated_at': '1'}],
+      'table': [table(2, 'orders', '1'), table(3, 'people', '1')],
+      'collection': [{'id': 4, 'name': 'Top', 'location': '/'}],
+      'card': [{'id': 5, 'name': 'q', 'collection_id': 4, 'updated_at': '1'}],
+      'dashboard': [],
+    }
+    self.fields = {2: [{'id': 20, 'name': 'ID'}], 3: [{'id': 30, 'name': 'NAME'}]}
+    self.requested = []
+
+  def handle(self, path):
+    if path == '/api/database/1':  # the check of the api key
+      return {}
+    self.requested.append(path)
+    item_type = path.split('/')[2]
+    if path.endswith('/query_metadata'):
+      return {'id': int(path.split('/')[3]), 'fields': self.fields[int(path.split('/')[3])]}
+    return {'data': self.listings[item_type]} if item_type == 'database' else self.listings[item_type]
+
+
+
+class _FakeSession(requests.Session):
+
+  def __init__(self, metabase):
+    super().__init__()
+    self.metabase = metabase
+
+  def request(self, method, url, **kwargs):
+    res = requests.Response()
+    res.status_code = 200
+    res._content = json.dumps(self.metabase.handle(url[len('http://metabase'):])).encode()
+    return res
+
+
+
+class MetadataStore_Test(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'metadata.sqlite')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir, ignore_errors=True)
+
+
+  def test_schema(self):
+    MetadataStore(self.path).close()
+    conn = sqlite3.connect(self.path)
+    tables = { i[0] for i in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'") }
+    conn.close()
+    self.assertEqual(tables, {'items', 'fields', 'snapshots'})
+
+    # opening an existing file keeps its content
+    store = MetadataStore(self.path)
+    store.update_items('card', [{'id': 1, 'name': 'q'}])
+    store.close()
+    store = MetadataStore(self.path)
+    self.assertEqual([ i['name'] for i in store.get_records('card') ], ['q'])
+    store.close()
+
+
+  def test_update_items(self):
+    store = MetadataStore(self.path)
+    self.assertIsNone(store.get_records('card'))  # no snapshot yet
+    cards = [{'id': 1, 'name': 'a', 'collection_id': 4, 'updated_at': '1'}, {'id': 2, 'name': 'b', 'collection_id': None, 'updated_at': '1'}]
+    self.assertEqual(store.update_items('card', cards), 2)
+    records = sorted(store.get_records('card'), key=lambda i: i['id'])
+    self.assertEqual(records[0]['collection_id'], 4)
+    self.assertEqual(records[1]['name'], 'b')
+    self.assertEqual(store.get_records('dashboard'), None)
+
+    # only the changed, new and removed items are written
+    self.assertEqual(store.update_items('card', cards), 0)
+    cards = [dict(cards[0], name='a2', updated_at='2'), {'id': 3, 'name': 'c'}]
+    self.assertEqual(store.update_items('card', cards), 3)
+    self.assertEqual(sorted(i['name'] for i in store.get_records('card')), ['a2', 'c'])
+    # without 'updated_at' the record itself is compared
+    self.assertEqual(store.update_items('card', cards), 0)
+    self.assertEqual(store.update_items('card', [cards[0], dict(cards[1], name='c2')]), 1)
+    store.close()
+
+
+  def test_staleness(self):
+    store = MetadataStore(self.path)
+    self.assertEqual(store.max_age, 86400)
+    store.update_items('card', [{'id': 1, 'name': 'a'}])
+    store.update_items('table', [table(2, 'orders', '1')])
+    store.mark_stale('card')
+    self.assertIsNone(store.get_records('card'))
+    self.assertIsNotNone(store.get_records('table'))
+    store.update_items('card', [{'id': 1, 'name': 'a'}])
+    self.assertIsNotNone(store.get_records('card'))
+    store.mark_stale()
+    self.assertIsNone(store.get_records('card'))
+    self.assertIsNone(store.get_records('table'))
+    store.close()
+
+    # a snapshot older than max_age is not used (unless max_age is None)
+    store = MetadataStore(self.path, max_age=60)
+    store.update_items('card', [{'id': 1, 'name': 'a'}])
+    with store._conn:
+      store._conn.execute('UPDATE snapshots SET refreshed_at = refreshed_at - 120')
+    self.assertIsNone(store.get_records('card'))
+    store.max_age = None
+    self.assertEqual(len(store.get_records('card')), 1)
+    store.close()
+
+
+  def test_table_fields(self):
+    store = MetadataStore(self.path)
+    store.update_items('table', [table(2, 'orders', '1'), table(3, 'people', '1')])
+    self.assertEqual(sorted(store.get_outdated_tables()), [2, 3])
+    self.assertIsNone(store.get_db_fields(1))  # the fields of some tables are missing
+    store.set_table_fields(2, [{'id': 20, 'name': 'ID'}], store.get_table_version(2))
+    store.set_table_fields(3, [{'id': 30, 'name': 'NAME'}], store.get_table_version(3))
+    self.assertEqual(store.get_outdated_tables(), [])
+    self.assertEqual(store.get_db_fields(1), {'orders': {'ID': 20}, 'people': {'NAME': 30}})
+    self.assertEqual(store.get_db_fields(2), {})
+    store.update_items('table', [table(2, 'orders', '2'), table(3, 'people', '1')])
+    self.assertEqual(store.get_outdated_tables(), [2])
+    self.assertEqual(store.get_table_fields(2), [{'id': 20, 'name': 'ID'}])  # kept until the refresh
+    store.close()
+
+
+
+class RefreshMetadataStore_Test(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'metadata.sqlite')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir, ignore_errors=True)
+
+
+  def check_refresh(self, metabase, refresh):
+    self.assertEqual(refresh(), {'database': 1, 'table': 2, 'collection': 1, 'card': 1, 'dashboard': 0, 'fields': 2})
+    self.assertEqual(sorted(i for i in metabase.requested if i.endswith('query_metadata')),
+                     ['/api/table/2/query_metadata', '/api/table/3/query_metadata'])
+
+    # nothing changed: the listings are fetched again but no field is pulled
+    del metabase.requested[:]
+    self.assertEqual(refresh(), {'database': 0, 'table': 0, 'collection': 0, 'card': 0, 'dashboard': 0, 'fields': 0})
+    self.assertEqual(sorted(metabase.requested), ['/api/card/', '/api/collection/', '/api/dashboard/', '/api/database/', '/api/table/'])
+
+    # only the fields of the changed table are pulled again
+    metabase.listings['table'][1] = table(3, 'people', '2')
+    metabase.fields[3] = [{'id': 31, 'name': 'EMAIL'}]
+    metabase.listings['card'].append({'id': 6, 'name': 'r', 'collection_id': 4, 'updated_at': '1'})
+    del metabase.requested[:]
+    self.assertEqual(refresh(), {'database': 0, 'table': 1, 'collection': 0, 'card': 1, 'dashboard': 0, 'fields': 1})
+    self.assertEqual([ i for i in metabase.requested if i.endswith('query_metadata') ], ['/api/table/3/query_metadata'])
+
+
+  def test_refresh(self):
+    metabase = _FakeMetabase()
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase), metadata_store=self.path)
+    self.check_refresh(metabase, mb.refresh_metadata_store)
+    mb.close()
+
+    # a new client resolves the names and columns from the store, without calling the API
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase), metadata_store=self.path)
+    del metabase.requested[:]
+    self.assertEqual(mb.get_item_id('card', 'r'), 6)
+    self.assertEqual(mb.get_columns_name_id(table_id=3), {'EMAIL': 31})
+    self.assertEqual(metabase.requested, [])
+    mb.close()
+
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase))
+    with self.assertRaises(ValueError):
+      mb.refresh_metadata_store()
+
+
+  def test_refresh_async(self):
+    metabase = _FakeMetabase()
+
+    def handler(request):
+      return httpx.Response(200, json=metabase.handle(request.url.path))
+
+    async def make_client():
+      mb = Metabase_API_Async('http://metabase', api_key='key', metadata_store=self.path)
+      await mb._client.aclose()
+      mb._client = httpx.AsyncClient(base_url=mb.domain, headers=mb.header, transport=httpx.MockTransport(handler))
+      return mb
+
+    loop = asyncio.new_event_loop()
+    try:
+      mb = loop.run_until_complete(make_client())
+      self.check_refresh(metabase, lambda: loop.run_until_complete(mb.refresh_metadata_store()))
+      del metabase.requested[:]
+      self.assertEqual(loop.run_until_complete(mb.get_item_id('card', 'r')), 6)
+      self.assertEqual(metabase.requested, [])
+      loop.run_until_complete(mb.aclose())
+    finally:
+      loop.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,81 @@
+import datetime
+import unittest
+
+from metabase_api._partitions import make_partitions
+
+
+TEMPLATE_TAGS = {
+  'order_date': {'type': 'dimension', 'widget-type': 'date/all-options'},
+  'id': {'type': 'dimension', 'widget-type': 'number/between'},
+  'region': {'type': 'dimension', 'widget-type': 'string/='},
+  'start_id': {'type': 'number'},
+  'end_id': {'type': 'number'},
+  'name': {'type': 'text'},
+}
+
+
+class MakePartitions_Test(unittest.TestCase):
+
+  def test_date_ranges(self):
+    partitions = make_partitions(TEMPLATE_TAGS, 'order_date', start='2024-01-01', end='2024-01-05', n_partitions=2)
+    target = ['dimension', ['template-tag', 'order_date']]
+    # date/range includes both ends, so each range ends the day before the start of the next one
+    self.assertEqual(partitions, [
+      [{'type': 'date/range', 'value': '2024-01-01~2024-01-02', 'target': target}],
+      [{'type': 'date/range', 'value': '2024-01-03~2024-01-04', 'target': target}],
+    ])
+    self.assertEqual(partitions, make_partitions(TEMPLATE_TAGS, 'order_date', start=datetime.date(2024, 1, 1),
+                                                 end=datetime.date(2024, 1, 5), n_partitions=2))
+
+
+  def test_date_ranges_are_not_empty(self):
+    # a range of 2 days gives 2 partitions of one day each, not 4 partitions
+    partitions = make_partitions(TEMPLATE_TAGS, 'order_date', start='2024-01-01', end='2024-01-03', n_partitions=4)
+    self.assertEqual([ p[0]['value'] for p in partitions ], ['2024-01-01~2024-01-01', '2024-01-02~2024-01-02'])
+
+
+  def test_integer_ranges(self):
+    partitions = make_partitions(TEMPLATE_TAGS, 'id', start=0, end=10, n_partitions=3)
+    target = ['dimension', ['template-tag', 'id']]
+    # number/between includes both ends
+    self.assertEqual(partitions, [
+      [{'type': 'number/between', 'value': [0, 2], 'target': target}],
+      [{'type': 'number/between', 'value': [3, 5], 'target': target}],
+      [{'type': 'number/between', 'value': [6, 9], 'target': target}],
+    ])
+    covered = [ i for p in partitions for i in range(p[0]['value'][0], p[0]['value'][1] + 1) ]
+    self.assertEqual(covered, list(range(10)))
+
+
+  def test_non_integer_ranges_need_two_variables(self):
+    with self.assertRaises(ValueError):
+      make_partitions(TEMPLATE_TAGS, 'id', start=0.0, end=1.0, n_partitions=2)
+
+    partitions = make_partitions(TEMPLATE_TAGS, 'start_id', start=0.0, end=1.0, n_partitions=2, end_template_tag='end_id')
+    self.assertEqual([ [i['value'] for i in p] for p in partitions ], [[0.0, 0.5], [0.5, 1.0]])
+    self.assertEqual(partitions[0][1], {'type': 'number/=', 'value': 0.5, 'target': ['variable', ['template-tag', 'end_id']]})
+
+
+  def test_values(self):
+    partitions = make_partitions(TEMPLATE_TAGS, 'region', values=['a', 'b', 'c'], n_partitions=2)
+    self.assertEqual([ p[0]['value'] for p in partitions ], [['a'], ['b', 'c']])
+    self.assertEqual(partitions[0][0]['type'], 'string/=')
+
+    partitions = make_partitions(TEMPLATE_TAGS, 'name', values=['a', 'b'])
+    self.assertEqual(partitions, [ [{'type': 'category', 'value': value, 'target': ['variable', ['template-tag', 'name']]}]
+                                   for value in ['a', 'b'] ])
+    with self.assertRaises(ValueError):
+      make_partitions(TEMPLATE_TAGS, 'name', values=['a', 'b'], n_partitions=1)
+
+
+  def test_errors(self):
+    with self.assertRaises(ValueError):
+      make_partitions(TEMPLATE_TAGS, 'missing', values=['a'])
+    with self.assertRaises(ValueError):
+      make_partitions(TEMPLATE_TAGS, 'id', start=10, end=0)
+    with self.assertRaises(ValueError):
+      make_partitions(TEMPLATE_TAGS, 'id')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from metabase_api import ResultCache
+
+
+class ResultCache_Test(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+
+  def tearDown(self):
+    shutil.rmtree(self.path, ignore_errors=True)
+
+
+  def test_key(self):
+    key = ResultCache.make_key(1, 'u1', [{'type': 'category', 'value': 1}])
+    self.assertEqual(key, ResultCache.make_key(1, 'u1', [{'value': 1, 'type': 'category'}]))
+    self.assertNotEqual(key, ResultCache.make_key(1, 'u2', [{'type': 'category', 'value': 1}]))
+    self.assertNotEqual(key, ResultCache.make_key(1, 'u1', [{'type': 'category', 'value': 1}], data_format='csv'))
+
+
+  def test_disk_tier_is_json(self):
+    result = {'cols': [{'name': 'v', 'base_type': 'type/BigInteger'}], 'rows': [[2**70], [None]]}
+    ResultCache(path=self.path).set('k', result)
+    with open(os.path.join(self.path, 'k')) as f:
+      self.assertTrue(f.read().startswith('['))
+    # a new cache (e.g. in another process) reads the entry from disk
+    self.assertEqual(ResultCache(path=self.path).get('k'), result)
+
+
+  def test_invalid_file_is_a_miss(self):
+    with open(os.path.join(self.path, 'k'), 'wb') as f:
+      f.write(b'\x80\x04\x95 not json')
+    self.assertIsNone(ResultCache(path=self.path).get('k'))
+
+
+  def test_results_are_copies(self):
+    cache = ResultCache()
+    cache.set('k', [{'v': 1}])
+    cache.get('k')[0]['v'] = 2
+    self.assertEqual(cache.get('k'), [{'v': 1}])
+
+
+if __name__ == '__main__':
+  unittest.main()
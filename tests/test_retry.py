@@ -0,0 +1,294 @@
+import asyncio
+import io
+import json
+import random
+import time
+import unittest
+from email.utils import formatdate
+
+import httpx
+import requests
+
+from metabase_api import Metabase_API, Metabase_API_Async, RetryPolicy, CircuitBreaker, CircuitBreakerOpen
+
+
+class _FailingSession(requests.Session):
+  """A session whose requests succeed until 'error' is set, and then fail with it (no network is used)"""
+  error = None
+
+  def request(self, *args, **kwargs):
+    if self.error:
+      raise self.error
+    res = requests.Response()
+    res.status_code = 200
+    res._content = b'{}'
+    return res
+
+
+
+class _FakeMetabase():
+  """
+  Answers the requests with the given statuses (one per request, then 200) and keeps the sessions:
+  a request with an expired session (see 'expire') gets a 401 response.
+  """
+
+  def __init__(self, statuses=(), retry_after=None):
+    self.statuses = list(statuses)
+    self.retry_after = retry_after
+    self.sessions = set()
+    self.requested = []  # (method, path, session id)
+
+  def expire(self):
+    self.sessions.clear()
+
+  def handle(self, method, path, session_id):
+    if path == '/api/database/1':  # the check of the api key
+      return 200, {}, {}
+    self.requested.append((method, path, session_id))
+    if path == '/api/session':
+      session_id = 'session-{}'.format(len(self.requested))
+      self.sessions.add(session_id)
+      return 200, {'id': session_id}, {}
+    if session_id is not None and session_id not in self.sessions:
+      return 401, {}, {}
+    status = self.statuses.pop(0) if self.statuses else 200
+    headers = {'Retry-After': self.retry_after} if status in [429, 503] and self.retry_after is not None else {}
+    return status, {}, headers
+
+
+
+class _FakeSession(requests.Session):
+
+  def __init__(self, metabase):
+    super().__init__()
+    self.metabase = metabase
+
+  def request(self, method, url, **kwargs):
+    session_id = (kwargs.get('headers') or {}).get('X-Metabase-Session')
+    status, body, headers = self.metabase.handle(method, url[len('http://metabase'):], session_id)
+    res = requests.Response()
+    res.status_code = status
+    res.headers.update(headers)
+    res._content = json.dumps(body).encode()
+    res.raw = io.BytesIO(res._content)  # closed before a retry or a replay
+    return res
+
+
+
+class RetryPolicy_Test(unittest.TestCase):
+
+  def test_backoff_bounds(self):
+    random.seed(0)
+    policy = RetryPolicy(backoff_factor=0.5, max_backoff=3)
+    for attempt, bound in enumerate([0.5, 1, 2, 3, 3]):
+      delays = [ policy.get_backoff(attempt) for i in range(200) ]
+      self.assertTrue(all(0 <= delay <= bound for delay in delays))
+      self.assertGreater(max(delays), bound / 2)  # full jitter: spread over the whole interval
+      self.assertLess(min(delays), bound / 2)
+
+
+  def test_retry_after(self):
+    policy = RetryPolicy(max_backoff=30)
+    self.assertEqual(policy.get_backoff(0, '2'), 2.0)
+    self.assertEqual(policy.get_backoff(0, '120'), 30)  # capped by max_backoff
+    self.assertEqual(policy.get_backoff(0, '-5'), 0.0)
+    self.assertAlmostEqual(policy.get_backoff(0, formatdate(time.time() + 10, usegmt=True)), 10, delta=1.5)
+    self.assertEqual(policy.get_backoff(0, formatdate(time.time() - 60, usegmt=True)), 0.0)
+    # an invalid header (or respect_retry_after=False) falls back to the backoff
+    self.assertLessEqual(policy.get_backoff(0, 'soon'), 0.5)
+    self.assertLessEqual(RetryPolicy(respect_retry_after=False).get_backoff(0, '20'), 0.5)
+
+
+  def test_statuses(self):
+    policy = RetryPolicy(max_retries=2)
+    self.assertTrue(policy.should_retry_status('GET', '/api/card/1', 503, 0))
+    self.assertTrue(policy.should_retry_status('PUT', '/api/card/1', 502, 1))
+    for status in [200, 400, 401, 404, 500]:
+      self.assertFalse(policy.should_retry_status('GET', '/api/card/1', status, 0))
+    # the retry limit
+    self.assertFalse(policy.should_retry_status('GET', '/api/card/1', 503, 2))
+    self.assertFalse(policy.should_retry_error('GET', '/api/card/1', 2))
+
+    # a POST is retried only if it was not processed, unless it only reads data
+    self.assertFalse(policy.should_retry_status('POST', '/api/card/', 503, 0))
+    self.assertTrue(policy.should_retry_status('POST', '/api/card/', 429, 0))
+    self.assertTrue(policy.should_retry_status('POST', '/api/card/1/query/json', 503, 0))
+    self.assertTrue(policy.should_retry_status('POST', '/api/dataset', 504, 0))
+    self.assertFalse(policy.should_retry_error('POST', '/api/card/', 0))
+    self.assertTrue(policy.should_retry_error('POST', '/api/card/', 0, connect_error=True))
+    self.assertTrue(RetryPolicy(retry_non_idempotent=True).should_retry_status('POST', '/api/card/', 503, 0))
+
+
+  def test_send(self):
+    metabase = _FakeMetabase([503, 429, 200], retry_after='0')
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase),
+                      retry_policy=RetryPolicy(max_retries=3, backoff_factor=0))
+    self.assertEqual(mb._send('GET', '/api/card/1').status_code, 200)
+    self.assertEqual(len(metabase.requested), 3)
+
+    # the last response is returned once the retries are used up
+    metabase = _FakeMetabase([503] * 5)
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase),
+                      retry_policy=RetryPolicy(max_retries=2, backoff_factor=0))
+    self.assertEqual(mb._send('GET', '/api/card/1').status_code, 503)
+    self.assertEqual(len(metabase.requested), 3)
+
+    # non-retryable statuses and non-idempotent requests are sent once
+    metabase = _FakeMetabase([500, 503])
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase),
+                      retry_policy=RetryPolicy(backoff_factor=0))
+    self.assertEqual(mb._send('GET', '/api/card/1').status_code, 500)
+    self.assertEqual(mb._send('POST', '/api/card/', json={}).status_code, 503)
+    self.assertEqual(len(metabase.requested), 2)
+
+
+
+class Reauthentication_Test(unittest.TestCase):
+
+  def test_reauth_on_401(self):
+    metabase = _FakeMetabase()
+    mb = Metabase_API('http://metabase', 'user', 'password', session=_FakeSession(metabase), reauth_on_401=True)
+    self.assertEqual(metabase.requested, [('POST', '/api/session', None)])
+    self.assertEqual(mb.get('/api/card/1'), {})
+    self.assertEqual(metabase.requested[1:], [('GET', '/api/card/1', 'session-1')])  # the session is not validated first
+
+    # a 401 response makes the client re-authenticate and replay the request once
+    metabase.expire()
+    del metabase.requested[:]
+    self.assertEqual(mb.get('/api/card/1'), {})
+    self.assertEqual(metabase.requested, [('GET', '/api/card/1', 'session-1'), ('POST', '/api/session', None),
+                                          ('GET', '/api/card/1', 'session-2')])
+    metabase.statuses = [401, 401]
+    del metabase.requested[:]
+    self.assertEqual(mb.get('/api/card/1', 'raw').status_code, 401)
+    self.assertEqual([ path for method, path, session_id in metabase.requested ], ['/api/card/1', '/api/session', '/api/card/1'])
+
+
+  def test_validate_session(self):
+    metabase = _FakeMetabase()
+    mb = Metabase_API('http://metabase', 'user', 'password', session=_FakeSession(metabase))
+    metabase.expire()
+    del metabase.requested[:]
+    self.assertEqual(mb.get('/api/card/1'), {})
+    self.assertEqual(metabase.requested, [('GET', '/api/user/current', 'session-1'), ('POST', '/api/session', None),
+                                          ('GET', '/api/card/1', 'session-2')])
+
+    # without an email there is no session to renew
+    metabase = _FakeMetabase([401])
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase), reauth_on_401=True)
+    self.assertIs(mb.get('/api/card/1'), False)
+    self.assertEqual(metabase.requested, [('GET', '/api/card/1', None)])
+
+
+  def test_reauth_on_401_async(self):
+    metabase = _FakeMetabase()
+
+    def handler(request):
+      status, body, headers = metabase.handle(request.method, request.url.path, request.headers.get('X-Metabase-Session'))
+      return httpx.Response(status, json=body, headers=headers)
+
+    async def run():
+      mb = Metabase_API_Async('http://metabase', 'user', 'password', reauth_on_401=True)
+      await mb._client.aclose()
+      mb._client = httpx.AsyncClient(base_url=mb.domain, transport=httpx.MockTransport(handler))
+      try:
+        await mb.get('/api/card/1')
+        metabase.expire()
+        del metabase.requested[:]
+        return await mb.get('/api/card/1')
+      finally:
+        await mb.aclose()
+
+    self.assertEqual(asyncio.run(run()), {})
+    self.assertEqual(metabase.requested, [('GET', '/api/card/1', 'session-1'), ('POST', '/api/session', 'session-1'),
+                                          ('GET', '/api/card/1', 'session-2')])
+
+
+
+class CircuitBreaker_Test(unittest.TestCase):
+
+  def test_opens_after_threshold(self):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_time=60)
+    self.assertEqual(breaker.state, 'closed')
+    self.assertFalse(breaker.before_request())
+    breaker.record_failure()
+    self.assertEqual(breaker.state, 'closed')
+    breaker.record_failure()
+    self.assertEqual(breaker.state, 'open')
+    with self.assertRaises(CircuitBreakerOpen):
+      breaker.before_request()
+
+
+  def test_success_resets_failures(self):
+    breaker = CircuitBreaker(failure_threshold=2, recovery_time=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    self.assertEqual(breaker.state, 'closed')
+
+
+  def test_half_open_trial(self):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_time=0.05)
+    breaker.record_failure()
+    self.assertEqual(breaker.state, 'open')
+    time.sleep(0.06)
+    self.assertEqual(breaker.state, 'half-open')
+
+    # a single trial request is let through
+    self.assertTrue(breaker.before_request())
+    with self.assertRaises(CircuitBreakerOpen):
+      breaker.before_request()
+
+    # a failed trial opens the circuit again
+    breaker.record_failure()
+    self.assertEqual(breaker.state, 'open')
+    time.sleep(0.06)
+
+    # a successful trial closes it
+    self.assertTrue(breaker.before_request())
+    breaker.record_success()
+    self.assertEqual(breaker.state, 'closed')
+    self.assertFalse(breaker.before_request())
+
+
+  def test_trial_released_on_unexpected_error(self):
+    for error in [requests.exceptions.ChunkedEncodingError('cut'), KeyboardInterrupt()]:
+      breaker = CircuitBreaker(failure_threshold=1, recovery_time=0.05)
+      session = _FailingSession()
+      mb = Metabase_API('http://localhost:1', api_key='key', session=session, circuit_breaker=breaker)
+      session.error = error
+      breaker.record_failure()
+      time.sleep(0.06)
+      with self.assertRaises(type(error)):
+        mb._send('GET', '/api/user/current')
+      # the trial failed (instead of staying in progress forever), so a new trial is allowed later
+      self.assertEqual(breaker.state, 'open')
+      time.sleep(0.06)
+      self.assertTrue(breaker.before_request())
+
+
+  def test_trial_released_on_cancellation(self):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_time=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    async def run():
+      mb = Metabase_API_Async('http://localhost:1', api_key='key', circuit_breaker=breaker)
+      async def send(*args, **kwargs):
+        await asyncio.sleep(10)
+      mb._client.send = send
+      task = asyncio.ensure_future(mb._send('GET', '/api/user/current'))
+      await asyncio.sleep(0.01)
+      task.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await task
+      await mb._client.aclose()
+
+    asyncio.run(run())
+    self.assertEqual(breaker.state, 'open')
+    time.sleep(0.06)
+    self.assertTrue(breaker.before_request())
+
+
+if __name__ == '__main__':
+  unittest.main()
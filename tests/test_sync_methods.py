@@ -0,0 +1,196 @@
+import asyncio
+import copy
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import httpx
+import requests
+
+from metabase_api import Metabase_API, Metabase_API_Async
+
+
+def dashcard(dashcard_id, card_id, row, col):
+  return {'id': dashcard_id, 'card_id': card_id, 'card': {'id': card_id, 'name': 'card'}, 'dashboard_tab_id': 7,
+          'row': row, 'col': col, 'size_x': 4, 'size_y': 4, 'visualization_settings': {}, 'parameter_mappings': [], 'series': []}
+
+
+QUERY = {'database': 1, 'type': 'native', 'native': {'query': 'select 1'}}
+
+
+class _FakeMetabase():
+  """
+  A source collection (1) with two cards, a dashboard with a tab and a pulse, and the copies written by the sync.
+  The dashcards and tabs are written as Metabase does: those with a negative id are created, the others are updated
+  and the ones missing from the body are deleted.
+  """
+
+  def __init__(self):
+    self.cards = {10: {'id': 10, 'name': 'a', 'collection_id': 1, 'display': 'table', 'dataset_query': QUERY},
+                  11: {'id': 11, 'name': 'b', 'collection_id': 1, 'display': 'table', 'dataset_query': QUERY}}
+    self.dashboards = {50: {'id': 50, 'name': 'd', 'collection_id': 1, 'parameters': [],
+                            'tabs': [{'id': 7, 'name': 'Tab', 'position': 0}],
+                            'dashcards': [dashcard(1, 10, 0, 0), dashcard(2, 11, 0, 4)]}}
+    self.pulses = {60: {'id': 60, 'name': 'p', 'collection_id': 1, 'skip_if_empty': True, 'parameters': [],
+                        'cards': [{'id': 10, 'name': 'a', 'include_csv': True, 'include_xls': False}],
+                        'channels': [{'id': 5, 'channel_type': 'email', 'enabled': True, 'schedule_type': 'daily',
+                                      'schedule_hour': 8, 'recipients': [{'id': 3, 'email': 'a@b.c', 'last_login': '1'}]}]}}
+    self.next_id = 1000
+    self.created = {}  # id -> (model, body)
+    self.copies = {}  # id -> dashboard written by the sync
+
+  def new_id(self):
+    self.next_id += 1
+    return self.next_id
+
+  def handle(self, method, path, body):
+    if path == '/api/database/1':  # the check of the api key
+      return 404, {}
+    match = re.match(r'^/api/(\w+)/(\d+)(/items)?$', path)
+    model, item_id = (match.group(1), int(match.group(2))) if match else (None, None)
+    if method == 'GET' and path == '/api/collection/':
+      return 200, [{'id': 1, 'name': 'Top', 'location': '/'}, {'id': 2, 'name': 'Dest', 'location': '/'}]
+    if method == 'GET' and path == '/api/card/':
+      return 200, list(self.cards.values())
+    if method == 'GET' and match and match.group(3):
+      items = [ {'model': model, 'id': i['id'], 'name': i['name']} for model, items in
+                [('card', self.cards), ('dashboard', self.dashboards), ('pulse', self.pulses)] for i in items.values() ]
+      return 200, {'data': items if item_id == 1 else []}
+    if method == 'GET' and model == 'dashboard':
+      dashboard = self.dashboards.get(item_id) or self.copies.get(item_id)
+      return (200, copy.deepcopy(dashboard)) if dashboard else (404, {})
+    if method == 'GET' and model == 'pulse':
+      return 200, copy.deepcopy(self.pulses[item_id])
+    if method == 'POST' and re.match(r'^/api/(collection|card|dashboard|pulse)/?$', path):
+      new_id = self.new_id()
+      self.created[new_id] = (path.split('/')[2], body)
+      if path.startswith('/api/dashboard'):
+        self.copies[new_id] = dict(body, id=new_id, tabs=[], dashcards=[])
+      return 200, {'id': new_id}
+    if method == 'PUT' and model == 'dashboard':
+      self.put_dashboard(self.copies[item_id], body)
+      return 200, {}
+    if method == 'PUT':
+      return 200, {}
+    return 404, {}
+
+  def put_dashboard(self, dashboard, body):
+    tab_ids = { tab['id']: tab['id'] if tab['id'] > 0 else self.new_id() for tab in body.get('tabs', []) }
+    dashboard['tabs'] = [ dict(tab, id=tab_ids[tab['id']], position=i) for i, tab in enumerate(body.get('tabs', [])) ]
+    existing = { i['id'] for i in dashboard['dashcards'] }
+    dashcards = []
+    for i in body.get('dashcards', []):
+      assert i['id'] < 0 or i['id'] in existing, 'an unknown dashcard is not updated by Metabase'
+      dashcards.append(dict(i, id=i['id'] if i['id'] > 0 else self.new_id(), dashboard_tab_id=tab_ids.get(i['dashboard_tab_id'])))
+    dashboard['dashcards'] = dashcards
+
+
+
+class _FakeSession(requests.Session):
+
+  def __init__(self, metabase):
+    super().__init__()
+    self.metabase = metabase
+
+  def request(self, method, url, **kwargs):
+    status, body = self.metabase.handle(method, url[len('http://metabase'):], kwargs.get('json'))
+    res = requests.Response()
+    res.status_code = status
+    res._content = json.dumps(body).encode()
+    return res
+
+
+
+class SyncCollection_Test(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.mapping_path = os.path.join(self.dir, 'mapping.jsonl')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir, ignore_errors=True)
+
+
+  def mapping(self):
+    with open(self.mapping_path) as f:
+      entries = [ json.loads(line) for line in f ]
+    return { (i['model'], i['source_id']): i for i in entries }
+
+
+  def check_sync(self, metabase, sync):
+    report = sync()
+    self.assertEqual(sorted((i['model'], i['source_id']) for i in report['created']),
+                     [('card', 10), ('card', 11), ('collection', 1), ('dashboard', 50), ('pulse', 60)])
+    ids = { (i['model'], i['source_id']): i['destination_id'] for i in report['created'] }
+
+    # the pulse uses the copies of the cards, and only the ids of the recipients are kept
+    pulse = metabase.created[ids[('pulse', 60)]][1]
+    self.assertEqual(pulse['cards'], [{'id': ids[('card', 10)], 'include_csv': True, 'include_xls': False}])
+    self.assertEqual(pulse['channels'][0]['recipients'], [{'id': 3}])
+    self.assertEqual(pulse['collection_id'], report['collection_id'])
+
+    # the ids of the copies of the tab and the dashcards are kept in the mapping
+    dashboard = metabase.copies[ids[('dashboard', 50)]]
+    entry = self.mapping()[('dashboard', 50)]
+    self.assertEqual(entry['tabs'], {'7': dashboard['tabs'][0]['id']})
+    self.assertEqual(entry['dashcards'], { str(source): i['id'] for source, i in zip([1, 2], dashboard['dashcards']) })
+    self.assertEqual([ i['card_id'] for i in dashboard['dashcards'] ], [ids[('card', 10)], ids[('card', 11)]])
+
+    # a changed dashboard: the copies of its dashcards are updated in place and only the new dashcard is created
+    source = metabase.dashboards[50]
+    source['dashcards'][0]['size_x'] = 8
+    source['dashcards'].append(dashcard(3, 10, 4, 0))
+    metabase.pulses[60]['channels'][0]['recipients'][0]['last_login'] = '2'  # not part of the definition
+    dashcard_ids = [ i['id'] for i in dashboard['dashcards'] ]
+    report = sync()
+    self.assertEqual([ (i['model'], i['source_id']) for i in report['updated'] ], [('dashboard', 50)])
+    self.assertEqual(report['created'], [])
+    self.assertEqual([ i['id'] for i in dashboard['dashcards'][:2] ], dashcard_ids)
+    self.assertEqual(dashboard['dashcards'][0]['size_x'], 8)
+    self.assertEqual(self.mapping()[('dashboard', 50)]['dashcards'],
+                     {'1': dashcard_ids[0], '2': dashcard_ids[1], '3': dashboard['dashcards'][2]['id']})
+
+    # the copy of a dashcard removed from the destination is created again
+    del dashboard['dashcards'][1]
+    source['dashcards'][1]['row'] = 1
+    sync()
+    self.assertEqual(dashboard['dashcards'][0]['id'], dashcard_ids[0])
+    self.assertNotIn(dashcard_ids[1], [ i['id'] for i in dashboard['dashcards'] ])
+    self.assertEqual(len(dashboard['dashcards']), 3)
+
+
+  def test_sync(self):
+    metabase = _FakeMetabase()
+    mb = Metabase_API('http://metabase', api_key='key', session=_FakeSession(metabase))
+    self.check_sync(metabase, lambda: mb.sync_collection(self.mapping_path, source_collection_id=1, destination_parent_collection_id=2))
+
+
+  def test_sync_async(self):
+    metabase = _FakeMetabase()
+
+    def handler(request):
+      status, body = metabase.handle(request.method, request.url.path, json.loads(request.content) if request.content else None)
+      return httpx.Response(status, json=body)
+
+    async def make_client():
+      mb = Metabase_API_Async('http://metabase', api_key='key')
+      await mb._client.aclose()
+      mb._client = httpx.AsyncClient(base_url=mb.domain, headers=mb.header, transport=httpx.MockTransport(handler))
+      return mb
+
+    loop = asyncio.new_event_loop()
+    try:
+      mb = loop.run_until_complete(make_client())
+      self.check_sync(metabase, lambda: loop.run_until_complete(
+        mb.sync_collection(self.mapping_path, source_collection_id=1, destination_parent_collection_id=2, concurrency=2)))
+      loop.run_until_complete(mb.aclose())
+    finally:
+      loop.close()
+
+
+if __name__ == '__main__':
+  unittest.main()